@@ -77,7 +77,7 @@ class BotConfigGenerator:
                 "ANALYTICS_RETENTION_DAYS": 90,
                 
                 # Broadcasting settings
-                "BROADCAST_DELAY": 1,  # seconds between messages
+                "BROADCAST_DELAY": 0,  # seconds between messages, 0 = Telegram's rate limit
                 "MAX_BROADCAST_SIZE": 1000,  # max recipients per broadcast
                 
                 # Configuration metadata
@@ -41,7 +41,7 @@ class Settings:
     BOT_RESTART_TIMEOUT: int = int(os.environ.get('BOT_RESTART_TIMEOUT', 10))
     
     # Broadcasting
-    BROADCAST_DELAY: float = float(os.environ.get('BROADCAST_DELAY', 1.0))
+    BROADCAST_DELAY: float = float(os.environ.get('BROADCAST_DELAY', 0.0))  # 0 = Telegram's rate limit
     MAX_BROADCAST_SIZE: int = int(os.environ.get('MAX_BROADCAST_SIZE', 1000))
     BROADCAST_TIMEOUT: int = int(os.environ.get('BROADCAST_TIMEOUT', 30))
     
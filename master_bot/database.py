@@ -6,11 +6,27 @@ Master Database - управление данными SaaS платформы
 import sqlite3
 import os
 import logging
+import threading
 import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
 from contextlib import contextmanager
 
+def _format_timestamp(value) -> Optional[str]:
+    """Format DB timestamp (datetime or ISO string) as 'YYYY-MM-DD HH:MM'"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    return str(value)[:16]
+
+def _bot_row(row) -> Dict:
+    """Convert bot row to dict with precomputed display fields"""
+    bot = dict(row)
+    bot['created_at_display'] = _format_timestamp(bot.get('created_at'))
+    bot['last_ping_display'] = _format_timestamp(bot.get('last_ping'))
+    return bot
+
 class MasterDatabase:
     def __init__(self, db_path: str = None):
         if db_path is None:
@@ -18,6 +34,7 @@ class MasterDatabase:
             db_path = os.path.join(data_dir, 'master_database.db')
         
         self.db_path = db_path
+        self._local = threading.local()
         self.init_database()
     
     def init_database(self):
@@ -77,6 +94,23 @@ class MasterDatabase:
             conn.commit()
             logging.info(f"Master database initialized: {self.db_path}")
     
+    def _get_thread_connection(self) -> sqlite3.Connection:
+        """Get connection reused by the current thread (opened on first use)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=30.0,  # 30 second timeout
+                check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row  # Enable dict-like access
+
+            # Set additional pragmas for better concurrency
+            conn.execute('PRAGMA busy_timeout=30000')  # 30 seconds
+
+            self._local.conn = conn
+        return conn
+
     @contextmanager
     def get_connection(self):
         """Context manager for database connections with retry logic"""
@@ -85,16 +119,8 @@ class MasterDatabase:
         
         for attempt in range(max_retries):
             try:
-                conn = sqlite3.connect(
-                    self.db_path, 
-                    timeout=30.0,  # 30 second timeout
-                    check_same_thread=False
-                )
-                conn.row_factory = sqlite3.Row  # Enable dict-like access
-                
-                # Set additional pragmas for better concurrency
-                conn.execute('PRAGMA busy_timeout=30000')  # 30 seconds
-                
+                conn = self._get_thread_connection()
+
                 try:
                     yield conn
                     conn.commit()
@@ -108,9 +134,7 @@ class MasterDatabase:
                     else:
                         logging.error(f"Database error: {e}")
                         raise
-                finally:
-                    conn.close()
-                    
+
             except sqlite3.OperationalError as e:
                 if "database is locked" in str(e).lower() and attempt < max_retries - 1:
                     logging.warning(f"Database connection locked, retrying {attempt + 1}/{max_retries}")
@@ -203,7 +227,7 @@ class MasterDatabase:
                 ''', (bot_id,))
                 
                 row = cursor.fetchone()
-                return dict(row) if row else None
+                return _bot_row(row) if row else None
         except Exception as e:
             logging.error(f"Error getting bot {bot_id}: {e}")
             return None
@@ -216,7 +240,7 @@ class MasterDatabase:
                     SELECT * FROM user_bots WHERE owner_id = ? ORDER BY created_at DESC
                 ''', (user_id,))
                 
-                return [dict(row) for row in cursor.fetchall()]
+                return [_bot_row(row) for row in cursor.fetchall()]
         except Exception as e:
             logging.error(f"Error getting bots for user {user_id}: {e}")
             return []
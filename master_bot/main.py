@@ -7,6 +7,7 @@ import asyncio
 import logging
 import re
 import sys
+import time
 import traceback
 from pathlib import Path
 from datetime import datetime
@@ -27,13 +28,142 @@ except ImportError as e:
     sys.exit(1)
 
 try:
-    from shared.telegram_utils import verify_bot_token
+    from shared.telegram_utils import verify_bot_token, close_client
+    from shared.database_utils import run_db
     logging.info("✅ Successfully imported verify_bot_token")
 except ImportError as e:
     logging.error(f"❌ Failed to import verify_bot_token: {e}")
     logging.error(f"Traceback: {traceback.format_exc()}")
     sys.exit(1)
 
+# Static buttons shared across dashboard renders
+CREATE_BOT_BUTTON = InlineKeyboardButton("➕ Создать нового бота", callback_data="create_bot")
+SUPPORT_BUTTON = InlineKeyboardButton("💬 Поддержка", callback_data="contact_support")
+
+# Callbacks that only display data and are safe to dedupe on the Telegram side
+READ_ONLY_CALLBACKS = ("show_examples", "contact_support", "manage_", "stats_")
+
+# Seconds a dashboard prefetch may serve bot rows before they are re-read
+BOTS_PREFETCH_TTL = 5
+
+# Static message texts (DEPLOY_SUCCESS_TEMPLATE is filled via str.format)
+WELCOME_MESSAGE = """
+🤖 <b>Добро пожаловать в Bot Factory!</b>
+
+Создай персонального бота для рассылок в твоем Telegram канале за 2 минуты:
+
+✅ Автоматические рассылки с задержками
+✅ Полная админ-панель в Telegram  
+✅ Статистика переходов и UTM-трекинг
+✅ Управление подписчиками канала
+
+🎁 <b>MVP версия - БЕСПЛАТНО для тестирования</b>
+
+<b>Что умеет твой бот:</b>
+• Автоматически одобрять заявки в закрытый канал
+• Отправлять рассылки всем участникам
+• Показывать статистику переходов
+• Управлять приветственными сообщениями
+
+<b>Как это работает:</b>
+1. Ты создаешь бота через @BotFather
+2. Даешь мне токен - я запускаю твоего бота
+3. Добавляешь бота админом в свой канал
+4. Управляешь через админ-панель
+
+Готов начать?
+"""
+
+DEPLOY_SUCCESS_TEMPLATE = """
+🎉 <b>Готово! Твой @{bot_username} запущен!</b>
+
+📋 <b>Что делать дальше:</b>
+
+<b>1️⃣ Добавь бота в канал как администратора:</b>
+• Зайди в настройки канала
+• Администраторы → Добавить администратора  
+• Найди @{bot_username} и добавь
+• Дай права: "Удаление сообщений" и "Приглашение пользователей"
+
+<b>2️⃣ Перейди к своему боту:</b> @{bot_username}
+
+<b>3️⃣ Напиши ему /start</b> - откроется админ-панель!
+
+🎁 <b>MVP версия работает бесплатно</b>
+📊 Полная статистика и аналитика
+⚡ Мгновенные рассылки и автоматизация
+
+<b>Нужна помощь?</b> Обращайся в поддержку!
+"""
+
+DEPLOY_ERROR_MESSAGE = """
+❌ <b>Ошибка при запуске бота</b>
+
+К сожалению, произошла ошибка при создании твоего бота.
+
+<b>Что делать:</b>
+• Попробуй еще раз через несколько минут
+• Обратись в поддержку для решения проблемы
+• Проверь, что токен был скопирован правильно
+
+Мы уже получили уведомление об ошибке и работаем над исправлением.
+"""
+
+EXAMPLES_MESSAGE = """
+📺 <b>Примеры использования Bot Factory</b>
+
+<b>🎯 Для бизнеса:</b>
+• Автоматические уведомления о новых товарах
+• Рассылка промо-акций и скидок  
+• Сбор заявок через закрытый канал
+• Статистика эффективности рекламы
+
+<b>📚 Для образования:</b>
+• Рассылка учебных материалов
+• Уведомления о занятиях и экзаменах
+• Автоматический прием в учебные группы
+• Статистика активности студентов
+
+<b>🎮 Для сообществ:</b>
+• Приветствие новых участников
+• Автоматическая модерация заявок
+• Регулярные дайджесты и новости
+• Интерактивные опросы и голосования
+
+<b>📈 Возможности ботов:</b>
+✅ Автоматические рассылки по расписанию
+✅ UTM-трекинг ссылок и переходов
+✅ Статистика активности участников  
+✅ Персонализированные сообщения
+✅ Интеграция с внешними сервисами
+"""
+
+SUPPORT_MESSAGE = """
+💬 <b>Поддержка Bot Factory</b>
+
+<b>Нужна помощь?</b> Мы всегда готовы помочь!
+
+📧 <b>Email:</b> support@botfactory.ru
+💬 <b>Telegram:</b> @BotFactorySupport  
+📱 <b>Чат поддержки:</b> @BotFactoryChat
+
+<b>Частые вопросы:</b>
+
+❓ <b>Как добавить бота в канал?</b>
+Перейди в настройки канала → Администраторы → Добавить администратора → Найди своего бота
+
+❓ <b>Бот не отвечает на команды</b>
+Убедись, что бот добавлен как администратор канала с правами на удаление сообщений
+
+❓ <b>Как настроить автоматические рассылки?</b>
+В админ-панели бота выбери "Управление рассылками" → "Создать рассылку"
+
+❓ <b>Где посмотреть статистику?</b>
+В админ-панели бота раздел "Статистика и аналитика"
+
+<b>🕐 Время ответа:</b> обычно в течение 2-4 часов
+"""
+
 class MasterBot:
     def __init__(self, bot_token: str):
         self.bot_token = bot_token
@@ -59,56 +189,48 @@ class MasterBot:
         
         try:
             # Update user activity
-            self.db.update_user_activity(user_id)
+            await run_db(self.db.update_user_activity, user_id)
             
             # Check if user exists
-            db_user = self.db.get_user_by_telegram_id(user_id)
+            db_user = await run_db(self.db.get_user_by_telegram_id, user_id)
             
             if not db_user:
                 # New user registration
-                db_user_id = self.db.create_user(
+                db_user_id = await run_db(
+                    self.db.create_user,
                     telegram_id=user_id,
                     username=user.username,
                     first_name=user.first_name
                 )
+                context.user_data['db_user'] = {
+                    'id': db_user_id,
+                    'telegram_id': user_id,
+                    'username': user.username,
+                    'first_name': user.first_name
+                }
                 
                 await self.send_welcome_message(update, context)
             else:
                 # Existing user - show dashboard
+                context.user_data['db_user'] = db_user
                 await self.show_user_dashboard(update, context, db_user)
                 
         except Exception as e:
             logging.error(f"Error in handle_start: {e}")
             await update.message.reply_text("❌ Произошла ошибка. Попробуйте позже.")
     
+    async def _get_db_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> dict:
+        """Get SaaS user record, cached in user_data for the conversation"""
+        db_user = context.user_data.get('db_user')
+        if not db_user:
+            db_user = await run_db(self.db.get_user_by_telegram_id, update.effective_user.id)
+            if db_user:
+                context.user_data['db_user'] = db_user
+        return db_user
+    
     async def send_welcome_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send welcome message to new user"""
-        message = """
-🤖 <b>Добро пожаловать в Bot Factory!</b>
-
-Создай персонального бота для рассылок в твоем Telegram канале за 2 минуты:
-
-✅ Автоматические рассылки с задержками
-✅ Полная админ-панель в Telegram  
-✅ Статистика переходов и UTM-трекинг
-✅ Управление подписчиками канала
-
-🎁 <b>MVP версия - БЕСПЛАТНО для тестирования</b>
-
-<b>Что умеет твой бот:</b>
-• Автоматически одобрять заявки в закрытый канал
-• Отправлять рассылки всем участникам
-• Показывать статистику переходов
-• Управлять приветственными сообщениями
-
-<b>Как это работает:</b>
-1. Ты создаешь бота через @BotFather
-2. Даешь мне токен - я запускаю твоего бота
-3. Добавляешь бота админом в свой канал
-4. Управляешь через админ-панель
-
-Готов начать?
-"""
+        message = WELCOME_MESSAGE
         
         keyboard = [
             [InlineKeyboardButton("🚀 Создать первого бота", callback_data="create_bot")],
@@ -125,7 +247,9 @@ class MasterBot:
     async def show_user_dashboard(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: dict):
         """Show user dashboard with existing bots"""
         try:
-            user_bots = self.db.get_user_bots(user['id'])
+            user_bots = await run_db(self.db.get_user_bots, user['id'])
+            context.user_data['bots_by_id'] = {b['id']: b for b in user_bots}
+            context.user_data['bots_by_id_at'] = time.monotonic()
             
             if not user_bots:
                 await self.send_welcome_message(update, context)
@@ -138,8 +262,6 @@ class MasterBot:
             message += f"👋 Привет, {safe_first_name}!\n\n"
             message += f"<b>Твои боты ({len(user_bots)}):</b>\n\n"
             
-            keyboard = []
-            
             for bot in user_bots:
                 status_emoji = {
                     'active': '✅',
@@ -147,20 +269,21 @@ class MasterBot:
                     'stopped': '⏸️',
                     'error': '❌'
                 }.get(bot['status'], '❓')
-                
+
                 bot_username = bot.get('bot_username', 'unknown')
                 bot_status = bot.get('status', 'unknown')
-                
+
                 message += f"{status_emoji} @{bot_username} - {bot_status}\n"
-                
-                keyboard.append([
-                    InlineKeyboardButton(f"⚙️ @{bot_username}", callback_data=f"manage_{bot['id']}"),
+
+            keyboard = [
+                [
+                    InlineKeyboardButton(f"⚙️ @{bot.get('bot_username', 'unknown')}", callback_data=f"manage_{bot['id']}"),
                     InlineKeyboardButton("📊", callback_data=f"stats_{bot['id']}")
-                ])
-            
-            keyboard.append([InlineKeyboardButton("➕ Создать нового бота", callback_data="create_bot")])
-            keyboard.append([InlineKeyboardButton("💬 Поддержка", callback_data="contact_support")])
-            
+                ]
+                for bot in user_bots
+            ]
+            keyboard += [[CREATE_BOT_BUTTON], [SUPPORT_BUTTON]]
+
             if update.callback_query:
                 await update.callback_query.edit_message_text(
                     message,
@@ -178,10 +301,7 @@ class MasterBot:
             # Fallback без форматирования
             fallback_message = "🏠 Твоя панель управления\n\nДобро пожаловать! Выберите действие из меню ниже."
             
-            keyboard = [
-                [InlineKeyboardButton("➕ Создать нового бота", callback_data="create_bot")],
-                [InlineKeyboardButton("💬 Поддержка", callback_data="contact_support")]
-            ]
+            keyboard = [[CREATE_BOT_BUTTON], [SUPPORT_BUTTON]]
             
             if update.callback_query:
                 await update.callback_query.edit_message_text(
@@ -197,9 +317,9 @@ class MasterBot:
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle callback queries"""
         query = update.callback_query
-        await query.answer()
-        
         data = query.data
+        # Let Telegram dedupe repeat taps on idempotent buttons
+        await query.answer(cache_time=3 if data.startswith(READ_ONLY_CALLBACKS) else 0)
         
         try:
             if data == "create_bot":
@@ -218,7 +338,7 @@ class MasterBot:
                 bot_id = int(data.split("_")[1])
                 await self.restart_bot(update, context, bot_id)
             elif data == "back_to_dashboard":
-                user = self.db.get_user_by_telegram_id(update.effective_user.id)
+                user = await self._get_db_user(update, context)
                 await self.show_user_dashboard(update, context, user)
             else:
                 await query.answer("🚧 Функция в разработке")
@@ -317,7 +437,7 @@ class MasterBot:
             logging.info(f"✅ Token verified successfully for user {user_id}, bot: @{bot_info['username']}")
             
             # Check if token already exists
-            if self.db.bot_exists_by_token(token):
+            if await run_db(self.db.bot_exists_by_token, token):
                 logging.warning(f"❌ Token already exists for user {user_id}")
                 await processing_msg.edit_text(
                     "❌ <b>Этот бот уже зарегистрирован</b>\n\n"
@@ -326,10 +446,11 @@ class MasterBot:
                 return
             
             # Create bot record
-            db_user = self.db.get_user_by_telegram_id(user_id)
+            db_user = await self._get_db_user(update, context)
             logging.info(f"🔄 Creating bot record for user {user_id}")
             
-            bot_id = self.db.create_user_bot(
+            bot_id = await run_db(
+                self.db.create_user_bot,
                 owner_id=db_user['id'],
                 bot_token=token,
                 bot_username=bot_info['username'],
@@ -411,27 +532,7 @@ class MasterBot:
         """Show successful deployment message"""
         bot_username = bot_info['username']
         
-        message = f"""
-🎉 <b>Готово! Твой @{bot_username} запущен!</b>
-
-📋 <b>Что делать дальше:</b>
-
-<b>1️⃣ Добавь бота в канал как администратора:</b>
-• Зайди в настройки канала
-• Администраторы → Добавить администратора  
-• Найди @{bot_username} и добавь
-• Дай права: "Удаление сообщений" и "Приглашение пользователей"
-
-<b>2️⃣ Перейди к своему боту:</b> @{bot_username}
-
-<b>3️⃣ Напиши ему /start</b> - откроется админ-панель!
-
-🎁 <b>MVP версия работает бесплатно</b>
-📊 Полная статистика и аналитика
-⚡ Мгновенные рассылки и автоматизация
-
-<b>Нужна помощь?</b> Обращайся в поддержку!
-"""
+        message = DEPLOY_SUCCESS_TEMPLATE.format(bot_username=bot_username)
         
         keyboard = [
             [InlineKeyboardButton(f"🤖 Перейти к @{bot_username}", 
@@ -448,24 +549,14 @@ class MasterBot:
             parse_mode='HTML'
         )
         
-        # Clear creation state
-        context.user_data.clear()
+        # Clear creation state (keep cached db_user)
+        context.user_data.pop('creation_step', None)
+        context.user_data.pop('bot_id', None)
     
     async def show_deployment_error(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
                                   message_to_edit, error_details: str = None):
         """Show deployment error message"""
-        message = """
-❌ <b>Ошибка при запуске бота</b>
-
-К сожалению, произошла ошибка при создании твоего бота.
-
-<b>Что делать:</b>
-• Попробуй еще раз через несколько минут
-• Обратись в поддержку для решения проблемы
-• Проверь, что токен был скопирован правильно
-
-Мы уже получили уведомление об ошибке и работаем над исправлением.
-"""
+        message = DEPLOY_ERROR_MESSAGE
         
         if error_details:
             message += f"\n\n<i>Техническая информация:</i>\n<code>{error_details[:200]}</code>"
@@ -484,34 +575,7 @@ class MasterBot:
     
     async def show_examples(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show bot examples"""
-        message = """
-📺 <b>Примеры использования Bot Factory</b>
-
-<b>🎯 Для бизнеса:</b>
-• Автоматические уведомления о новых товарах
-• Рассылка промо-акций и скидок  
-• Сбор заявок через закрытый канал
-• Статистика эффективности рекламы
-
-<b>📚 Для образования:</b>
-• Рассылка учебных материалов
-• Уведомления о занятиях и экзаменах
-• Автоматический прием в учебные группы
-• Статистика активности студентов
-
-<b>🎮 Для сообществ:</b>
-• Приветствие новых участников
-• Автоматическая модерация заявок
-• Регулярные дайджесты и новости
-• Интерактивные опросы и голосования
-
-<b>📈 Возможности ботов:</b>
-✅ Автоматические рассылки по расписанию
-✅ UTM-трекинг ссылок и переходов
-✅ Статистика активности участников  
-✅ Персонализированные сообщения
-✅ Интеграция с внешними сервисами
-"""
+        message = EXAMPLES_MESSAGE
         
         keyboard = [
             [InlineKeyboardButton("🚀 Создать своего бота", callback_data="create_bot")],
@@ -526,31 +590,7 @@ class MasterBot:
     
     async def contact_support(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show support information"""  
-        message = """
-💬 <b>Поддержка Bot Factory</b>
-
-<b>Нужна помощь?</b> Мы всегда готовы помочь!
-
-📧 <b>Email:</b> support@botfactory.ru
-💬 <b>Telegram:</b> @BotFactorySupport  
-📱 <b>Чат поддержки:</b> @BotFactoryChat
-
-<b>Частые вопросы:</b>
-
-❓ <b>Как добавить бота в канал?</b>
-Перейди в настройки канала → Администраторы → Добавить администратора → Найди своего бота
-
-❓ <b>Бот не отвечает на команды</b>
-Убедись, что бот добавлен как администратор канала с правами на удаление сообщений
-
-❓ <b>Как настроить автоматические рассылки?</b>
-В админ-панели бота выбери "Управление рассылками" → "Создать рассылку"
-
-❓ <b>Где посмотреть статистику?</b>
-В админ-панели бота раздел "Статистика и аналитика"
-
-<b>🕐 Время ответа:</b> обычно в течение 2-4 часов
-"""
+        message = SUPPORT_MESSAGE
         
         keyboard = [
             [InlineKeyboardButton("📧 Написать в поддержку", url="https://t.me/BotFactorySupport")],
@@ -563,10 +603,21 @@ class MasterBot:
             parse_mode='HTML'
         )
     
+    async def _get_bot(self, context: ContextTypes.DEFAULT_TYPE, bot_id: int):
+        """Get bot from a fresh dashboard prefetch, falling back to DB"""
+        bot = None
+        fetched_at = context.user_data.get('bots_by_id_at')
+        # Status, PID and last ping change under an old dashboard keyboard
+        if fetched_at is not None and time.monotonic() - fetched_at < BOTS_PREFETCH_TTL:
+            bot = context.user_data.get('bots_by_id', {}).get(bot_id)
+        if bot is None:
+            bot = await run_db(self.db.get_bot_by_id, bot_id)
+        return bot
+    
     async def manage_bot(self, update: Update, context: ContextTypes.DEFAULT_TYPE, bot_id: int):
         """Show bot management options"""
         try:
-            bot = self.db.get_bot_by_id(bot_id)
+            bot = await self._get_bot(context, bot_id)
             if not bot:
                 await update.callback_query.answer("Бот не найден")
                 return
@@ -579,9 +630,8 @@ class MasterBot:
             }.get(bot['status'], '❓ Неизвестно')
             
             bot_username = bot.get('bot_username', 'unknown')
-            created_at = bot.get('created_at', 'Неизвестно')[:16]
-            last_ping = bot.get('last_ping')
-            last_ping_text = last_ping[:16] if last_ping else 'Никогда'
+            created_at = bot.get('created_at_display') or 'Неизвестно'
+            last_ping_text = bot.get('last_ping_display') or 'Никогда'
             error_message = bot.get('error_message', '')
             
             message = f"""
@@ -617,7 +667,9 @@ class MasterBot:
     async def restart_bot(self, update: Update, context: ContextTypes.DEFAULT_TYPE, bot_id: int):
         """Restart a user bot"""
         try:
-            bot = self.db.get_bot_by_id(bot_id)
+            # Status changes on restart, so drop the prefetched row
+            context.user_data.get('bots_by_id', {}).pop(bot_id, None)
+            bot = await run_db(self.db.get_bot_by_id, bot_id)
             if not bot:
                 await update.callback_query.answer("Бот не найден")
                 return
@@ -682,16 +734,15 @@ class MasterBot:
     async def show_bot_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE, bot_id: int):
         """Show bot statistics"""
         try:
-            bot = self.db.get_bot_by_id(bot_id)
+            bot = await self._get_bot(context, bot_id)
             if not bot:
                 await update.callback_query.answer("Бот не найден")
                 return
             
             bot_username = bot.get('bot_username', 'unknown')
             bot_status = bot.get('status', 'unknown')
-            created_at = bot.get('created_at', 'Неизвестно')[:16]
-            last_ping = bot.get('last_ping')
-            last_ping_text = last_ping[:16] if last_ping else 'Неизвестно'
+            created_at = bot.get('created_at_display') or 'Неизвестно'
+            last_ping_text = bot.get('last_ping_display') or 'Неизвестно'
             process_id = bot.get('process_id', 'Неизвестно')
             database_status = '✅ Создана' if bot.get('database_path') else '❌ Не создана'
             
@@ -731,7 +782,14 @@ class MasterBot:
         """Run the master bot - СИНХРОННАЯ ВЕРСИЯ"""
         try:
             logging.info("🔄 Creating Application...")
-            self.application = Application.builder().token(self.bot_token).build()
+            # Read timeout must exceed the 20s long-poll window
+            self.application = (
+                Application.builder()
+                .token(self.bot_token)
+                .get_updates_read_timeout(25)
+                .post_shutdown(lambda app: close_client())
+                .build()
+            )
             
             # Setup handlers (это теперь должно быть синхронно)
             logging.info("🔄 Setting up handlers...")
@@ -740,7 +798,12 @@ class MasterBot:
             logging.info("🚀 Starting Master Bot...")
             
             # ПРОСТОЙ СИНХРОННЫЙ ПОДХОД
-            self.application.run_polling(drop_pending_updates=True)
+            self.application.run_polling(
+                drop_pending_updates=True,
+                timeout=20,
+                poll_interval=0,
+                bootstrap_retries=-1
+            )
             
         except Exception as e:
             logging.error(f"❌ Error running master bot: {e}")
@@ -2,6 +2,16 @@
 Application Constants - общие константы для всего приложения
 """
 
+import re
+
+try:
+    import re2  # optional: google-re2, linear-time matching for untrusted text
+except ImportError:
+    re2 = None
+
+# Allowlists are frozensets for O(1) membership checks,
+# *_ORDER tuples keep the display order
+
 # Bot statuses
 BOT_STATUS_CREATING = 'creating'
 BOT_STATUS_ACTIVE = 'active'
@@ -9,13 +19,14 @@ BOT_STATUS_STOPPED = 'stopped'
 BOT_STATUS_ERROR = 'error'
 BOT_STATUS_DELETED = 'deleted'
 
-BOT_STATUSES = [
+BOT_STATUSES_ORDER = (
     BOT_STATUS_CREATING,
     BOT_STATUS_ACTIVE,
     BOT_STATUS_STOPPED,
     BOT_STATUS_ERROR,
     BOT_STATUS_DELETED
-]
+)
+BOT_STATUSES = frozenset(BOT_STATUSES_ORDER)
 
 # User subscription statuses
 SUBSCRIPTION_TRIAL = 'trial'
@@ -23,12 +34,13 @@ SUBSCRIPTION_ACTIVE = 'active'
 SUBSCRIPTION_EXPIRED = 'expired'
 SUBSCRIPTION_CANCELLED = 'cancelled'
 
-SUBSCRIPTION_STATUSES = [
+SUBSCRIPTION_STATUSES_ORDER = (
     SUBSCRIPTION_TRIAL,
     SUBSCRIPTION_ACTIVE,
     SUBSCRIPTION_EXPIRED,
     SUBSCRIPTION_CANCELLED
-]
+)
+SUBSCRIPTION_STATUSES = frozenset(SUBSCRIPTION_STATUSES_ORDER)
 
 # Message types
 MESSAGE_TYPE_WELCOME = 'welcome'
@@ -39,7 +51,7 @@ MESSAGE_TYPE_MEMBER_ADDED = 'member_added'
 MESSAGE_TYPE_MEMBER_LEFT = 'member_left'
 MESSAGE_TYPE_URL_SHARED = 'url_shared'
 
-MESSAGE_TYPES = [
+MESSAGE_TYPES_ORDER = (
     MESSAGE_TYPE_WELCOME,
     MESSAGE_TYPE_FAREWELL,
     MESSAGE_TYPE_BROADCAST,
@@ -47,7 +59,8 @@ MESSAGE_TYPES = [
     MESSAGE_TYPE_MEMBER_ADDED,
     MESSAGE_TYPE_MEMBER_LEFT,
     MESSAGE_TYPE_URL_SHARED
-]
+)
+MESSAGE_TYPES = frozenset(MESSAGE_TYPES_ORDER)
 
 # Event types for system logs
 EVENT_USER_REGISTERED = 'user_registered'
@@ -59,7 +72,7 @@ EVENT_BROADCAST_SENT = 'broadcast_sent'
 EVENT_USER_JOINED = 'user_joined'
 EVENT_USER_LEFT = 'user_left'
 
-EVENT_TYPES = [
+EVENT_TYPES_ORDER = (
     EVENT_USER_REGISTERED,
     EVENT_BOT_CREATED,
     EVENT_BOT_STARTED,
@@ -68,7 +81,8 @@ EVENT_TYPES = [
     EVENT_BROADCAST_SENT,
     EVENT_USER_JOINED,
     EVENT_USER_LEFT
-]
+)
+EVENT_TYPES = frozenset(EVENT_TYPES_ORDER)
 
 # UTM sources
 UTM_SOURCE_CHANNEL_JOIN = 'channel_join'
@@ -80,7 +94,7 @@ UTM_SOURCE_AUTO_APPROVE = 'auto_approve'
 UTM_SOURCE_AUTO_WELCOME = 'auto_welcome'
 UTM_SOURCE_AUTO_FAREWELL = 'auto_farewell'
 
-UTM_SOURCES = [
+UTM_SOURCES_ORDER = (
     UTM_SOURCE_CHANNEL_JOIN,
     UTM_SOURCE_CHANNEL_INVITE,
     UTM_SOURCE_CHANNEL_MESSAGE,
@@ -89,7 +103,8 @@ UTM_SOURCES = [
     UTM_SOURCE_AUTO_APPROVE,
     UTM_SOURCE_AUTO_WELCOME,
     UTM_SOURCE_AUTO_FAREWELL
-]
+)
+UTM_SOURCES = frozenset(UTM_SOURCES_ORDER)
 
 # Default configuration values
 DEFAULT_WELCOME_MESSAGE = "👋 Добро пожаловать в наш канал! Мы рады видеть тебя здесь."
@@ -100,7 +115,7 @@ DEFAULT_AUTO_APPROVE_MESSAGE = "✅ Твоя заявка одобрена! До
 MAX_MESSAGE_LENGTH = 4000
 MAX_BROADCAST_SIZE = 1000
 MAX_BOTS_PER_USER = 5  # For future implementation
-BROADCAST_DELAY_SECONDS = 1
+BROADCAST_DELAY_SECONDS = 0  # 0 = send at Telegram's rate limit
 HEALTH_CHECK_INTERVAL_SECONDS = 300  # 5 minutes
 
 # Rate limiting
@@ -135,6 +150,8 @@ TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 TELEGRAM_MAX_CAPTION_LENGTH = 1024
 TELEGRAM_RATE_LIMIT_PER_SECOND = 30
 TELEGRAM_RATE_LIMIT_PER_MINUTE = 20
+# Max broadcast sends in flight at once per bot
+BROADCAST_CONCURRENCY = 30
 
 # Error messages
 ERROR_BOT_NOT_FOUND = 'Бот не найден'
@@ -153,10 +170,11 @@ SUCCESS_BOT_STOPPED = 'Бот остановлен'
 SUCCESS_BROADCAST_SENT = 'Рассылка отправлена'
 SUCCESS_SETTINGS_UPDATED = 'Настройки обновлены'
 
-# Regex patterns
-TELEGRAM_BOT_TOKEN_PATTERN = r'^\d+:[A-Za-z0-9_-]+$'
-TELEGRAM_USERNAME_PATTERN = r'^[a-zA-Z0-9_]+$'
-URL_PATTERN = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+# Regex patterns (compiled once at import)
+TELEGRAM_BOT_TOKEN_PATTERN = re.compile(r'^\d+:[A-Za-z0-9_-]+$')
+TELEGRAM_USERNAME_PATTERN = re.compile(r'^[a-zA-Z0-9_]+$')
+# URLs are extracted from arbitrary user messages, use re2 when installed
+URL_PATTERN = (re2 or re).compile(r"https?://(?:[a-zA-Z0-9\-._~:/?#\[\]@!$&'()*+,;=]|%[0-9a-fA-F]{2})+")
 
 # Cache settings
 STATS_CACHE_DURATION_MINUTES = 60
@@ -3,32 +3,153 @@ Database Utilities - общие функции для работы с базам
 """
 
 import os
+import re
+import asyncio
+import queue
+import shutil
 import sqlite3
 import logging
+import threading
+import time
 from pathlib import Path
+from datetime import datetime
+from functools import lru_cache
 from typing import Optional, Dict, Any, List
 from contextlib import contextmanager
 
+from .constants import STATS_CACHE_DURATION_MINUTES
+
+logger = logging.getLogger(__name__)
+
+# Per-path pool of warm connections (keeps SQLite page cache between calls)
+POOL_MAX_SIZE = 8
+_POOLS: Dict[str, queue.LifoQueue] = {}
+_POOLS_LOCK = threading.Lock()
+
+# Table/column names allowed in interpolated SQL
+IDENTIFIER_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Share of free pages that makes a full VACUUM worth its O(db_size) rewrite
+VACUUM_FREELIST_RATIO = 0.25
+
+# get_database_info(fast=True) results: db_path -> (expires_at, info)
+_INFO_CACHE: Dict[str, tuple] = {}
+
+# test_database_connection results: db_path -> (expires_at, ok)
+HEALTH_CHECK_TTL_SECONDS = 10
+_HEALTH_CACHE: Dict[str, tuple] = {}
+
+AUTO_VACUUM_INCREMENTAL = 2
+INCREMENTAL_VACUUM_PAGES = 1000
+
+async def run_db(func, *args, **kwargs):
+    """Run blocking database call in a worker thread"""
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+def _open_connection(db_path: str) -> sqlite3.Connection:
+    """Open new pooled connection with tuned PRAGMAs"""
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    
+    # Takes effect immediately on a new file, on existing ones after next VACUUM
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    
+    # journal_mode is persistent in the file, only switch it once
+    if conn.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal':
+        conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-64000')
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
+
+def _db_mtime(db_path: str) -> float:
+    """Latest modification time of database file and its WAL"""
+    wal_path = f"{db_path}-wal"
+    mtime = os.path.getmtime(db_path)
+    if os.path.exists(wal_path):
+        mtime = max(mtime, os.path.getmtime(wal_path))
+    return mtime
+
+def _get_pool(db_path: str) -> queue.LifoQueue:
+    """Get (or create) connection pool for database path"""
+    pool = _POOLS.get(db_path)
+    if pool is None:
+        with _POOLS_LOCK:
+            pool = _POOLS.setdefault(db_path, queue.LifoQueue(maxsize=POOL_MAX_SIZE))
+    return pool
+
+@contextmanager
+def acquire(db_path: str):
+    """Borrow a pooled connection, returning it to the pool on exit"""
+    db_path = str(db_path)
+    pool = _get_pool(db_path)
+    
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection(db_path)
+    
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
 def ensure_directory_exists(directory_path: Path):
     """Ensure directory exists, create if not"""
     try:
         directory_path.mkdir(parents=True, exist_ok=True)
-        logging.info(f"Directory ensured: {directory_path}")
+        logger.info("Directory ensured: %s", directory_path)
     except Exception as e:
-        logging.error(f"Failed to create directory {directory_path}: {e}")
+        logger.error("Failed to create directory %s: %s", directory_path, e)
         raise
 
+@lru_cache(maxsize=1)
 def get_data_directory() -> Path:
     """Get data directory path"""
     data_dir = os.environ.get('RENDER_DISK_PATH', '/data')
     return Path(data_dir)
 
+@lru_cache(maxsize=128)
 def get_database_path(db_name: str) -> Path:
     """Get full path for database file"""
     data_dir = get_data_directory()
     return data_dir / db_name
 
-def backup_database(db_path: str, backup_dir: str = None) -> Optional[str]:
+def _copy_file(src_path, dst_path):
+    """Copy file via in-kernel sendfile where available, else shutil.copy2"""
+    if not hasattr(os, 'sendfile'):
+        shutil.copy2(src_path, dst_path)
+        return
+    
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            remaining = os.fstat(src_fd).st_size
+            offset = 0
+            while remaining > 0:
+                sent = os.sendfile(dst_fd, src_fd, offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    
+    shutil.copystat(src_path, dst_path)
+
+def backup_database(db_path: str, backup_dir: str = None,
+                    use_backup_api: bool = True) -> Optional[str]:
     """Create database backup"""
     try:
         if backup_dir is None:
@@ -37,29 +158,48 @@ def backup_database(db_path: str, backup_dir: str = None) -> Optional[str]:
         ensure_directory_exists(Path(backup_dir))
         
         # Generate backup filename with timestamp
-        from datetime import datetime
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         db_name = Path(db_path).name
         backup_filename = f"{db_name}_{timestamp}.backup"
         backup_path = Path(backup_dir) / backup_filename
         
-        # Copy database file
-        import shutil
-        shutil.copy2(db_path, backup_path)
+        if use_backup_api:
+            # Online backup is consistent even while other connections write (WAL included)
+            with acquire(db_path) as src_conn:
+                dst_conn = sqlite3.connect(str(backup_path))
+                try:
+                    src_conn.backup(dst_conn, pages=1000)
+                finally:
+                    dst_conn.close()
+        else:
+            # Raw copy of the database file
+            _copy_file(db_path, backup_path)
         
-        logging.info(f"Database backed up: {db_path} -> {backup_path}")
+        logger.info("Database backed up: %s -> %s", db_path, backup_path)
         return str(backup_path)
         
     except Exception as e:
-        logging.error(f"Failed to backup database {db_path}: {e}")
+        logger.error("Failed to backup database %s: %s", db_path, e)
         return None
 
-def optimize_database(db_path: str):
+def optimize_database(db_path: str, force_vacuum: bool = False):
     """Optimize database performance"""
     try:
-        with sqlite3.connect(db_path) as conn:
-            # Run VACUUM to reclaim space
-            conn.execute('VACUUM')
+        with acquire(db_path) as conn:
+            auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            
+            if force_vacuum or auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+                # Full VACUUM rewrites the whole file (and applies a pending
+                # auto_vacuum mode change), only run it when asked or when
+                # enough pages are free
+                page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+                freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if force_vacuum or (page_count and freelist_count / page_count >= VACUUM_FREELIST_RATIO):
+                    conn.execute('VACUUM')
+            else:
+                # Reclaim free pages only, bounded by freelist size
+                # (executescript steps the pragma to completion, execute frees one page)
+                conn.executescript(f'PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES});')
             
             # Analyze tables for query optimization
             conn.execute('ANALYZE')
@@ -69,14 +209,19 @@ def optimize_database(db_path: str):
             
             conn.commit()
             
-        logging.info(f"Database optimized: {db_path}")
+        logger.info("Database optimized: %s", db_path)
         
     except Exception as e:
-        logging.error(f"Failed to optimize database {db_path}: {e}")
+        logger.error("Failed to optimize database %s: %s", db_path, e)
 
-def get_database_info(db_path: str) -> Dict[str, Any]:
-    """Get database information and statistics"""
+def get_database_info(db_path: str, fast: bool = False) -> Dict[str, Any]:
+    """Get database information and statistics (fast=True approximates row counts)"""
     try:
+        if fast:
+            cached = _INFO_CACHE.get(db_path)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
+        
         info = {
             'path': db_path,
             'exists': os.path.exists(db_path),
@@ -92,9 +237,7 @@ def get_database_info(db_path: str) -> Dict[str, Any]:
         info['size_bytes'] = os.path.getsize(db_path)
         info['size_mb'] = round(info['size_bytes'] / 1024 / 1024, 2)
         
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            
+        with acquire(db_path) as conn:
             # Get table list
             cursor = conn.execute('''
                 SELECT name FROM sqlite_master 
@@ -108,9 +251,15 @@ def get_database_info(db_path: str) -> Dict[str, Any]:
             for row in cursor.fetchall():
                 table_name = row['name']
                 
-                # Get row count for each table
-                count_cursor = conn.execute(f'SELECT COUNT(*) FROM {table_name}')
-                row_count = count_cursor.fetchone()[0]
+                # Get row count for each table (MAX(rowid) avoids a full scan)
+                row_count = None
+                if fast:
+                    try:
+                        row_count = conn.execute(f'SELECT MAX(rowid) FROM {table_name}').fetchone()[0] or 0
+                    except sqlite3.OperationalError:
+                        pass  # WITHOUT ROWID table
+                if row_count is None:
+                    row_count = conn.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
                 
                 tables.append({
                     'name': table_name,
@@ -125,44 +274,52 @@ def get_database_info(db_path: str) -> Dict[str, Any]:
             # Get database version/user_version
             cursor = conn.execute('PRAGMA user_version')
             info['version'] = cursor.fetchone()[0]
+        
+        if fast:
+            _INFO_CACHE[db_path] = (time.monotonic() + STATS_CACHE_DURATION_MINUTES * 60, info)
             
         return info
         
     except Exception as e:
-        logging.error(f"Failed to get database info for {db_path}: {e}")
+        logger.error("Failed to get database info for %s: %s", db_path, e)
         return {'path': db_path, 'error': str(e)}
 
 def migrate_database(db_path: str, migrations: List[str]) -> bool:
     """Run database migrations"""
     try:
-        with sqlite3.connect(db_path) as conn:
+        with acquire(db_path) as conn:
             # Get current version
             cursor = conn.execute('PRAGMA user_version')
             current_version = cursor.fetchone()[0]
             
-            # Run migrations starting from current version
-            for i, migration_sql in enumerate(migrations[current_version:], current_version):
-                logging.info(f"Running migration {i + 1} on {db_path}")
-                
-                try:
-                    conn.executescript(migration_sql)
-                    
-                    # Update version
-                    conn.execute(f'PRAGMA user_version = {i + 1}')
-                    conn.commit()
-                    
-                    logging.info(f"Migration {i + 1} completed successfully")
-                    
-                except Exception as e:
-                    logging.error(f"Migration {i + 1} failed: {e}")
+            pending = migrations[current_version:]
+            if not pending:
+                return True
+            
+            # All pending migrations and version bumps run as one script inside a
+            # single transaction: one commit, and a failure leaves the DB untouched
+            # (executescript would commit an open transaction, so BEGIN goes in the script)
+            script = ['BEGIN IMMEDIATE;']
+            for i, migration_sql in enumerate(pending, current_version):
+                script.append(migration_sql)
+                script.append(f';\nPRAGMA user_version = {i + 1};')
+            script.append('COMMIT;')
+            
+            logger.info("Running migrations %s-%s on %s", current_version + 1, len(migrations), db_path)
+            
+            try:
+                conn.executescript('\n'.join(script))
+            except Exception as e:
+                logger.error("Migrations %s-%s failed: %s", current_version + 1, len(migrations), e)
+                if conn.in_transaction:
                     conn.rollback()
-                    return False
+                return False
             
-            logging.info(f"All migrations completed for {db_path}")
+            logger.info("All migrations completed for %s", db_path)
             return True
             
     except Exception as e:
-        logging.error(f"Failed to migrate database {db_path}: {e}")
+        logger.error("Failed to migrate database %s: %s", db_path, e)
         return False
 
 def export_table_to_csv(db_path: str, table_name: str, output_path: str) -> bool:
@@ -170,129 +327,137 @@ def export_table_to_csv(db_path: str, table_name: str, output_path: str) -> bool
     try:
         import csv
         
-        with sqlite3.connect(db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.execute(f'SELECT * FROM {table_name}')
+        with acquire(db_path) as conn:
+            # Plain tuples stream straight into csv.writer
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.arraysize = 1000
+            cursor.execute(f'SELECT * FROM {table_name}')
             
-            rows = cursor.fetchall()
-            if not rows:
-                logging.warning(f"No data in table {table_name}")
-                return True
+            header = [column[0] for column in cursor.description]
             
             # Write CSV file
             with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
                 writer = csv.writer(csvfile)
+                writer.writerow(header)
                 
-                # Write header
-                writer.writerow(rows[0].keys())
-                
-                # Write data
-                for row in rows:
-                    writer.writerow([row[col] for col in row.keys()])
+                # Write data without materializing the whole table
+                writer.writerows(cursor)
             
-            logging.info(f"Exported {len(rows)} rows from {table_name} to {output_path}")
+            logger.info("Exported table %s to %s", table_name, output_path)
             return True
             
     except Exception as e:
-        logging.error(f"Failed to export table {table_name}: {e}")
+        logger.error("Failed to export table %s: %s", table_name, e)
         return False
 
 def cleanup_old_records(db_path: str, table_name: str, date_column: str, 
                        days_to_keep: int) -> int:
-    """Clean up old records from database"""
+    """Clean up old records from database
+    
+    date_column should be indexed by the schema (the user bot's init_database
+    indexes messages.sent_at, link_clicks.clicked_at and broadcasts.created_at)
+    so the DELETE is a range scan.
+    """
     try:
-        with sqlite3.connect(db_path) as conn:
-            # Count records to be deleted
-            cursor = conn.execute(f'''
-                SELECT COUNT(*) FROM {table_name} 
-                WHERE {date_column} < datetime('now', '-{days_to_keep} days')
-            ''')
-            
-            records_to_delete = cursor.fetchone()[0]
-            
-            if records_to_delete == 0:
-                return 0
-            
-            # Delete old records
-            cursor = conn.execute(f'''
-                DELETE FROM {table_name} 
-                WHERE {date_column} < datetime('now', '-{days_to_keep} days')
-            ''')
+        # Identifiers can't be bound as parameters, so validate them instead
+        for identifier in (table_name, date_column):
+            if not IDENTIFIER_PATTERN.match(identifier):
+                raise ValueError(f"Invalid SQL identifier: {identifier!r}")
+        
+        with acquire(db_path) as conn:
+            # Delete old records in a single pass
+            cursor = conn.execute(
+                f"DELETE FROM {table_name} WHERE {date_column} < datetime('now', ?)",
+                (f'-{int(days_to_keep)} days',)
+            )
+            records_deleted = cursor.rowcount
             
             conn.commit()
             
-            logging.info(f"Cleaned up {records_to_delete} old records from {table_name}")
-            return records_to_delete
+            if records_deleted:
+                logger.info("Cleaned up %s old records from %s", records_deleted, table_name)
+            return records_deleted
             
     except Exception as e:
-        logging.error(f"Failed to cleanup old records from {table_name}: {e}")
+        logger.error("Failed to cleanup old records from %s: %s", table_name, e)
         return 0
 
 @contextmanager
 def database_transaction(db_path: str):
     """Context manager for database transactions"""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    
-    try:
-        yield conn
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        logging.error(f"Database transaction error: {e}")
-        raise
-    finally:
-        conn.close()
+    with acquire(db_path) as conn:
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error("Database transaction error: %s", e)
+            raise
 
 def test_database_connection(db_path: str) -> bool:
-    """Test database connection"""
+    """Test database connection (result is reused for HEALTH_CHECK_TTL_SECONDS)"""
+    db_path = str(db_path)
+    cached = _HEALTH_CACHE.get(db_path)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
     try:
-        with sqlite3.connect(db_path, timeout=5) as conn:
+        with acquire(db_path) as conn:
             cursor = conn.execute('SELECT 1')
-            result = cursor.fetchone()
-            return result is not None
+            result = cursor.fetchone() is not None
             
     except Exception as e:
-        logging.error(f"Database connection test failed for {db_path}: {e}")
-        return False
+        logger.error("Database connection test failed for %s: %s", db_path, e)
+        result = False
+    
+    _HEALTH_CACHE[db_path] = (time.monotonic() + HEALTH_CHECK_TTL_SECONDS, result)
+    return result
 
 def create_indexes(db_path: str, indexes: Dict[str, str]) -> bool:
     """Create database indexes"""
     try:
-        with sqlite3.connect(db_path) as conn:
+        with acquire(db_path) as conn:
+            log_info = logger.isEnabledFor(logging.INFO)
             for index_name, index_sql in indexes.items():
                 try:
                     conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} {index_sql}')
-                    logging.info(f"Created index: {index_name}")
+                    if log_info:
+                        logger.info("Created index: %s", index_name)
                 except Exception as e:
-                    logging.warning(f"Failed to create index {index_name}: {e}")
+                    logger.warning("Failed to create index %s: %s", index_name, e)
             
             conn.commit()
             return True
             
     except Exception as e:
-        logging.error(f"Failed to create indexes: {e}")
+        logger.error("Failed to create indexes: %s", e)
         return False
 
+@lru_cache(maxsize=256)
+def _cached_schema(db_path: str, mtime: float, table_name: str) -> tuple:
+    """Read table schema (mtime is part of the cache key so edits invalidate it)"""
+    with acquire(db_path) as conn:
+        cursor = conn.execute(f'PRAGMA table_info({table_name})')
+        return tuple(
+            {
+                'cid': row[0],
+                'name': row[1],
+                'type': row[2],
+                'notnull': bool(row[3]),
+                'default_value': row[4],
+                'pk': bool(row[5])
+            }
+            for row in cursor.fetchall()
+        )
+
 def get_table_schema(db_path: str, table_name: str) -> Optional[List[Dict]]:
     """Get table schema information"""
     try:
-        with sqlite3.connect(db_path) as conn:
-            cursor = conn.execute(f'PRAGMA table_info({table_name})')
-            columns = []
-            
-            for row in cursor.fetchall():
-                columns.append({
-                    'cid': row[0],
-                    'name': row[1],
-                    'type': row[2],
-                    'notnull': bool(row[3]),
-                    'default_value': row[4],
-                    'pk': bool(row[5])
-                })
-            
-            return columns
+        db_path = str(db_path)
+        columns = _cached_schema(db_path, _db_mtime(db_path), table_name)
+        return [dict(column) for column in columns]
             
     except Exception as e:
-        logging.error(f"Failed to get schema for table {table_name}: {e}")
+        logger.error("Failed to get schema for table %s: %s", table_name, e)
         return None
@@ -2,9 +2,175 @@
 Telegram Utilities - вспомогательные функции для работы с Telegram API
 """
 
+import os
+import json
+import time
 import httpx
+import asyncio
 import logging
-from typing import Optional, Dict
+from functools import lru_cache
+from typing import Optional, Dict, List, Tuple
+
+from .constants import (
+    TELEGRAM_RATE_LIMIT_PER_SECOND,
+    TELEGRAM_RATE_LIMIT_PER_MINUTE,
+    BROADCAST_CONCURRENCY,
+    TELEGRAM_BOT_TOKEN_PATTERN,
+    DEFAULT_WELCOME_MESSAGE,
+    DEFAULT_FAREWELL_MESSAGE,
+    DEFAULT_AUTO_APPROVE_MESSAGE
+)
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson
+    
+    _loads = orjson.loads
+    
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    _loads = json.loads
+    
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+BASE_URL = "https://api.telegram.org"
+JSON_HEADERS = {'content-type': 'application/json'}
+
+# Default texts are sent often, keep them JSON-encoded once
+_DEFAULT_TEXTS_JSON = {
+    text: _dumps(text)
+    for text in (DEFAULT_WELCOME_MESSAGE, DEFAULT_FAREWELL_MESSAGE, DEFAULT_AUTO_APPROVE_MESSAGE)
+}
+
+def _encode_payload(payload: Dict) -> bytes:
+    """Serialize sendMessage payload, reusing pre-encoded default texts"""
+    text_json = _DEFAULT_TEXTS_JSON.get(payload['text'])
+    if text_json is None:
+        return _dumps(payload)
+    
+    rest = {key: value for key, value in payload.items() if key != 'text'}
+    return _dumps(rest)[:-1] + b',"text":' + text_json + b'}'
+
+# HTTP backend for sendMessage: 'httpx' (default) or 'aiohttp' (if installed)
+TELEGRAM_HTTP_CLIENT = os.environ.get('TELEGRAM_HTTP_CLIENT', 'httpx').lower()
+USE_AIOHTTP = TELEGRAM_HTTP_CLIENT == 'aiohttp' and aiohttp is not None
+
+# Shared client keeps TCP/TLS sessions to api.telegram.org alive between calls
+_client: Optional[httpx.AsyncClient] = None
+
+async def get_client() -> httpx.AsyncClient:
+    """Get shared HTTP client, creating it on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+            timeout=10.0
+        )
+    return _client
+
+_session = None
+
+async def get_session():
+    """Get shared aiohttp session, creating it on first use"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=200, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=10)
+        )
+    return _session
+
+async def close_client():
+    """Close shared HTTP clients (call on shutdown)"""
+    global _client, _session
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+async def _post_json(url: str, body: bytes) -> Tuple[int, Optional[str], Dict]:
+    """POST pre-serialized JSON, returns (status, Retry-After header, response data)"""
+    if USE_AIOHTTP:
+        session = await get_session()
+        async with session.post(url, data=body, headers=JSON_HEADERS) as response:
+            status, retry_after, raw = response.status, response.headers.get('Retry-After'), await response.read()
+    else:
+        client = await get_client()
+        response = await client.post(url, content=body, headers=JSON_HEADERS)
+        status, retry_after, raw = response.status_code, response.headers.get('Retry-After'), response.content
+    
+    try:
+        data = _loads(raw)
+    except ValueError:
+        data = {}
+    return status, retry_after, data
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens refilled every `per` seconds"""
+    
+    def __init__(self, rate: float, per: float):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self, n: int = 1):
+        """Wait until n tokens are available and take them"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate / self.per)
+                self.updated_at = now
+                
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                
+                await asyncio.sleep((n - self.tokens) * self.per / self.rate)
+
+# Global per-bot limit and per-group limit (groups have negative chat ids)
+_buckets: Dict[str, TokenBucket] = {}
+_group_buckets: Dict[Tuple[str, int], TokenBucket] = {}
+
+MAX_SEND_RETRIES = 3
+
+def get_bucket(token: str) -> TokenBucket:
+    """Get the process-wide rate limit bucket shared by every sender of this bot"""
+    bucket = _buckets.get(token)
+    if bucket is None:
+        bucket = _buckets[token] = TokenBucket(TELEGRAM_RATE_LIMIT_PER_SECOND, 1.0)
+    return bucket
+
+async def _wait_rate_limit(token: str, chat_id: int):
+    """Wait for rate limit tokens before sending to chat"""
+    await get_bucket(token).acquire()
+    
+    if isinstance(chat_id, int) and chat_id < 0:
+        key = (token, chat_id)
+        group_bucket = _group_buckets.get(key)
+        if group_bucket is None:
+            group_bucket = _group_buckets[key] = TokenBucket(TELEGRAM_RATE_LIMIT_PER_MINUTE, 60.0)
+        await group_bucket.acquire()
+
+def _method_url(token: str, method: str) -> str:
+    """Build Bot API method URL"""
+    return f"{BASE_URL}/bot{token}/{method}"
 
 async def verify_bot_token(token: str) -> Optional[Dict]:
     """
@@ -17,27 +183,25 @@ async def verify_bot_token(token: str) -> Optional[Dict]:
         Dict with bot info if valid, None if invalid
     """
     try:
-        url = f"https://api.telegram.org/bot{token}/getMe"
+        client = await get_client()
+        response = await client.get(_method_url(token, 'getMe'))
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, timeout=10.0)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('ok'):
-                    bot_info = data['result']
-                    return {
-                        'id': bot_info['id'],
-                        'username': bot_info['username'],
-                        'first_name': bot_info['first_name'],
-                        'is_bot': bot_info['is_bot']
-                    }
-                else:
-                    logging.warning(f"Bot API returned error: {data.get('description')}")
-                    return None
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('ok'):
+                bot_info = data['result']
+                return {
+                    'id': bot_info['id'],
+                    'username': bot_info['username'],
+                    'first_name': bot_info['first_name'],
+                    'is_bot': bot_info['is_bot']
+                }
             else:
-                logging.warning(f"HTTP error verifying token: {response.status_code}")
+                logging.warning(f"Bot API returned error: {data.get('description')}")
                 return None
+        else:
+            logging.warning(f"HTTP error verifying token: {response.status_code}")
+            return None
                 
     except httpx.TimeoutException:
         logging.error("Timeout verifying bot token")
@@ -61,8 +225,6 @@ async def send_telegram_message(token: str, chat_id: int, text: str,
         True if sent successfully, False otherwise
     """
     try:
-        url = f"https://api.telegram.org/bot{token}/sendMessage"
-        
         payload = {
             'chat_id': chat_id,
             'text': text
@@ -71,31 +233,77 @@ async def send_telegram_message(token: str, chat_id: int, text: str,
         if parse_mode:
             payload['parse_mode'] = parse_mode
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload, timeout=10.0)
+        url = _method_url(token, 'sendMessage')
+        body = _encode_payload(payload)
+        
+        for attempt in range(MAX_SEND_RETRIES):
+            await _wait_rate_limit(token, chat_id)
+            status, retry_after, data = await _post_json(url, body)
             
-            if response.status_code == 200:
-                data = response.json()
+            if status == 200:
                 return data.get('ok', False)
+            elif status == 429:
+                # Flood control: wait as long as Telegram asks, then retry
+                if retry_after is None:
+                    retry_after = data.get('parameters', {}).get('retry_after', 1)
+                if attempt == MAX_SEND_RETRIES - 1:
+                    logging.warning(f"Rate limited sending to {chat_id}, giving up")
+                    return False
+                logging.warning(f"Rate limited sending to {chat_id}, retry in {retry_after}s")
+                await asyncio.sleep(float(retry_after))
             else:
-                logging.warning(f"Failed to send message: {response.status_code}")
+                logging.warning(f"Failed to send message: {status}")
                 return False
+        
+        return False
                 
     except Exception as e:
         logging.error(f"Error sending telegram message: {e}")
         return False
 
+async def send_many(token: str, targets: List[int], text: str,
+                    parse_mode: str = None) -> Dict[int, bool]:
+    """
+    Send the same message to many chats concurrently within Telegram rate limits
+    
+    Args:
+        token: Bot token
+        targets: Chat IDs to send to
+        text: Message text
+        parse_mode: Parse mode (Markdown, HTML, etc.)
+        
+    Returns:
+        Dict of chat_id -> True if sent successfully
+    """
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    
+    async def _send_one(chat_id: int) -> bool:
+        # Rate limit tokens are taken inside send_telegram_message
+        async with semaphore:
+            return await send_telegram_message(token, chat_id, text, parse_mode)
+    
+    results = await asyncio.gather(*(_send_one(chat_id) for chat_id in targets), return_exceptions=True)
+    return {chat_id: result is True for chat_id, result in zip(targets, results)}
+
+MARKDOWN_CHARS = frozenset('*_`[')
+
+def markdown_parse_mode(text: str) -> Optional[str]:
+    """Return 'Markdown' only if text uses markup, plain text needs no parsing"""
+    if text and not MARKDOWN_CHARS.isdisjoint(text):
+        return 'Markdown'
+    return None
+
 def format_username(username: str) -> str:
     """Format username with @ prefix if not present"""
     if username and not username.startswith('@'):
         return f"@{username}"
     return username or ""
 
+@lru_cache(maxsize=1024)
 def extract_bot_username(token: str) -> Optional[str]:
     """Extract bot username from token (basic validation)"""
-    try:
-        # Token format: bot_id:auth_token
-        bot_id = token.split(':')[0]
-        return f"bot{bot_id}"  # Approximate username
-    except:
+    # Token format: bot_id:auth_token
+    if not token or not TELEGRAM_BOT_TOKEN_PATTERN.match(token):
         return None
+    bot_id, _, _ = token.partition(':')
+    return f"bot{bot_id}"  # Approximate username
@@ -2,129 +2,61 @@
 Admin Panel - интерфейс управления для владельца бота
 """
 
+import time
 import logging
 from typing import Dict, List
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-class AdminPanel:
-    def __init__(self, db, config):
-        self.db = db
-        self.config = config
-        self.admin_chat_id = config['ADMIN_CHAT_ID']
-    
-    def is_admin(self, user_id: int) -> bool:
-        """Check if user is bot admin"""
-        return user_id == self.admin_chat_id
-    
-    def get_main_menu_markup(self) -> InlineKeyboardMarkup:
-        """Get main admin menu keyboard"""
-        keyboard = [
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
-            [InlineKeyboardButton("✉️ Управление рассылкой", callback_data="admin_broadcast")],
-            [InlineKeyboardButton("👥 Управление пользователями", callback_data="admin_users")],
-            [InlineKeyboardButton("⚙️ Настройки бота", callback_data="admin_settings")],
-            [InlineKeyboardButton("📢 Отправить всем", callback_data="admin_mass_send")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="admin_help")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
-    
-    def get_main_menu_message(self) -> str:
-        """Get main admin menu message"""
-        stats = self.db.get_dashboard_stats()
-        
-        message = f"""
+USER_ROW_TEMPLATE = """
+**{n}.** {name} ({username})
+    📅 Присоединился: {joined}
+    🕐 Последняя активность: {activity}
+    🤖 Статус: {status}
+"""
+
+MAIN_MENU_TEMPLATE = """
 🔧 **Админ-панель твоего бота**
 
 📊 **Быстрая статистика:**
-• Подписчиков канала: {stats['total_subscribers']}
-• Активных пользователей: {stats['active_users']}
-• Отправлено сообщений: {stats['messages_sent']}
-• Переходов по ссылкам: {stats['link_clicks']}
+• Подписчиков канала: {total_subscribers}
+• Активных пользователей: {active_users}
+• Отправлено сообщений: {messages_sent}
+• Переходов по ссылкам: {link_clicks}
 
 ⚙️ **Управление:**
 Выберите действие из меню ниже
 """
-        return message
-    
-    def get_stats_message(self) -> str:
-        """Get detailed statistics message"""
-        stats = self.db.get_dashboard_stats()
-        message_stats = self.db.get_message_stats(30)
-        click_stats = self.db.get_click_stats(30)
-        
-        message = f"""
+
+STATS_TEMPLATE = """
 📊 **Подробная статистика**
 
 **👥 Пользователи:**
-• Всего подписчиков: {stats['total_subscribers']}
-• Активных (7 дней): {stats['active_users']}
-• Взаимодействовали с ботом: {stats['bot_interactions']}
+• Всего подписчиков: {total_subscribers}
+• Активных (7 дней): {active_users}
+• Взаимодействовали с ботом: {bot_interactions}
 
 **📬 Сообщения (30 дней):**
-• Всего отправлено: {message_stats['total_messages']}
-• Уникальных получателей: {message_stats['unique_recipients']}
-• Рассылок создано: {stats['recent_broadcasts']}
+• Всего отправлено: {total_messages}
+• Уникальных получателей: {unique_recipients}
+• Рассылок создано: {recent_broadcasts}
 
 **🔗 Переходы по ссылкам (30 дней):**
-• Всего кликов: {click_stats['total_clicks']}
-• Уникальных пользователей: {click_stats['unique_clickers']}
-• Уникальных ссылок: {click_stats['unique_urls']}
+• Всего кликов: {total_clicks}
+• Уникальных пользователей: {unique_clickers}
+• Уникальных ссылок: {unique_urls}
 
 **📈 Эффективность:**
-• CTR (клики/сообщения): {(click_stats['total_clicks'] / max(message_stats['total_messages'], 1) * 100):.1f}%
-• Вовлеченность: {(stats['active_users'] / max(stats['total_subscribers'], 1) * 100):.1f}%
+• CTR (клики/сообщения): {ctr:.1f}%
+• Вовлеченность: {engagement:.1f}%
 """
-        
-        return message
-    
-    def get_stats_keyboard(self) -> InlineKeyboardMarkup:
-        """Get statistics keyboard"""
-        keyboard = [
-            [InlineKeyboardButton("📈 Экспорт данных", callback_data="admin_export")],
-            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_stats")],
-            [InlineKeyboardButton("🔙 Главное меню", callback_data="admin_main")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
-    
-    def get_broadcast_menu_message(self) -> str:
-        """Get broadcast management message"""
-        return """
-✉️ **Управление рассылками**
-
-**Доступные действия:**
-• Создать новую рассылку
-• Посмотреть историю рассылок
-• Настроить автоматические сообщения
-
-**Типы рассылок:**
-📢 **Обычная рассылка** - отправка всем подписчикам
-👋 **Приветственное сообщение** - для новых участников
-👥 **Целевая рассылка** - для определенной группы
 
-Выберите действие:
-"""
-    
-    def get_broadcast_keyboard(self) -> InlineKeyboardMarkup:
-        """Get broadcast management keyboard"""
-        keyboard = [
-            [InlineKeyboardButton("📢 Создать рассылку", callback_data="broadcast_create")],
-            [InlineKeyboardButton("📋 История рассылок", callback_data="broadcast_history")],
-            [InlineKeyboardButton("👋 Приветственное сообщение", callback_data="broadcast_welcome")],
-            [InlineKeyboardButton("🔙 Главное меню", callback_data="admin_main")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
-    
-    def get_users_menu_message(self) -> str:
-        """Get user management message"""
-        stats = self.db.get_dashboard_stats()
-        
-        return f"""
+USERS_MENU_TEMPLATE = """
 👥 **Управление пользователями**
 
 **Текущие показатели:**
-• Всего пользователей: {stats['total_subscribers']}
-• Активных за неделю: {stats['active_users']}
-• Взаимодействовали с ботом: {stats['bot_interactions']}
+• Всего пользователей: {total_subscribers}
+• Активных за неделю: {active_users}
+• Взаимодействовали с ботом: {bot_interactions}
 
 **Доступные действия:**
 • Просмотр списка пользователей
@@ -134,50 +66,85 @@ class AdminPanel:
 
 Что хотите сделать?
 """
-    
-    def get_users_keyboard(self) -> InlineKeyboardMarkup:
-        """Get user management keyboard"""
-        keyboard = [
-            [InlineKeyboardButton("📋 Список пользователей", callback_data="users_list")],
-            [InlineKeyboardButton("📊 Статистика активности", callback_data="users_activity")],
-            [InlineKeyboardButton("📤 Экспорт данных", callback_data="users_export")],
-            [InlineKeyboardButton("🔙 Главное меню", callback_data="admin_main")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
-    
-    def get_settings_menu_message(self) -> str:
-        """Get settings menu message"""
-        welcome_msg = self.db.get_setting('welcome_message', 'Не настроено')
-        auto_approve = self.db.get_setting('auto_approve', 'true')
-        
-        return f"""
+
+SETTINGS_MENU_TEMPLATE = """
 ⚙️ **Настройки бота**
 
 **Текущие настройки:**
-• Автоодобрение заявок: {'✅ Включено' if auto_approve == 'true' else '❌ Выключено'}
-• Приветственное сообщение: {'✅ Настроено' if welcome_msg != 'Не настроено' else '❌ Не настроено'}
-• UTM трекинг: {'✅ Включен' if self.config.get('UTM_TRACKING_ENABLED') else '❌ Выключен'}
+• Автоодобрение заявок: {auto_approve}
+• Приветственное сообщение: {welcome}
+• UTM трекинг: {utm}
 
-**ID канала:** {self.config.get('CHANNEL_ID', 'Не настроен')}
-**Имя бота:** @{self.config.get('BOT_USERNAME')}
+**ID канала:** {channel_id}
+**Имя бота:** @{bot_username}
 
 Что хотите изменить?
 """
-    
-    def get_settings_keyboard(self) -> InlineKeyboardMarkup:
-        """Get settings keyboard"""
-        keyboard = [
+
+# How long stats are reused between admin screen renders
+STATS_CACHE_TTL_SECONDS = 5
+
+class AdminPanel:
+    def __init__(self, db, config):
+        self.db = db
+        self.config = config
+        self.admin_chat_id = config['ADMIN_CHAT_ID']
+        self._stats_cache = {}  # key -> (timestamp, value)
+        
+        # Static keyboards and messages never change, build them once
+        self._main_menu_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+            [InlineKeyboardButton("✉️ Управление рассылкой", callback_data="admin_broadcast")],
+            [InlineKeyboardButton("👥 Управление пользователями", callback_data="admin_users")],
+            [InlineKeyboardButton("⚙️ Настройки бота", callback_data="admin_settings")],
+            [InlineKeyboardButton("📢 Отправить всем", callback_data="admin_mass_send")],
+            [InlineKeyboardButton("❓ Помощь", callback_data="admin_help")]
+        ])
+        self._stats_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📈 Экспорт данных", callback_data="admin_export")],
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_stats")],
+            [InlineKeyboardButton("🔙 Главное меню", callback_data="admin_main")]
+        ])
+        self._broadcast_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📢 Создать рассылку", callback_data="broadcast_create")],
+            [InlineKeyboardButton("📋 История рассылок", callback_data="broadcast_history")],
+            [InlineKeyboardButton("👋 Приветственное сообщение", callback_data="broadcast_welcome")],
+            [InlineKeyboardButton("🔙 Главное меню", callback_data="admin_main")]
+        ])
+        self._users_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📋 Список пользователей", callback_data="users_list")],
+            [InlineKeyboardButton("📊 Статистика активности", callback_data="users_activity")],
+            [InlineKeyboardButton("📤 Экспорт данных", callback_data="users_export")],
+            [InlineKeyboardButton("🔙 Главное меню", callback_data="admin_main")]
+        ])
+        self._settings_keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("🔄 Автоодобрение заявок", callback_data="settings_auto_approve")],
             [InlineKeyboardButton("👋 Приветственное сообщение", callback_data="settings_welcome")],
             [InlineKeyboardButton("🔗 Настройка канала", callback_data="settings_channel")],
             [InlineKeyboardButton("📊 UTM трекинг", callback_data="settings_utm")],
             [InlineKeyboardButton("🔙 Главное меню", callback_data="admin_main")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
-    
-    def get_help_message(self) -> str:
-        """Get help message"""
-        return f"""
+        ])
+        self._help_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("💬 Связаться с поддержкой", url="https://t.me/BotFactorySupport")],
+            [InlineKeyboardButton("📖 Полная документация", callback_data="help_docs")],
+            [InlineKeyboardButton("🔙 Главное меню", callback_data="admin_main")]
+        ])
+        self._broadcast_menu_message = """
+✉️ **Управление рассылками**
+
+**Доступные действия:**
+• Создать новую рассылку
+• Посмотреть историю рассылок
+• Настроить автоматические сообщения
+
+**Типы рассылок:**
+📢 **Обычная рассылка** - отправка всем подписчикам
+👋 **Приветственное сообщение** - для новых участников
+👥 **Целевая рассылка** - для определенной группы
+
+Выберите действие:
+"""
+        self._help_message = """
 ❓ **Помощь по использованию бота**
 
 **🚀 Быстрый старт:**
@@ -216,40 +183,107 @@ class AdminPanel:
 **Бот создан через Bot Factory** 🤖
 """
     
+    def is_admin(self, user_id: int) -> bool:
+        """Check if user is bot admin"""
+        return user_id == self.admin_chat_id
+    
+    def _cached(self, key: str, loader, ttl: float = STATS_CACHE_TTL_SECONDS):
+        """Return loader() result, reusing it for ttl seconds"""
+        now = time.monotonic()
+        cached = self._stats_cache.get(key)
+        if cached and now - cached[0] < ttl:
+            return cached[1]
+        
+        value = loader()
+        self._stats_cache[key] = (now, value)
+        return value
+    
+    def get_main_menu_markup(self) -> InlineKeyboardMarkup:
+        """Get main admin menu keyboard"""
+        return self._main_menu_markup
+    
+    def get_main_menu_message(self) -> str:
+        """Get main admin menu message"""
+        stats = self.db.get_dashboard_stats()
+        
+        return MAIN_MENU_TEMPLATE.format_map(stats)
+    
+    def get_stats_message(self) -> str:
+        """Get detailed statistics message"""
+        stats = self.db.get_dashboard_stats()
+        message_stats = self._cached('message_stats', lambda: self.db.get_message_stats(30))
+        click_stats = self._cached('click_stats', lambda: self.db.get_click_stats(30))
+        
+        return STATS_TEMPLATE.format(**stats, **message_stats, **click_stats)
+    
+    def get_stats_keyboard(self) -> InlineKeyboardMarkup:
+        """Get statistics keyboard"""
+        return self._stats_keyboard
+    
+    def get_broadcast_menu_message(self) -> str:
+        """Get broadcast management message"""
+        return self._broadcast_menu_message
+    
+    def get_broadcast_keyboard(self) -> InlineKeyboardMarkup:
+        """Get broadcast management keyboard"""
+        return self._broadcast_keyboard
+    
+    def get_users_menu_message(self) -> str:
+        """Get user management message"""
+        stats = self.db.get_dashboard_stats()
+        
+        return USERS_MENU_TEMPLATE.format_map(stats)
+    
+    def get_users_keyboard(self) -> InlineKeyboardMarkup:
+        """Get user management keyboard"""
+        return self._users_keyboard
+    
+    def get_settings_menu_message(self) -> str:
+        """Get settings menu message"""
+        welcome_msg = self.db.get_setting('welcome_message', 'Не настроено')
+        auto_approve = self.db.get_setting('auto_approve', 'true')
+        
+        return SETTINGS_MENU_TEMPLATE.format(
+            auto_approve='✅ Включено' if auto_approve == 'true' else '❌ Выключено',
+            welcome='✅ Настроено' if welcome_msg != 'Не настроено' else '❌ Не настроено',
+            utm='✅ Включен' if self.config.get('UTM_TRACKING_ENABLED') else '❌ Выключен',
+            channel_id=self.config.get('CHANNEL_ID', 'Не настроен'),
+            bot_username=self.config.get('BOT_USERNAME')
+        )
+    
+    def get_settings_keyboard(self) -> InlineKeyboardMarkup:
+        """Get settings keyboard"""
+        return self._settings_keyboard
+    
+    def get_help_message(self) -> str:
+        """Get help message"""
+        return self._help_message
+    
     def get_help_keyboard(self) -> InlineKeyboardMarkup:
         """Get help keyboard"""
-        keyboard = [
-            [InlineKeyboardButton("💬 Связаться с поддержкой", url="https://t.me/BotFactorySupport")],
-            [InlineKeyboardButton("📖 Полная документация", callback_data="help_docs")],
-            [InlineKeyboardButton("🔙 Главное меню", callback_data="admin_main")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return self._help_keyboard
     
-    def format_user_list(self, users: List[Dict], page: int = 0, per_page: int = 10) -> str:
-        """Format user list for display"""
+    def format_user_list(self, page_users: List[Dict], total_count: int,
+                         page: int = 0, per_page: int = 10) -> str:
+        """Format one page of users for display"""
         start = page * per_page
-        end = start + per_page
-        page_users = users[start:end]
-        
-        message = f"👥 **Пользователи канала** (стр. {page + 1})\n\n"
+        end = start + len(page_users)
         
-        for i, user in enumerate(page_users, 1):
-            username = f"@{user['username']}" if user['username'] else "Без username"
-            name = user['first_name'] or "Без имени"
-            joined = user['joined_at'][:16] if user['joined_at'] else "Неизвестно"
-            activity = user['last_activity'][:16] if user['last_activity'] else "Никогда"
-            
-            message += f"""
-**{start + i}.** {name} ({username})
-    📅 Присоединился: {joined}
-    🕐 Последняя активность: {activity}
-    🤖 Статус: {'✅ Активен' if user['is_active'] else '❌ Неактивен'}
-"""
+        rows = ''.join(
+            USER_ROW_TEMPLATE.format(
+                n=start + i,
+                name=user['first_name'] or "Без имени",
+                username=f"@{user['username']}" if user['username'] else "Без username",
+                joined=user['joined_at'][:16] if user['joined_at'] else "Неизвестно",
+                activity=user['last_activity'][:16] if user['last_activity'] else "Никогда",
+                status='✅ Активен' if user['is_active'] else '❌ Неактивен'
+            )
+            for i, user in enumerate(page_users, 1)
+        )
         
-        if len(users) > end:
-            message += f"\n... и еще {len(users) - end} пользователей"
+        footer = f"\n... и еще {total_count - end} пользователей" if total_count > end else ""
         
-        return message
+        return f"👥 **Пользователи канала** (стр. {page + 1})\n\n{rows}{footer}"
     
     def get_pagination_keyboard(self, current_page: int, total_pages: int, 
                                callback_prefix: str) -> InlineKeyboardMarkup:
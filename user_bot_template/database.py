@@ -2,15 +2,36 @@
 User Bot Database - изолированная база данных для каждого пользовательского бота
 """
 
+import json
+import time
 import sqlite3
 import logging
+import threading
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple, Iterator
 from contextlib import contextmanager
 
+# Buffered last_activity updates are written after this many events or seconds
+ACTIVITY_FLUSH_EVERY = 50
+ACTIVITY_FLUSH_SECONDS = 5
+
+# Dashboard stats are served from stats_cache for this long
+DASHBOARD_CACHE_MINUTES = 1
+
+# Settings are re-read after this long so edits from other processes show up
+SETTINGS_CACHE_SECONDS = 60
+
 class Database:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self._lock = threading.RLock()
+        self._pending_activity: Dict[int, str] = {}
+        self._last_activity_flush = time.monotonic()
+        # Settings and metadata rarely change, keep them in memory after first read
+        self._settings_cache: Optional[Dict[str, str]] = None
+        self._settings_loaded_at = 0.0
+        self._metadata_cache: Optional[Dict[str, str]] = None
+        self._conn = self._connect()
         self.init_database()
         logging.info(f"User bot database initialized: {db_path}")
     
@@ -109,40 +130,135 @@ class Database:
                 )
             ''')
             
+            # Indexes for time-range filters in stats queries
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages(sent_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_sent ON messages(user_id, sent_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_type_sent ON messages(message_type, sent_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_clicks_clicked_at ON link_clicks(clicked_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_broadcasts_created_at ON broadcasts(created_at)')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity) 
+                WHERE is_active = 1
+            ''')
+            
+            # Partial indexes turn active / bot_started counts into index-only scans
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_users_active ON users(user_id) WHERE is_active = 1')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_users_bot_started ON users(user_id) WHERE bot_started = 1')
+            
+            # Channel stats count recent activity of all users, active or not
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_users_activity ON users(last_activity)')
+            
+            # Admin user list pages are ordered by join date
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_users_active_joined ON users(joined_at) WHERE is_active = 1')
+            
+            # Denormalized user counters, kept up to date by triggers
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('''
+                INSERT OR IGNORE INTO counters (name, value)
+                SELECT 'active_users', COUNT(*) FROM users WHERE is_active = 1
+            ''')
+            conn.execute('''
+                INSERT OR IGNORE INTO counters (name, value)
+                SELECT 'bot_started_users', COUNT(*) FROM users WHERE bot_started = 1
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS users_counters_insert AFTER INSERT ON users
+                BEGIN
+                    UPDATE counters SET value = value + (NEW.is_active IS 1) WHERE name = 'active_users';
+                    UPDATE counters SET value = value + (NEW.bot_started IS 1) WHERE name = 'bot_started_users';
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS users_counters_delete AFTER DELETE ON users
+                BEGIN
+                    UPDATE counters SET value = value - (OLD.is_active IS 1) WHERE name = 'active_users';
+                    UPDATE counters SET value = value - (OLD.bot_started IS 1) WHERE name = 'bot_started_users';
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS users_counters_update AFTER UPDATE OF is_active, bot_started ON users
+                BEGIN
+                    UPDATE counters SET value = value + (NEW.is_active IS 1) - (OLD.is_active IS 1) 
+                    WHERE name = 'active_users';
+                    UPDATE counters SET value = value + (NEW.bot_started IS 1) - (OLD.bot_started IS 1) 
+                    WHERE name = 'bot_started_users';
+                END
+            ''')
+            
             conn.commit()
     
+    def _connect(self) -> sqlite3.Connection:
+        """Open the persistent connection used by all methods"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row  # Enable dict-like access
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-20000')
+        # Rows replaced by INSERT OR REPLACE must fire the counter DELETE trigger
+        conn.execute('PRAGMA recursive_triggers=ON')
+        return conn
+    
     @contextmanager
     def get_connection(self):
-        """Context manager for database connections"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row  # Enable dict-like access
-        try:
-            yield conn
-        except Exception as e:
-            conn.rollback()
-            logging.error(f"Database error: {e}")
-            raise
-        finally:
-            conn.close()
+        """Context manager for the shared database connection"""
+        with self._lock:
+            try:
+                yield self._conn
+            except Exception as e:
+                self._conn.rollback()
+                logging.error(f"Database error: {e}")
+                raise
+    
+    def close(self):
+        """Close database connection"""
+        with self._lock:
+            self.flush_activity()
+            self._conn.close()
     
     # User management
     def add_user(self, user_id: int, username: str = None, first_name: str = None, 
                  last_name: str = None, utm_source: str = None, utm_campaign: str = None):
         """Add new user to database"""
+        self.add_users_bulk([(user_id, username, first_name, last_name, utm_source, utm_campaign)])
+    
+    def add_users_bulk(self, rows: List[tuple]):
+        """Add many users in one transaction
+        
+        rows: (user_id, username, first_name, last_name, utm_source, utm_campaign) tuples
+        """
+        if not rows:
+            return
+        
         with self.get_connection() as conn:
-            conn.execute('''
-                INSERT OR REPLACE INTO users 
+            # Upsert keeps joined_at and bot_started of existing users, returning users become active again
+            conn.executemany('''
+                INSERT INTO users 
                 (user_id, username, first_name, last_name, utm_source, utm_campaign, last_activity)
                 VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, username, first_name, last_name, utm_source, utm_campaign))
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    utm_source = COALESCE(excluded.utm_source, utm_source),
+                    utm_campaign = COALESCE(excluded.utm_campaign, utm_campaign),
+                    is_active = 1,
+                    last_activity = CURRENT_TIMESTAMP
+            ''', rows)
+            self._invalidate_dashboard(conn)
             conn.commit()
     
-    def get_user(self, user_id: int) -> Optional[Dict]:
-        """Get user by ID"""
+    def get_user(self, user_id: int) -> Optional[sqlite3.Row]:
+        """Get user by ID (Row supports key access like a dict)"""
+        self.flush_activity()
         with self.get_connection() as conn:
             cursor = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            return cursor.fetchone()
     
     def update_user_activity(self, user_id: int):
         """Update user last activity"""
@@ -152,6 +268,30 @@ class Database:
             ''', (user_id,))
             conn.commit()
     
+    def queue_activity(self, user_id: int, auto_flush: bool = True):
+        """Record user activity in memory, writing it in batches
+        
+        auto_flush=False leaves writing to a caller that flushes on its own schedule
+        """
+        with self._lock:
+            self._pending_activity[user_id] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+            
+            if auto_flush and (len(self._pending_activity) >= ACTIVITY_FLUSH_EVERY or
+                    time.monotonic() - self._last_activity_flush >= ACTIVITY_FLUSH_SECONDS):
+                self.flush_activity()
+    
+    def flush_activity(self):
+        """Write buffered activity timestamps in one transaction"""
+        with self.get_connection() as conn:
+            self._last_activity_flush = time.monotonic()
+            if not self._pending_activity:
+                return
+            
+            pairs = [(ts, user_id) for user_id, ts in self._pending_activity.items()]
+            self._pending_activity.clear()
+            conn.executemany('UPDATE users SET last_activity = ? WHERE user_id = ?', pairs)
+            conn.commit()
+    
     def set_user_bot_started(self, user_id: int):
         """Mark user as having started the bot"""
         with self.get_connection() as conn:
@@ -159,20 +299,78 @@ class Database:
                 UPDATE users SET bot_started = 1, last_activity = CURRENT_TIMESTAMP 
                 WHERE user_id = ?
             ''', (user_id,))
+            self._invalidate_dashboard(conn)
             conn.commit()
     
-    def get_active_users(self) -> List[Dict]:
+    def mark_inactive(self, user_id: int) -> bool:
+        """Mark user as inactive, return False if user is unknown"""
+        with self.get_connection() as conn:
+            self._pending_activity.pop(user_id, None)
+            cursor = conn.execute('''
+                UPDATE users SET is_active = 0, last_activity = CURRENT_TIMESTAMP 
+                WHERE user_id = ?
+            ''', (user_id,))
+            self._invalidate_dashboard(conn)
+            conn.commit()
+            return cursor.rowcount > 0
+    
+    def get_active_users(self) -> List[sqlite3.Row]:
         """Get all active users"""
+        self.flush_activity()
         with self.get_connection() as conn:
             cursor = conn.execute('''
                 SELECT * FROM users WHERE is_active = 1 ORDER BY joined_at DESC
             ''')
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
+    
+    def iter_active_users(self, chunk_size: int = 1000) -> Iterator[sqlite3.Row]:
+        """Iterate active users in chunks without loading all of them, newest first
+        
+        Same order as get_active_users, so a capped broadcast still reaches
+        the most recent subscribers.
+        """
+        self.flush_activity()
+        last_key = None  # (joined_at, user_id) of the last row seen
+        
+        while True:
+            # Keyset pagination: short queries, no cursor held open between chunks
+            with self.get_connection() as conn:
+                if last_key is None:
+                    cursor = conn.execute('''
+                        SELECT * FROM users WHERE is_active = 1
+                        ORDER BY joined_at DESC, user_id DESC LIMIT ?
+                    ''', (chunk_size,))
+                else:
+                    cursor = conn.execute('''
+                        SELECT * FROM users 
+                        WHERE is_active = 1 AND (joined_at, user_id) < (?, ?)
+                        ORDER BY joined_at DESC, user_id DESC LIMIT ?
+                    ''', (*last_key, chunk_size))
+                rows = cursor.fetchall()
+            
+            if not rows:
+                return
+            
+            yield from rows
+            last_key = (rows[-1]['joined_at'], rows[-1]['user_id'])
+    
+    def get_users_page(self, offset: int, limit: int) -> Tuple[List[sqlite3.Row], int]:
+        """Get one page of active users and total active user count"""
+        self.flush_activity()
+        with self.get_connection() as conn:
+            cursor = conn.execute('''
+                SELECT * FROM users WHERE is_active = 1 
+                ORDER BY joined_at DESC LIMIT ? OFFSET ?
+            ''', (limit, offset))
+            rows = cursor.fetchall()
+            
+            total_count = conn.execute("SELECT value FROM counters WHERE name = 'active_users'").fetchone()[0]
+            return rows, total_count
     
     def get_user_count(self) -> int:
         """Get total user count"""
         with self.get_connection() as conn:
-            cursor = conn.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
+            cursor = conn.execute("SELECT value FROM counters WHERE name = 'active_users'")
             return cursor.fetchone()[0]
     
     # Message tracking
@@ -186,34 +384,44 @@ class Database:
             ''', (user_id, message_type, content, utm_source, utm_campaign))
             conn.commit()
     
+    def log_messages_bulk(self, rows: List[tuple]):
+        """Log many sent messages in one transaction
+        
+        rows: (user_id, message_type, content, utm_source, utm_campaign) tuples
+        """
+        if not rows:
+            return
+        
+        with self.get_connection() as conn:
+            conn.executemany('''
+                INSERT INTO messages (user_id, message_type, content, utm_source, utm_campaign)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+    
     def get_message_stats(self, days: int = 30) -> Dict:
         """Get message statistics"""
+        since = f'-{int(days)} days'
+        
         with self.get_connection() as conn:
+            # Distinct recipients come from a scalar subquery in the same statement
+            # (SQLite has no COUNT(DISTINCT) window function)
             cursor = conn.execute('''
                 SELECT 
-                    COUNT(*) as total_messages,
-                    COUNT(DISTINCT user_id) as unique_recipients,
                     message_type,
-                    COUNT(*) as count
+                    COUNT(*) as count,
+                    (SELECT COUNT(DISTINCT user_id) FROM messages 
+                     WHERE sent_at > datetime('now', ?)) as unique_recipients
                 FROM messages 
-                WHERE sent_at > datetime('now', '-{} days')
+                WHERE sent_at > datetime('now', ?)
                 GROUP BY message_type
-            '''.format(days))
+            ''', (since, since))
             
             stats = {'total_messages': 0, 'unique_recipients': 0, 'by_type': {}}
             for row in cursor.fetchall():
                 stats['by_type'][row['message_type']] = row['count']
                 stats['total_messages'] += row['count']
-            
-            # Get unique recipients
-            cursor = conn.execute('''
-                SELECT COUNT(DISTINCT user_id) as unique_recipients
-                FROM messages 
-                WHERE sent_at > datetime('now', '-{} days')
-            '''.format(days))
-            
-            result = cursor.fetchone()
-            stats['unique_recipients'] = result['unique_recipients'] if result else 0
+                stats['unique_recipients'] = row['unique_recipients']
             
             return stats
     
@@ -238,8 +446,8 @@ class Database:
                     COUNT(DISTINCT user_id) as unique_clickers,
                     COUNT(DISTINCT original_url) as unique_urls
                 FROM link_clicks 
-                WHERE clicked_at > datetime('now', '-{} days')
-            '''.format(days))
+                WHERE clicked_at > datetime('now', ?)
+            ''', (f'-{int(days)} days',))
             
             row = cursor.fetchone()
             return {
@@ -260,26 +468,32 @@ class Database:
             conn.commit()
             return cursor.lastrowid
     
-    def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
+    def get_broadcast(self, broadcast_id: int) -> Optional[sqlite3.Row]:
         """Get broadcast by ID"""
         with self.get_connection() as conn:
             cursor = conn.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            return cursor.fetchone()
     
     def update_broadcast_stats(self, broadcast_id: int, total_recipients: int,
-                              successful_sends: int, failed_sends: int):
+                              successful_sends: int, failed_sends: int, status: str = 'sent'):
         """Update broadcast statistics"""
         with self.get_connection() as conn:
             conn.execute('''
                 UPDATE broadcasts 
                 SET total_recipients = ?, successful_sends = ?, failed_sends = ?,
-                    sent_at = CURRENT_TIMESTAMP, status = 'sent'
+                    sent_at = CURRENT_TIMESTAMP, status = ?
                 WHERE id = ?
-            ''', (total_recipients, successful_sends, failed_sends, broadcast_id))
+            ''', (total_recipients, successful_sends, failed_sends, status, broadcast_id))
+            self._invalidate_dashboard(conn)
             conn.commit()
     
     # Settings management
+    def _load_key_values(self, table: str) -> Dict[str, str]:
+        """Load whole key/value table into memory"""
+        with self.get_connection() as conn:
+            cursor = conn.execute(f'SELECT key, value FROM {table}')
+            return {row['key']: row['value'] for row in cursor.fetchall()}
+    
     def set_setting(self, key: str, value: str):
         """Set channel setting"""
         with self.get_connection() as conn:
@@ -288,13 +502,17 @@ class Database:
                 VALUES (?, ?, CURRENT_TIMESTAMP)
             ''', (key, value))
             conn.commit()
+            
+            if self._settings_cache is not None:
+                self._settings_cache[key] = value
     
     def get_setting(self, key: str, default: str = None) -> str:
         """Get channel setting"""
-        with self.get_connection() as conn:
-            cursor = conn.execute('SELECT value FROM channel_settings WHERE key = ?', (key,))
-            row = cursor.fetchone()
-            return row['value'] if row else default
+        now = time.monotonic()
+        if self._settings_cache is None or now - self._settings_loaded_at > SETTINGS_CACHE_SECONDS:
+            self._settings_cache = self._load_key_values('channel_settings')
+            self._settings_loaded_at = now
+        return self._settings_cache.get(key, default)
     
     # Metadata management
     def set_metadata(self, key: str, value: str):
@@ -305,57 +523,70 @@ class Database:
                 VALUES (?, ?, CURRENT_TIMESTAMP)
             ''', (key, value))
             conn.commit()
+            
+            if self._metadata_cache is not None:
+                self._metadata_cache[key] = value
     
     def get_metadata(self, key: str, default: str = None) -> str:
         """Get bot metadata"""
-        with self.get_connection() as conn:
-            cursor = conn.execute('SELECT value FROM bot_metadata WHERE key = ?', (key,))
-            row = cursor.fetchone()
-            return row['value'] if row else default
+        if self._metadata_cache is None:
+            self._metadata_cache = self._load_key_values('bot_metadata')
+        return self._metadata_cache.get(key, default)
     
     # Dashboard statistics
     def get_dashboard_stats(self) -> Dict[str, Any]:
         """Get comprehensive dashboard statistics"""
-        stats = {}
+        cached = self.get_cached_stat('dashboard', DASHBOARD_CACHE_MINUTES)
+        if cached:
+            return json.loads(cached)
+        
+        stats = self._calculate_dashboard_stats()
+        self.cache_stat('dashboard', json.dumps(stats))
+        return stats
+    
+    def _invalidate_dashboard(self, conn):
+        """Drop cached dashboard stats (call inside the writing transaction)
         
+        Only for writes that move the subscriber counters (users joining or leaving,
+        broadcasts); message and click totals are left to DASHBOARD_CACHE_MINUTES.
+        """
+        conn.execute("DELETE FROM stats_cache WHERE metric_name = 'dashboard'")
+    
+    def _calculate_dashboard_stats(self) -> Dict[str, Any]:
+        """Calculate dashboard statistics from tables"""
+        self.flush_activity()
         with self.get_connection() as conn:
-            # Total subscribers
-            cursor = conn.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
-            stats['total_subscribers'] = cursor.fetchone()[0]
-            
-            # Active users (last 7 days)
             cursor = conn.execute('''
-                SELECT COUNT(*) FROM users 
-                WHERE is_active = 1 AND last_activity > datetime('now', '-7 days')
-            ''')
-            stats['active_users'] = cursor.fetchone()[0]
-            
-            # Messages sent (last 30 days)
-            cursor = conn.execute('''
-                SELECT COUNT(*) FROM messages 
-                WHERE sent_at > datetime('now', '-30 days')
-            ''')
-            stats['messages_sent'] = cursor.fetchone()[0]
-            
-            # Link clicks (last 30 days)
-            cursor = conn.execute('''
-                SELECT COUNT(*) FROM link_clicks 
-                WHERE clicked_at > datetime('now', '-30 days')
-            ''')
-            stats['link_clicks'] = cursor.fetchone()[0]
-            
-            # Recent broadcasts
+                SELECT *,
+                    COALESCE(100.0 * link_clicks / NULLIF(messages_sent, 0), 0) as ctr,
+                    COALESCE(100.0 * active_users / NULLIF(total_subscribers, 0), 0) as engagement
+                FROM (SELECT
+                    (SELECT value FROM counters WHERE name = 'active_users') as total_subscribers,
+                    (SELECT COUNT(*) FROM users 
+                     WHERE is_active = 1 AND last_activity > datetime('now', :week)) as active_users,
+                    (SELECT COUNT(*) FROM messages 
+                     WHERE sent_at > datetime('now', :month)) as messages_sent,
+                    (SELECT COUNT(*) FROM link_clicks 
+                     WHERE clicked_at > datetime('now', :month)) as link_clicks,
+                    (SELECT COUNT(*) FROM broadcasts 
+                     WHERE created_at > datetime('now', :month)) as recent_broadcasts,
+                    (SELECT value FROM counters WHERE name = 'bot_started_users') as bot_interactions)
+            ''', {'week': '-7 days', 'month': '-30 days'})
+            return dict(cursor.fetchone())
+    
+    def get_channel_activity(self) -> Tuple[int, int]:
+        """Get (join events in 30 days, users active in 7 days) in one query"""
+        self.flush_activity()
+        with self.get_connection() as conn:
             cursor = conn.execute('''
-                SELECT COUNT(*) FROM broadcasts 
-                WHERE created_at > datetime('now', '-30 days')
+                SELECT
+                    (SELECT COUNT(*) FROM messages 
+                     WHERE message_type IN ('auto_approval', 'member_added')
+                     AND sent_at > datetime('now', '-30 days')),
+                    (SELECT COUNT(*) FROM users 
+                     WHERE last_activity > datetime('now', '-7 days'))
             ''')
-            stats['recent_broadcasts'] = cursor.fetchone()[0]
-            
-            # Bot started users
-            cursor = conn.execute('SELECT COUNT(*) FROM users WHERE bot_started = 1')
-            stats['bot_interactions'] = cursor.fetchone()[0]
-        
-        return stats
+            return tuple(cursor.fetchone())
     
     # Cache management
     def cache_stat(self, metric_name: str, value: str):
@@ -373,8 +604,8 @@ class Database:
             cursor = conn.execute('''
                 SELECT metric_value FROM stats_cache 
                 WHERE metric_name = ? 
-                AND calculated_at > datetime('now', '-{} minutes')
-            '''.format(max_age_minutes), (metric_name,))
+                AND calculated_at > datetime('now', ?)
+            ''', (metric_name, f'-{int(max_age_minutes)} minutes'))
             
             row = cursor.fetchone()
             return row['metric_value'] if row else None
@@ -2,9 +2,74 @@
 Admin Commands Handler - обработка административных команд
 """
 
+import time
+import asyncio
 import logging
+import functools
+from collections import namedtuple
+from itertools import islice
+from typing import Tuple
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
+from telegram.error import RetryAfter, TimedOut
+
+from shared.constants import BROADCAST_CONCURRENCY
+from shared.telegram_utils import get_bucket, HTTP2_AVAILABLE, markdown_parse_mode
+
+# Broadcast message log rows are written in batches of this size
+LOG_BATCH_SIZE = 500
+
+# Bot HTTP connection pool, big enough for broadcast fan-out plus regular updates
+CONNECTION_POOL_SIZE = 64
+# Bot API timeouts, generous enough for slow answers during broadcast bursts
+READ_TIMEOUT_SECONDS = 20
+CONNECT_TIMEOUT_SECONDS = 10
+# Pause before retrying a send that timed out
+SEND_TIMEOUT_RETRY_SECONDS = 0.5
+
+# Broadcasts queued within this window of each other are merged into one message
+# per user, as long as the merged text stays under Telegram's 4096 char limit
+BROADCAST_COALESCE_SECONDS = 1.0
+BROADCAST_MAX_LENGTH = 4000
+BROADCAST_SEPARATOR = "\n---\n"
+
+PendingBroadcast = namedtuple('PendingBroadcast', 'status_msg broadcast_id text queued_at')
+
+# Minimum interval between broadcast progress edits (Telegram allows ~1 edit/s)
+PROGRESS_EDIT_SECONDS = 1.0
+
+MASS_SEND_MESSAGE = """
+📢 **Массовая рассылка**
+
+Отправьте следующим сообщением текст, который хотите разослать всем подписчикам канала.
+
+**Возможности:**
+- Поддержка Markdown разметки
+- Автоматический UTM трекинг ссылок  
+- Статистика доставки
+- Защита от спама
+
+**Пример сообщения:**
+🎉 Новая акция в нашем магазине!
+Скидка 20% на все товары до конца недели.
+Переходите по ссылке: https://example.com
+#акция #скидка
+Отправьте сообщение или вернитесь в меню:
+"""
+
+BACK_TO_MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Назад", callback_data="admin_main")]
+])
+
+def _require_admin(method):
+    """Reply with an access error instead of running method for non-admins"""
+    @functools.wraps(method)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        if update.effective_user.id not in self._admin_ids:
+            await update.message.reply_text("❌ У вас нет прав для этого действия")
+            return
+        return await method(self, update, context, *args, **kwargs)
+    return wrapper
 
 class AdminCommandsHandler:
     def __init__(self, db, config, admin_panel):
@@ -12,6 +77,35 @@ class AdminCommandsHandler:
         self.config = config
         self.admin_panel = admin_panel
         self.admin_chat_id = config['ADMIN_CHAT_ID']
+        self._admin_ids = frozenset((self.admin_chat_id,))
+        self._waiting_admins = set()  # admins whose next message is a broadcast
+        # Shared with every other broadcast path of this bot
+        self._limiter = get_bucket(config['BOT_TOKEN'])
+        self._pending_broadcasts = []  # PendingBroadcast entries in queue order
+        self._broadcast_worker = None
+        
+        # Static menus (message, keyboard) are built once
+        self._menus = {
+            'broadcast': (admin_panel.get_broadcast_menu_message(), admin_panel.get_broadcast_keyboard()),
+            'help': (admin_panel.get_help_message(), admin_panel.get_help_keyboard()),
+            'mass_send': (MASS_SEND_MESSAGE, BACK_TO_MAIN_KEYBOARD)
+        }
+        
+        # Callback data -> handler
+        self._exact_routes = {
+            "admin_main": self.show_admin_dashboard,
+            "admin_stats": self.show_admin_stats,
+            "admin_broadcast": self.show_broadcast_menu,
+            "admin_users": self.show_users_menu,
+            "admin_settings": self.show_settings_menu,
+            "admin_mass_send": self.show_mass_send_menu,
+            "admin_help": self.show_help_menu
+        }
+        self._prefix_routes = (
+            ("broadcast_", self.handle_broadcast_callback),
+            ("users_", self.handle_users_callback),
+            ("settings_", self.handle_settings_callback)
+        )
     
     async def handle_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
@@ -61,20 +155,27 @@ class AdminCommandsHandler:
         
         await update.message.reply_text(welcome_message)
     
+    def configure_pool(self, builder, size: int = CONNECTION_POOL_SIZE):
+        """Tune the bot's HTTP client so concurrent broadcast sends don't starve it"""
+        builder = (
+            builder.connection_pool_size(size)
+            .read_timeout(READ_TIMEOUT_SECONDS)
+            .connect_timeout(CONNECT_TIMEOUT_SECONDS)
+        )
+        # Multiplex API calls over one connection when h2 is installed;
+        # long polling keeps its own default request
+        if HTTP2_AVAILABLE:
+            builder = builder.http_version("2")
+        return builder
+    
+    @_require_admin
     async def handle_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /admin command"""
-        if not self.admin_panel.is_admin(update.effective_user.id):
-            await update.message.reply_text("❌ У вас нет прав для этого действия")
-            return
-        
         await self.show_admin_dashboard(update, context)
     
+    @_require_admin
     async def handle_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /stats command"""
-        if not self.admin_panel.is_admin(update.effective_user.id):
-            await update.message.reply_text("❌ У вас нет прав для этого действия")
-            return
-        
         message = self.admin_panel.get_stats_message()
         keyboard = self.admin_panel.get_stats_keyboard()
         
@@ -84,12 +185,9 @@ class AdminCommandsHandler:
             parse_mode='Markdown'
         )
     
+    @_require_admin
     async def handle_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /broadcast command"""
-        if not self.admin_panel.is_admin(update.effective_user.id):
-            await update.message.reply_text("❌ У вас нет прав для этого действия")
-            return
-        
         # Extract broadcast message from command
         args = context.args
         if not args:
@@ -107,10 +205,10 @@ class AdminCommandsHandler:
     async def send_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
         """Send broadcast message to all users"""
         try:
-            # Get all active users
-            users = self.db.get_active_users()
+            # Recipients are streamed from DB, only the count is needed upfront
+            total_users = self.db.get_user_count()
             
-            if not users:
+            if not total_users:
                 await update.message.reply_text("❌ Нет активных пользователей для рассылки")
                 return
             
@@ -123,57 +221,163 @@ class AdminCommandsHandler:
             
             # Send status message
             status_msg = await update.message.reply_text(
-                f"🔄 Отправляю рассылку {len(users)} пользователям..."
+                f"🔄 Отправляю рассылку {total_users} пользователям..."
             )
             
+            # Deliver in the background so the bot keeps serving other updates
+            self._pending_broadcasts.append(PendingBroadcast(status_msg, broadcast_id, text, time.monotonic()))
+            if self._broadcast_worker is None or self._broadcast_worker.done():
+                self._broadcast_worker = context.application.create_task(
+                    self._process_broadcasts(context.bot)
+                )
+            
+        except Exception as e:
+            logging.error("Broadcast error: %s", e)
+            await update.message.reply_text(
+                f"❌ Ошибка при отправке рассылки: {str(e)}"
+            )
+    
+    async def _process_broadcasts(self, bot):
+        """Deliver queued broadcasts, merging short ones queued close together"""
+        while self._pending_broadcasts:
+            await asyncio.sleep(BROADCAST_COALESCE_SECONDS)
+            pending, self._pending_broadcasts = self._pending_broadcasts, []
+            
+            for group in self._coalesce_broadcasts(pending):
+                await self._run_broadcast(
+                    bot,
+                    [item.status_msg for item in group],
+                    [item.broadcast_id for item in group],
+                    BROADCAST_SEPARATOR.join(item.text for item in group)
+                )
+    
+    @staticmethod
+    def _coalesce_broadcasts(pending: list) -> list:
+        """Group broadcasts queued within the coalescing window whose joined text fits in one message
+        
+        pending: PendingBroadcast entries in queue order
+        """
+        groups = []
+        length = 0
+        for item in pending:
+            merged_length = length + len(BROADCAST_SEPARATOR) + len(item.text)
+            # Only merge with the group's first item if queued close to it; anything
+            # that piled up during a long broadcast is sent separately
+            if (groups and merged_length <= BROADCAST_MAX_LENGTH
+                    and item.queued_at - groups[-1][0].queued_at <= BROADCAST_COALESCE_SECONDS):
+                groups[-1].append(item)
+                length = merged_length
+            else:
+                groups.append([item])
+                length = len(item.text)
+        return groups
+    
+    async def _edit_status(self, status_msgs: list, text: str, **kwargs):
+        """Edit every status message of a broadcast group"""
+        for status_msg in status_msgs:
+            try:
+                await status_msg.edit_text(text, **kwargs)
+            except Exception as e:
+                logging.warning("Failed to update broadcast status: %s", e)
+    
+    async def _run_broadcast(self, bot, status_msgs: list, broadcast_ids: list, text: str):
+        """Deliver broadcast to all active users and report results"""
+        try:
             successful_sends = 0
             failed_sends = 0
+            semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+            parse_mode = markdown_parse_mode(text)
             
-            # Send to each user
-            for user in users:
-                try:
-                    await context.bot.send_message(
-                        chat_id=user['user_id'],
-                        text=text,
-                        parse_mode='Markdown'
-                    )
-                    
-                    # Log message
-                    self.db.log_message(
-                        user_id=user['user_id'],
-                        message_type='broadcast',
-                        content=text,
-                        utm_source='admin_broadcast'
-                    )
-                    
-                    successful_sends += 1
+            async def send_one(user_id: int) -> Tuple[int, bool]:
+                async with semaphore:
+                    for attempt in range(2):
+                        try:
+                            await self._limiter.acquire()
+                            await bot.send_message(
+                                chat_id=user_id,
+                                text=text,
+                                parse_mode=parse_mode
+                            )
+                            return user_id, True
+                        except RetryAfter as e:
+                            if attempt:
+                                logging.warning("Failed to send to user %s: %s", user_id, e)
+                                return user_id, False
+                            # Flood control hit, wait as told and retry once
+                            await asyncio.sleep(e.retry_after)
+                        except TimedOut as e:
+                            if attempt:
+                                logging.warning("Failed to send to user %s: %s", user_id, e)
+                                return user_id, False
+                            await asyncio.sleep(SEND_TIMEOUT_RETRY_SECONDS)
+                        except Exception as e:
+                            logging.warning("Failed to send to user %s: %s", user_id, e)
+                            return user_id, False
+            
+            # Send concurrently, one batch of users at a time
+            total_users = self.db.get_user_count()
+            last_edit = time.monotonic()
+            progress_task = None
+            users = self.db.iter_active_users()
+            while True:
+                batch = [user['user_id'] for user in islice(users, LOG_BATCH_SIZE)]
+                if not batch:
+                    break
+                
+                log_rows = []
+                for finished in asyncio.as_completed([send_one(user_id) for user_id in batch]):
+                    user_id, ok = await finished
+                    if ok:
+                        log_rows.append((user_id, 'broadcast', text, 'admin_broadcast', None))
+                        successful_sends += 1
+                    else:
+                        failed_sends += 1
                     
-                except Exception as e:
-                    logging.warning(f"Failed to send to user {user['user_id']}: {e}")
-                    failed_sends += 1
+                    # Progress edits run alongside sending, at most one in flight
+                    now = time.monotonic()
+                    if now - last_edit >= PROGRESS_EDIT_SECONDS and (progress_task is None or progress_task.done()):
+                        progress_task = asyncio.create_task(self._edit_status(
+                            status_msgs,
+                            f"🔄 Отправляю рассылку... {successful_sends + failed_sends}/{total_users}"
+                        ))
+                        last_edit = now
+                
+                # Log delivered messages for this batch
+                self.db.log_messages_bulk(log_rows)
             
-            # Update broadcast stats
-            self.db.update_broadcast_stats(
-                broadcast_id=broadcast_id,
-                total_recipients=len(users),
-                successful_sends=successful_sends,
-                failed_sends=failed_sends
-            )
+            if progress_task:
+                await progress_task
+            
+            total_recipients = successful_sends + failed_sends
+            
+            # Update broadcast stats; merged broadcasts were one delivery, so their
+            # rows share its counts and are marked 'merged' to avoid double counting
+            status = 'sent' if len(broadcast_ids) == 1 else 'merged'
+            for broadcast_id in broadcast_ids:
+                self.db.update_broadcast_stats(
+                    broadcast_id=broadcast_id,
+                    total_recipients=total_recipients,
+                    successful_sends=successful_sends,
+                    failed_sends=failed_sends,
+                    status=status
+                )
             
             # Update status message
-            await status_msg.edit_text(
+            await self._edit_status(
+                status_msgs,
                 f"✅ **Рассылка завершена!**\n\n"
                 f"📊 Результаты:\n"
-                f"• Получателей: {len(users)}\n"
+                f"• Получателей: {total_recipients}\n"
                 f"• Доставлено: {successful_sends}\n"
                 f"• Ошибок: {failed_sends}\n"
-                f"• Успешность: {(successful_sends/len(users)*100):.1f}%",
+                f"• Успешность: {(successful_sends/max(total_recipients, 1)*100):.1f}%",
                 parse_mode='Markdown'
             )
             
         except Exception as e:
-            logging.error(f"Broadcast error: {e}")
-            await update.message.reply_text(
+            logging.error("Broadcast error: %s", e)
+            await self._edit_status(
+                status_msgs,
                 f"❌ Ошибка при отправке рассылки: {str(e)}"
             )
     
@@ -185,131 +389,56 @@ class AdminCommandsHandler:
         await query.answer()
         
         try:
-            if data == "admin_main":
-                await self.show_admin_dashboard(update, context)
-            
-            elif data == "admin_stats":
-                await self.show_admin_stats(update, context)
-            
-            elif data == "admin_broadcast":
-                await self.show_broadcast_menu(update, context)
-            
-            elif data == "admin_users":
-                await self.show_users_menu(update, context)
-            
-            elif data == "admin_settings":
-                await self.show_settings_menu(update, context)
-            
-            elif data == "admin_mass_send":
-                await self.show_mass_send_menu(update, context)
-            
-            elif data == "admin_help":
-                await self.show_help_menu(update, context)
-            
-            elif data.startswith("broadcast_"):
-                await self.handle_broadcast_callback(update, context, data)
-            
-            elif data.startswith("users_"):
-                await self.handle_users_callback(update, context, data)
+            handler = self._exact_routes.get(data)
+            if handler:
+                await handler(update, context)
+                return
             
-            elif data.startswith("settings_"):
-                await self.handle_settings_callback(update, context, data)
+            for prefix, prefix_handler in self._prefix_routes:
+                if data.startswith(prefix):
+                    await prefix_handler(update, context, data)
+                    return
             
-            else:
-                await query.answer("🚧 Функция в разработке")
+            await query.answer("🚧 Функция в разработке")
                 
         except Exception as e:
-            logging.error(f"Callback query error: {e}")
+            logging.error("Callback query error: %s", e)
             await query.answer("❌ Произошла ошибка")
     
-    async def show_admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Show detailed statistics"""
-        message = self.admin_panel.get_stats_message()
-        keyboard = self.admin_panel.get_stats_keyboard()
-        
+    async def _render(self, update: Update, message: str, keyboard: InlineKeyboardMarkup):
+        """Show menu by editing the callback message"""
         await update.callback_query.edit_message_text(
             message,
             reply_markup=keyboard,
             parse_mode='Markdown'
         )
     
+    async def show_admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show detailed statistics"""
+        await self._render(update, self.admin_panel.get_stats_message(), self.admin_panel.get_stats_keyboard())
+    
     async def show_broadcast_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show broadcast management menu"""
-        message = self.admin_panel.get_broadcast_menu_message()
-        keyboard = self.admin_panel.get_broadcast_keyboard()
-        
-        await update.callback_query.edit_message_text(
-            message,
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
+        await self._render(update, *self._menus['broadcast'])
     
     async def show_users_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show user management menu"""
-        message = self.admin_panel.get_users_menu_message()
-        keyboard = self.admin_panel.get_users_keyboard()
-        
-        await update.callback_query.edit_message_text(
-            message,
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
+        await self._render(update, self.admin_panel.get_users_menu_message(), self.admin_panel.get_users_keyboard())
     
     async def show_settings_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show settings menu"""
-        message = self.admin_panel.get_settings_menu_message()
-        keyboard = self.admin_panel.get_settings_keyboard()
-        
-        await update.callback_query.edit_message_text(
-            message,
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
+        await self._render(update, self.admin_panel.get_settings_menu_message(), self.admin_panel.get_settings_keyboard())
     
     async def show_mass_send_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show mass send interface"""
-        message = """
-📢 **Массовая рассылка**
-
-Отправьте следующим сообщением текст, который хотите разослать всем подписчикам канала.
-
-**Возможности:**
-- Поддержка Markdown разметки
-- Автоматический UTM трекинг ссылок  
-- Статистика доставки
-- Защита от спама
-
-**Пример сообщения:**
-🎉 Новая акция в нашем магазине!
-Скидка 20% на все товары до конца недели.
-Переходите по ссылке: https://example.com
-#акция #скидка
-Отправьте сообщение или вернитесь в меню:
-"""
-        
-        keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_main")]
-        ]
-        
-        await update.callback_query.edit_message_text(
-            message,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+        await self._render(update, *self._menus['mass_send'])
         
         # Set user state for next message
-        context.user_data['waiting_for_broadcast'] = True
+        self._waiting_admins.add(update.effective_user.id)
     
     async def show_help_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show help menu"""
-        message = self.admin_panel.get_help_message()
-        keyboard = self.admin_panel.get_help_keyboard()
-        
-        await update.callback_query.edit_message_text(
-            message,
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
+        await self._render(update, *self._menus['help'])
     
     async def handle_broadcast_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
         """Handle broadcast-related callbacks"""
@@ -324,6 +453,8 @@ class AdminCommandsHandler:
         """Handle user management callbacks"""
         if data == "users_list":
             await self.show_users_list(update, context)
+        elif data.startswith("users_page_"):
+            await self.show_users_list(update, context, int(data.split("_")[2]))
         elif data == "users_activity":
             await update.callback_query.answer("🚧 Статистика активности в разработке")
         elif data == "users_export":
@@ -331,18 +462,18 @@ class AdminCommandsHandler:
     
     async def show_users_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
         """Show paginated users list"""
-        users = self.db.get_active_users()
+        per_page = 5
+        users, total_count = self.db.get_users_page(page * per_page, per_page)
         
-        if not users:
+        if not total_count:
             await update.callback_query.edit_message_text(
                 "👥 **Пользователи канала**\n\nПользователей пока нет."
             )
             return
         
-        per_page = 5
-        total_pages = (len(users) + per_page - 1) // per_page
+        total_pages = (total_count + per_page - 1) // per_page
         
-        message = self.admin_panel.format_user_list(users, page, per_page)
+        message = self.admin_panel.format_user_list(users, total_count, page, per_page)
         keyboard = self.admin_panel.get_pagination_keyboard(page, total_pages, "users_page")
         
         await update.callback_query.edit_message_text(
@@ -378,11 +509,11 @@ class AdminCommandsHandler:
     async def handle_private_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle private messages from admin"""
         # Check if waiting for broadcast message
-        if context.user_data.get('waiting_for_broadcast'):
-            broadcast_text = update.message.text
-            context.user_data['waiting_for_broadcast'] = False
+        user_id = update.effective_user.id
+        if user_id in self._waiting_admins:
+            self._waiting_admins.discard(user_id)
             
-            await self.send_broadcast(update, context, broadcast_text)
+            await self.send_broadcast(update, context, update.message.text)
         else:
             # Default response
             await update.message.reply_text(
@@ -2,11 +2,58 @@
 Channel Events Handler - обработка событий канала
 """
 
+import asyncio
 import logging
+from typing import Tuple
 from telegram import Update, ChatJoinRequest
 from telegram.ext import ContextTypes
 from telegram.error import TelegramError
 
+from shared.telegram_utils import markdown_parse_mode
+
+# Max welcome messages in flight when several members join at once
+WELCOME_CONCURRENCY = 25
+
+JOIN_APPROVED_TEMPLATE = """
+✅ **Новый участник одобрен автоматически**
+
+👤 **Пользователь:** {name} ({username})
+🆔 **ID:** `{user_id}`
+🕐 **Время:** {time}
+
+Пользователь был автоматически добавлен в канал и получил приветственное сообщение.
+"""
+
+JOIN_PENDING_TEMPLATE = """
+🔔 **Новая заявка на вступление**
+
+👤 **Пользователь:** {name} ({username})
+🆔 **ID:** `{user_id}`
+🕐 **Время:** {time}
+
+⚠️ Автоодобрение отключено. Заявка ожидает ручного рассмотрения в настройках канала.
+"""
+
+APPROVAL_ERROR_TEMPLATE = """
+❌ **Ошибка при автоодобрении**
+
+👤 **Пользователь:** {name} ({username})
+🆔 **ID:** `{user_id}`
+🚫 **Ошибка:** {error}
+
+Пожалуйста, рассмотрите заявку вручную в настройках канала.
+"""
+
+MEMBER_LEFT_TEMPLATE = """
+👋 **Пользователь покинул канал**
+
+👤 **Пользователь:** {name} ({username})
+🆔 **ID:** `{user_id}`
+🕐 **Время:** {time}
+
+Пользователь был помечен как неактивный в базе данных.
+"""
+
 class ChannelEventsHandler:
     def __init__(self, db, config):
         self.db = db
@@ -21,7 +68,7 @@ class ChannelEventsHandler:
             user = join_request.from_user
             chat = join_request.chat
             
-            logging.info(f"Join request from user {user.id} ({user.username}) to chat {chat.id}")
+            logging.info("Join request from user %s (%s) to chat %s", user.id, user.username, chat.id)
             
             # Add user to database
             self.db.add_user(
@@ -32,96 +79,109 @@ class ChannelEventsHandler:
                 utm_source='channel_join'
             )
             
-            # Check auto-approve setting
-            auto_approve_enabled = self.db.get_setting('auto_approve', 'true') == 'true'
+            # Check auto-approve setting, config switch wins without a settings lookup
+            auto_approve_enabled = self.auto_approve and self.db.get_setting('auto_approve', 'true') == 'true'
             
-            if auto_approve_enabled and self.auto_approve:
+            if auto_approve_enabled:
                 # Auto-approve the request
                 try:
                     await join_request.approve()
                     
-                    # Send welcome message if enabled
-                    await self._send_welcome_message(user.id, context)
+                    # Welcome, log and notify in background so the update is acked right away
+                    context.application.create_task(self._post_join(user, context))
                     
-                    # Log approval
-                    self.db.log_message(
-                        user_id=user.id,
-                        message_type='auto_approval',
-                        content='User auto-approved to channel',
-                        utm_source='auto_approve'
-                    )
-                    
-                    # Notify admin
-                    await self._notify_admin_join(user, context, approved=True)
-                    
-                    logging.info(f"Auto-approved join request from {user.id}")
+                    logging.info("Auto-approved join request from %s", user.id)
                     
                 except TelegramError as e:
-                    logging.error(f"Failed to approve join request: {e}")
+                    logging.error("Failed to approve join request: %s", e)
                     await self._notify_admin_error(user, context, str(e))
             else:
                 # Manual approval needed - notify admin
                 await self._notify_admin_join(user, context, approved=False)
-                logging.info(f"Join request from {user.id} pending manual approval")
+                logging.info("Join request from %s pending manual approval", user.id)
                 
         except Exception as e:
-            logging.error(f"Error handling join request: {e}")
+            logging.error("Error handling join request: %s", e)
     
-    async def _send_welcome_message(self, user_id: int, context: ContextTypes.DEFAULT_TYPE):
-        """Send welcome message to new user"""
+    async def _post_join(self, user, context: ContextTypes.DEFAULT_TYPE):
+        """Follow-up work after a join request was auto-approved"""
         try:
-            welcome_message = self.db.get_setting('welcome_message', 
-                self.config.get('WELCOME_MESSAGE', 
-                    '👋 Добро пожаловать в наш канал! Мы рады видеть тебя здесь.'
-                )
+            # Send welcome message if enabled
+            await self._send_welcome_message(user.id, context)
+            
+            # Log approval
+            self.db.log_message(
+                user_id=user.id,
+                message_type='auto_approval',
+                content='User auto-approved to channel',
+                utm_source='auto_approve'
             )
             
-            if welcome_message and self.config.get('WELCOME_MESSAGE_ENABLED', True):
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=welcome_message,
-                    parse_mode='Markdown'
-                )
-                
-                # Log welcome message
-                self.db.log_message(
-                    user_id=user_id,
-                    message_type='welcome',
-                    content=welcome_message,
-                    utm_source='auto_welcome'
-                )
-                
+            # Notify admin
+            await self._notify_admin_join(user, context, approved=True)
+            
+        except Exception as e:
+            logging.error("Error after approving join request from %s: %s", user.id, e)
+    
+    def _get_welcome_message(self) -> str:
+        """Get welcome message text, empty if welcome messages are disabled"""
+        if not self.config.get('WELCOME_MESSAGE_ENABLED', True):
+            return ''
+        
+        return self.db.get_setting('welcome_message', 
+            self.config.get('WELCOME_MESSAGE', 
+                '👋 Добро пожаловать в наш канал! Мы рады видеть тебя здесь.'
+            )
+        )
+    
+    async def _deliver_welcome(self, user_id: int, context: ContextTypes.DEFAULT_TYPE,
+                               welcome_message: str) -> bool:
+        """Send welcome message without logging it, return True on success"""
+        try:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=welcome_message,
+                parse_mode=markdown_parse_mode(welcome_message)
+            )
+            return True
+            
         except TelegramError as e:
-            logging.warning(f"Failed to send welcome message to {user_id}: {e}")
+            logging.warning("Failed to send welcome message to %s: %s", user_id, e)
         except Exception as e:
-            logging.error(f"Error sending welcome message: {e}")
+            logging.error("Error sending welcome message: %s", e)
+        return False
+    
+    async def _send_welcome_message(self, user_id: int, context: ContextTypes.DEFAULT_TYPE):
+        """Send welcome message to new user"""
+        welcome_message = self._get_welcome_message()
+        
+        if welcome_message and await self._deliver_welcome(user_id, context, welcome_message):
+            # Log welcome message
+            self.db.log_message(
+                user_id=user_id,
+                message_type='welcome',
+                content=welcome_message,
+                utm_source='auto_welcome'
+            )
+    
+    @staticmethod
+    def _format_user(user) -> Tuple[str, str]:
+        """Get (username, name) of user for admin notifications"""
+        return (
+            f"@{user.username}" if user.username else "Без username",
+            user.first_name or "Без имени"
+        )
     
     async def _notify_admin_join(self, user, context: ContextTypes.DEFAULT_TYPE, approved: bool = False):
         """Notify admin about new join request"""
         try:
-            username = f"@{user.username}" if user.username else "Без username"
-            name = user.first_name or "Без имени"
+            username, name = self._format_user(user)
             
-            if approved:
-                message = f"""
-✅ **Новый участник одобрен автоматически**
-
-👤 **Пользователь:** {name} ({username})
-🆔 **ID:** `{user.id}`
-🕐 **Время:** {context.bot_data.get('current_time', 'сейчас')}
-
-Пользователь был автоматически добавлен в канал и получил приветственное сообщение.
-"""
-            else:
-                message = f"""
-🔔 **Новая заявка на вступление**
-
-👤 **Пользователь:** {name} ({username})
-🆔 **ID:** `{user.id}`
-🕐 **Время:** {context.bot_data.get('current_time', 'сейчас')}
-
-⚠️ Автоодобрение отключено. Заявка ожидает ручного рассмотрения в настройках канала.
-"""
+            template = JOIN_APPROVED_TEMPLATE if approved else JOIN_PENDING_TEMPLATE
+            message = template.format(
+                name=name, username=username, user_id=user.id,
+                time=context.bot_data.get('current_time', 'сейчас')
+            )
             
             await context.bot.send_message(
                 chat_id=self.admin_chat_id,
@@ -130,23 +190,16 @@ class ChannelEventsHandler:
             )
             
         except Exception as e:
-            logging.error(f"Failed to notify admin: {e}")
+            logging.error("Failed to notify admin: %s", e)
     
     async def _notify_admin_error(self, user, context: ContextTypes.DEFAULT_TYPE, error_msg: str):
         """Notify admin about approval error"""
         try:
-            username = f"@{user.username}" if user.username else "Без username"
-            name = user.first_name or "Без имени"
+            username, name = self._format_user(user)
             
-            message = f"""
-❌ **Ошибка при автоодобрении**
-
-👤 **Пользователь:** {name} ({username})
-🆔 **ID:** `{user.id}`
-🚫 **Ошибка:** {error_msg}
-
-Пожалуйста, рассмотрите заявку вручную в настройках канала.
-"""
+            message = APPROVAL_ERROR_TEMPLATE.format(
+                name=name, username=username, user_id=user.id, error=error_msg
+            )
             
             await context.bot.send_message(
                 chat_id=self.admin_chat_id,
@@ -155,7 +208,7 @@ class ChannelEventsHandler:
             )
             
         except Exception as e:
-            logging.error(f"Failed to notify admin about error: {e}")
+            logging.error("Failed to notify admin about error: %s", e)
     
     async def handle_member_left(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle member leaving channel"""
@@ -164,17 +217,8 @@ class ChannelEventsHandler:
             if not left_member:
                 return
             
-            # Update user status in database
-            user = self.db.get_user(left_member.id)
-            if user:
-                # Mark as inactive instead of deleting
-                with self.db.get_connection() as conn:
-                    conn.execute('''
-                        UPDATE users SET is_active = 0, last_activity = CURRENT_TIMESTAMP 
-                        WHERE user_id = ?
-                    ''', (left_member.id,))
-                    conn.commit()
-                
+            # Mark as inactive instead of deleting
+            if self.db.mark_inactive(left_member.id):
                 # Send farewell message if enabled
                 await self._send_farewell_message(left_member.id, context)
                 
@@ -189,10 +233,10 @@ class ChannelEventsHandler:
                 # Notify admin
                 await self._notify_admin_left(left_member, context)
                 
-                logging.info(f"User {left_member.id} left the channel")
+                logging.info("User %s left the channel", left_member.id)
                 
         except Exception as e:
-            logging.error(f"Error handling member left: {e}")
+            logging.error("Error handling member left: %s", e)
     
     async def _send_farewell_message(self, user_id: int, context: ContextTypes.DEFAULT_TYPE):
         """Send farewell message to user who left"""
@@ -207,7 +251,7 @@ class ChannelEventsHandler:
                 await context.bot.send_message(
                     chat_id=user_id,
                     text=farewell_message,
-                    parse_mode='Markdown'
+                    parse_mode=markdown_parse_mode(farewell_message)
                 )
                 
                 # Log farewell message
@@ -219,25 +263,19 @@ class ChannelEventsHandler:
                 )
                 
         except TelegramError as e:
-            logging.warning(f"Failed to send farewell message to {user_id}: {e}")
+            logging.warning("Failed to send farewell message to %s: %s", user_id, e)
         except Exception as e:
-            logging.error(f"Error sending farewell message: {e}")
+            logging.error("Error sending farewell message: %s", e)
     
     async def _notify_admin_left(self, user, context: ContextTypes.DEFAULT_TYPE):
         """Notify admin about user leaving"""
         try:
-            username = f"@{user.username}" if user.username else "Без username"
-            name = user.first_name or "Без имени"
+            username, name = self._format_user(user)
             
-            message = f"""
-👋 **Пользователь покинул канал**
-
-👤 **Пользователь:** {name} ({username})
-🆔 **ID:** `{user.id}`
-🕐 **Время:** {context.bot_data.get('current_time', 'сейчас')}
-
-Пользователь был помечен как неактивный в базе данных.
-"""
+            message = MEMBER_LEFT_TEMPLATE.format(
+                name=name, username=username, user_id=user.id,
+                time=context.bot_data.get('current_time', 'сейчас')
+            )
             
             await context.bot.send_message(
                 chat_id=self.admin_chat_id,
@@ -246,7 +284,7 @@ class ChannelEventsHandler:
             )
             
         except Exception as e:
-            logging.error(f"Failed to notify admin about user leaving: {e}")
+            logging.error("Failed to notify admin about user leaving: %s", e)
     
     async def handle_new_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle new member added to channel"""
@@ -255,35 +293,44 @@ class ChannelEventsHandler:
             if not new_members:
                 return
             
-            for member in new_members:
-                # Skip bots
-                if member.is_bot:
-                    continue
-                
-                # Add to database
-                self.db.add_user(
-                    user_id=member.id,
-                    username=member.username,
-                    first_name=member.first_name,
-                    last_name=member.last_name,
-                    utm_source='channel_invite'
-                )
+            # Skip bots
+            members = [member for member in new_members if not member.is_bot]
+            if not members:
+                return
+            
+            # Add to database
+            self.db.add_users_bulk([
+                (member.id, member.username, member.first_name, member.last_name, 'channel_invite', None)
+                for member in members
+            ])
+            
+            log_rows = [
+                (member.id, 'member_added', 'User added to channel', 'channel_event', None)
+                for member in members
+            ]
+            
+            # Send welcome messages concurrently, setting is read once
+            welcome_message = self._get_welcome_message()
+            if welcome_message:
+                semaphore = asyncio.Semaphore(WELCOME_CONCURRENCY)
                 
-                # Send welcome message
-                await self._send_welcome_message(member.id, context)
+                async def welcome(user_id: int) -> bool:
+                    async with semaphore:
+                        return await self._deliver_welcome(user_id, context, welcome_message)
                 
-                # Log event
-                self.db.log_message(
-                    user_id=member.id,
-                    message_type='member_added',
-                    content='User added to channel',
-                    utm_source='channel_event'
+                results = await asyncio.gather(*(welcome(member.id) for member in members))
+                log_rows.extend(
+                    (member.id, 'welcome', welcome_message, 'auto_welcome', None)
+                    for member, ok in zip(members, results) if ok
                 )
-                
-                logging.info(f"New member added: {member.id}")
+            
+            # Log events
+            self.db.log_messages_bulk(log_rows)
+            
+            logging.info("New members added: %s", ', '.join(str(member.id) for member in members))
                 
         except Exception as e:
-            logging.error(f"Error handling new member: {e}")
+            logging.error("Error handling new member: %s", e)
     
     def get_channel_stats(self) -> dict:
         """Get channel statistics"""
@@ -291,30 +338,15 @@ class ChannelEventsHandler:
             stats = self.db.get_dashboard_stats()
             
             # Add channel-specific stats
-            with self.db.get_connection() as conn:
-                # Join requests processed
-                cursor = conn.execute('''
-                    SELECT COUNT(*) FROM messages 
-                    WHERE message_type IN ('auto_approval', 'member_added')
-                    AND sent_at > datetime('now', '-30 days')
-                ''')
-                join_requests = cursor.fetchone()[0]
-                
-                # Recent activity
-                cursor = conn.execute('''
-                    SELECT COUNT(*) FROM users 
-                    WHERE last_activity > datetime('now', '-7 days')
-                ''')
-                recent_activity = cursor.fetchone()[0]
-                
-                stats.update({
-                    'join_requests_30d': join_requests,
-                    'recent_activity_7d': recent_activity,
-                    'auto_approve_enabled': self.db.get_setting('auto_approve', 'true') == 'true'
-                })
+            join_requests, recent_activity = self.db.get_channel_activity()
+            stats.update({
+                'join_requests_30d': join_requests,
+                'recent_activity_7d': recent_activity,
+                'auto_approve_enabled': self.db.get_setting('auto_approve', 'true') == 'true'
+            })
             
             return stats
             
         except Exception as e:
-            logging.error(f"Error getting channel stats: {e}")
+            logging.error("Error getting channel stats: %s", e)
             return {}
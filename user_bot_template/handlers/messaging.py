@@ -2,22 +2,128 @@
 Messaging Handler - обработка сообщений и рассылок
 """
 
+import time
 import logging
-import re
 import asyncio
+from functools import lru_cache
+from itertools import islice
+from typing import Tuple
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-from telegram import Update
+from telegram import Update, Bot
 from telegram.ext import ContextTypes
+from telegram.request import HTTPXRequest
 from telegram.error import TelegramError
 
+from shared.constants import URL_PATTERN, TELEGRAM_RATE_LIMIT_PER_SECOND, BROADCAST_CONCURRENCY
+from shared.database_utils import run_db
+from shared.telegram_utils import TokenBucket, get_bucket, HTTP2_AVAILABLE, markdown_parse_mode
+
+try:
+    import ahocorasick  # optional: pyahocorasick, one pass for any number of markers
+except ImportError:
+    ahocorasick = None
+
+# Basic spam markers, matched as plain substrings of the uppercased content
+SPAM_LITERALS = ('СРОЧНО!!!', 'БЕСПЛАТНО!!!', 'ТОЛЬКО СЕГОДНЯ!!!')
+
+if ahocorasick:
+    SPAM_AUTOMATON = ahocorasick.Automaton()
+    for _literal in SPAM_LITERALS:
+        SPAM_AUTOMATON.add_word(_literal, _literal)
+    SPAM_AUTOMATON.make_automaton()
+else:
+    SPAM_AUTOMATON = None
+
+def _contains_spam(content: str) -> bool:
+    """Check content for any spam marker, case-insensitive"""
+    content_upper = content.upper()
+    if SPAM_AUTOMATON is not None:
+        return next(SPAM_AUTOMATON.iter(content_upper), None) is not None
+    return any(literal in content_upper for literal in SPAM_LITERALS)
+
+# Keep-alive connections shared by all broadcast sends
+BROADCAST_POOL_SIZE = 64
+# Recipients buffered ahead of the senders
+BROADCAST_QUEUE_SIZE = 2000
+# Recipients read from the database per worker-thread call
+RECIPIENT_FETCH_SIZE = 500
+# Activity from a burst of channel messages is written in one batch after this delay
+ACTIVITY_FLUSH_DELAY = 1.0
+# How long broadcast stats are reused between requests
+STATS_CACHE_SECONDS = 60
+# Slow Bot API answers under load shouldn't fail a send
+BROADCAST_READ_TIMEOUT = 20
+
+@lru_cache(maxsize=256)
+def _utm_suffix(source: str, medium: str, campaign: str, content: str) -> str:
+    """Encoded UTM query string for URLs that have no query yet"""
+    return urlencode({
+        'utm_source': source,
+        'utm_medium': medium,
+        'utm_campaign': campaign,
+        'utm_content': content
+    })
+
+@lru_cache(maxsize=2048)
+def _utm_url(url: str, source: str, medium: str, campaign: str, content: str) -> str:
+    """Add UTM parameters not already present in URL (same links repeat a lot)"""
+    # Nothing to merge with, skip the parse/rebuild roundtrip
+    if '?' not in url and '#' not in url:
+        return f"{url}?{_utm_suffix(source, medium, campaign, content)}"
+    
+    parsed = urlparse(url)
+    query_params = parse_qs(parsed.query)
+    
+    utm_params = {
+        'utm_source': source,
+        'utm_medium': medium,
+        'utm_campaign': campaign,
+        'utm_content': content
+    }
+    
+    for key, value in utm_params.items():
+        if key not in query_params:
+            query_params[key] = [value]
+    
+    # Rebuild URL
+    new_query = urlencode(query_params, doseq=True)
+    return urlunparse(parsed._replace(query=new_query))
+
 class MessagingHandler:
     def __init__(self, db, config):
         self.db = db
         self.config = config
         self.admin_chat_id = config['ADMIN_CHAT_ID']
         self.utm_tracking_enabled = config.get('UTM_TRACKING_ENABLED', True)
-        self.broadcast_delay = config.get('BROADCAST_DELAY', 1)
+        self.broadcast_delay = config.get('BROADCAST_DELAY', 0)
         self.max_broadcast_size = config.get('MAX_BROADCAST_SIZE', 1000)
+        
+        # One bot (and HTTP connection pool) for all broadcast sends
+        self._request = HTTPXRequest(
+            connection_pool_size=BROADCAST_POOL_SIZE,
+            read_timeout=BROADCAST_READ_TIMEOUT,
+            http_version="2" if HTTP2_AVAILABLE else "1.1"
+        )
+        self._bot = Bot(token=config['BOT_TOKEN'], request=self._request)
+        
+        # Broadcasts share the bot's global limit with the other send paths; a
+        # BROADCAST_DELAY (seconds between sends) slower than that is an explicit override
+        self._limiter = get_bucket(config['BOT_TOKEN'])
+        if self.broadcast_delay * TELEGRAM_RATE_LIMIT_PER_SECOND > 1:
+            self._delay_limiter = TokenBucket(1, self.broadcast_delay)
+        else:
+            self._delay_limiter = None
+        
+        self._activity_flusher = None
+        self._stats_cache = {}  # days -> (timestamp, stats)
+        self._welcome_cache = None  # (raw text, send kwargs, log snippet)
+    
+    async def close(self):
+        """Close broadcast bot connections"""
+        if self._activity_flusher:
+            self._activity_flusher.cancel()
+        # The bot is never initialize()d, so Bot.shutdown() would be a no-op
+        await self._request.shutdown()
     
     async def handle_channel_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle messages in channel/group"""
@@ -32,33 +138,48 @@ class MessagingHandler:
             
             # Log channel activity
             if message.from_user:
-                self.db.update_user_activity(message.from_user.id)
+                self._record_activity(message.from_user.id)
             
-            # Process URLs in message for tracking
-            if message.text and self.utm_tracking_enabled:
+            # Process URLs in message for tracking (cheap substring check before the regex)
+            if self.utm_tracking_enabled and message.text and 'http' in message.text:
                 await self._process_message_links(message, context)
             
         except Exception as e:
             logging.error(f"Error handling channel message: {e}")
     
+    def _record_activity(self, user_id: int):
+        """Buffer user activity and schedule one background flush for the burst"""
+        self.db.queue_activity(user_id, auto_flush=False)
+        
+        if self._activity_flusher is None or self._activity_flusher.done():
+            self._activity_flusher = asyncio.create_task(self._flush_activity_later())
+    
+    async def _flush_activity_later(self):
+        """Write buffered activity after a short delay, off the event loop"""
+        try:
+            await asyncio.sleep(ACTIVITY_FLUSH_DELAY)
+            await run_db(self.db.flush_activity)
+        except Exception as e:
+            logging.error(f"Error flushing user activity: {e}")
+    
     async def _process_message_links(self, message, context: ContextTypes.DEFAULT_TYPE):
         """Process and track links in messages"""
         try:
             text = message.text
-            urls = re.findall(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', text)
-            
-            for url in urls:
-                # Add UTM parameters if enabled
-                if self.utm_tracking_enabled:
+            urls = URL_PATTERN.findall(text)
+            
+            # Add UTM parameters
+            if urls:
+                user_id = message.from_user.id if message.from_user else None
+                
+                log_rows = []
+                # Each distinct link is rewritten and logged once per message
+                for url in dict.fromkeys(urls):
                     utm_url = self._add_utm_parameters(url, 'channel_message', 'organic')
-                    
-                    # Log URL for tracking
-                    self.db.log_message(
-                        user_id=message.from_user.id if message.from_user else None,
-                        message_type='url_shared',
-                        content=f"Original: {url}, UTM: {utm_url}",
-                        utm_source='channel_message'
-                    )
+                    log_rows.append((user_id, 'url_shared', f"Original: {url}, UTM: {utm_url}", 'channel_message', None))
+                
+                # Log URLs for tracking in one transaction
+                await run_db(self.db.log_messages_bulk, log_rows)
             
         except Exception as e:
             logging.error(f"Error processing message links: {e}")
@@ -67,26 +188,7 @@ class MessagingHandler:
                            medium: str = 'telegram') -> str:
         """Add UTM parameters to URL"""
         try:
-            parsed = urlparse(url)
-            query_params = parse_qs(parsed.query)
-            
-            # Add UTM parameters if not already present
-            utm_params = {
-                'utm_source': source,
-                'utm_medium': medium,
-                'utm_campaign': campaign,
-                'utm_content': f"bot_{self.config.get('BOT_ID', 'unknown')}"
-            }
-            
-            for key, value in utm_params.items():
-                if key not in query_params:
-                    query_params[key] = [value]
-            
-            # Rebuild URL
-            new_query = urlencode(query_params, doseq=True)
-            new_parsed = parsed._replace(query=new_query)
-            
-            return urlunparse(new_parsed)
+            return _utm_url(url, source, medium, campaign, f"bot_{self.config.get('BOT_ID', 'unknown')}")
             
         except Exception as e:
             logging.error(f"Error adding UTM parameters: {e}")
@@ -97,11 +199,11 @@ class MessagingHandler:
                                    title: str = "Рассылка") -> dict:
         """Send broadcast message to users"""
         try:
-            # Get recipients
-            if users is None:
-                users = self.db.get_active_users()
+            # Stream recipients instead of loading the whole audience
+            users = iter(self.db.iter_active_users() if users is None else users)
+            batch = await run_db(list, islice(users, min(RECIPIENT_FETCH_SIZE, self.max_broadcast_size)))
             
-            if not users:
+            if not batch:
                 return {
                     'success': False,
                     'error': 'No active users to send to',
@@ -110,63 +212,84 @@ class MessagingHandler:
                     'failed': 0
                 }
             
-            # Limit broadcast size
-            if len(users) > self.max_broadcast_size:
-                users = users[:self.max_broadcast_size]
-                logging.warning(f"Broadcast limited to {self.max_broadcast_size} users")
-            
             # Create broadcast record
-            broadcast_id = self.db.create_broadcast(
+            broadcast_id = await run_db(
+                self.db.create_broadcast,
                 title=title,
                 content=content,
                 utm_source=utm_source,
                 utm_campaign=utm_campaign
             )
             
-            # Process content (add UTM to links)
-            processed_content = self._process_broadcast_content(content, utm_source, utm_campaign)
+            # Same payload for every recipient, render it once
+            send_kwargs, log_content = self._prepare_message(content, utm_source, utm_campaign)
             
             successful_sends = 0
             failed_sends = 0
             failed_users = []
             
-            # Send to each user with delay
-            for i, user in enumerate(users):
-                try:
-                    # Send message
-                    await self._send_single_message(
-                        user_id=user['user_id'],
-                        content=processed_content,
-                        utm_source=utm_source,
-                        utm_campaign=utm_campaign
-                    )
-                    
-                    successful_sends += 1
-                    
-                    # Add delay between messages to avoid rate limits
-                    if i < len(users) - 1:  # Don't delay after last message
-                        await asyncio.sleep(self.broadcast_delay)
+            log_rows = []
+            queue = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
+            
+            async def sender():
+                nonlocal successful_sends, failed_sends
+                while True:
+                    user_id = await queue.get()
+                    if user_id is None:
+                        return
                     
-                except TelegramError as e:
-                    failed_sends += 1
-                    failed_users.append({
-                        'user_id': user['user_id'],
-                        'error': str(e)
-                    })
-                    logging.warning(f"Failed to send to user {user['user_id']}: {e}")
+                    if self._delay_limiter:
+                        await self._delay_limiter.acquire()
+                    await self._limiter.acquire()
+                    try:
+                        await self._send_single_message(user_id, send_kwargs)
+                        log_rows.append((user_id, 'broadcast', log_content, utm_source, utm_campaign))
+                        successful_sends += 1
+                    except Exception as e:
+                        failed_sends += 1
+                        failed_users.append({
+                            'user_id': user_id,
+                            'error': str(e)
+                        })
+                        if isinstance(e, TelegramError):
+                            logging.warning(f"Failed to send to user {user_id}: {e}")
+                        else:
+                            logging.error(f"Unexpected error sending to user {user_id}: {e}")
+            
+            # Senders start while recipients are still being read
+            senders = [asyncio.create_task(sender()) for _ in range(BROADCAST_CONCURRENCY)]
+            total = 0
+            try:
+                while batch:
+                    for user in batch:
+                        await queue.put(user['user_id'])
+                    total += len(batch)
                     
-                except Exception as e:
-                    failed_sends += 1
-                    failed_users.append({
-                        'user_id': user['user_id'],
-                        'error': str(e)
-                    })
-                    logging.error(f"Unexpected error sending to user {user['user_id']}: {e}")
+                    remaining = self.max_broadcast_size - total
+                    if remaining <= 0:
+                        break
+                    batch = await run_db(list, islice(users, min(RECIPIENT_FETCH_SIZE, remaining)))
+                
+                for _ in senders:
+                    await queue.put(None)
+                await asyncio.gather(*senders)
+            except BaseException:
+                for task in senders:
+                    task.cancel()
+                raise
+            
+            # Limit broadcast size
+            if total >= self.max_broadcast_size and await run_db(next, users, None) is not None:
+                logging.warning(f"Broadcast limited to {self.max_broadcast_size} users")
+            
+            # Log delivered messages in one transaction
+            await run_db(self.db.log_messages_bulk, log_rows)
             
             # Update broadcast statistics
-            self.db.update_broadcast_stats(
+            await run_db(
+                self.db.update_broadcast_stats,
                 broadcast_id=broadcast_id,
-                total_recipients=len(users),
+                total_recipients=total,
                 successful_sends=successful_sends,
                 failed_sends=failed_sends
             )
@@ -174,11 +297,11 @@ class MessagingHandler:
             return {
                 'success': True,
                 'broadcast_id': broadcast_id,
-                'total': len(users),
+                'total': total,
                 'successful': successful_sends,
                 'failed': failed_sends,
                 'failed_users': failed_users,
-                'success_rate': (successful_sends / len(users)) * 100 if users else 0
+                'success_rate': (successful_sends / total) * 100 if total else 0
             }
             
         except Exception as e:
@@ -186,35 +309,20 @@ class MessagingHandler:
             return {
                 'success': False,
                 'error': str(e),
-                'total': len(users) if users else 0,
+                'total': 0,
                 'successful': 0,
                 'failed': 0
             }
     
-    async def _send_single_message(self, user_id: int, content: str, 
-                                  utm_source: str = None, utm_campaign: str = None):
-        """Send single message to user"""
-        try:
-            from telegram import Bot
-            bot = Bot(token=self.config['BOT_TOKEN'])
-            
-            await bot.send_message(
-                chat_id=user_id,
-                text=content,
-                parse_mode='Markdown'
-            )
-            
-            # Log message
-            self.db.log_message(
-                user_id=user_id,
-                message_type='broadcast',
-                content=content[:200],  # Truncate for storage
-                utm_source=utm_source,
-                utm_campaign=utm_campaign
-            )
-            
-        except Exception as e:
-            raise e  # Re-raise to be handled by caller
+    def _prepare_message(self, content: str, utm_source: str, utm_campaign: str) -> Tuple[dict, str]:
+        """Render content once for many sends: (send_message kwargs, log snippet)"""
+        processed = self._process_broadcast_content(content, utm_source, utm_campaign)
+        send_kwargs = {'text': processed, 'parse_mode': markdown_parse_mode(processed)}
+        return send_kwargs, processed[:200]  # Truncate for storage
+    
+    async def _send_single_message(self, user_id: int, send_kwargs: dict):
+        """Send single message to user, errors are handled by caller"""
+        await self._bot.send_message(chat_id=user_id, **send_kwargs)
     
     def _process_broadcast_content(self, content: str, utm_source: str, utm_campaign: str) -> str:
         """Process broadcast content - add UTM to links"""
@@ -222,18 +330,11 @@ class MessagingHandler:
             if not self.utm_tracking_enabled:
                 return content
             
-            # Find all URLs
-            url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-            urls = re.findall(url_pattern, content)
-            
-            processed_content = content
-            
-            # Replace each URL with UTM version
-            for url in urls:
-                utm_url = self._add_utm_parameters(url, utm_source, utm_campaign, 'telegram')
-                processed_content = processed_content.replace(url, utm_url)
-            
-            return processed_content
+            # Replace each URL with UTM version in a single pass
+            return URL_PATTERN.sub(
+                lambda match: self._add_utm_parameters(match.group(0), utm_source, utm_campaign, 'telegram'),
+                content
+            )
             
         except Exception as e:
             logging.error(f"Error processing broadcast content: {e}")
@@ -251,23 +352,20 @@ class MessagingHandler:
             if not welcome_message:
                 return
             
-            # Process welcome message (add UTM)
-            processed_message = self._process_broadcast_content(
-                welcome_message, 'welcome', 'auto_welcome'
-            )
+            # Process welcome message (add UTM), only again when the setting changes
+            if self._welcome_cache is None or self._welcome_cache[0] != welcome_message:
+                self._welcome_cache = (welcome_message, *self._prepare_message(welcome_message, 'welcome', 'auto_welcome'))
+            _, send_kwargs, log_content = self._welcome_cache
             
             # Send welcome message
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=processed_message,
-                parse_mode='Markdown'
-            )
+            await context.bot.send_message(chat_id=user_id, **send_kwargs)
             
             # Log welcome message
-            self.db.log_message(
+            await run_db(
+                self.db.log_message,
                 user_id=user_id,
                 message_type='welcome',
-                content=processed_message[:200],
+                content=log_content,
                 utm_source='welcome',
                 utm_campaign='auto_welcome'
             )
@@ -285,7 +383,8 @@ class MessagingHandler:
             utm_url = self._add_utm_parameters(original_url, utm_source or 'unknown', 
                                               utm_campaign or 'unknown')
             
-            self.db.log_link_click(
+            await run_db(
+                self.db.log_link_click,
                 user_id=user_id,
                 original_url=original_url,
                 utm_url=utm_url,
@@ -300,7 +399,12 @@ class MessagingHandler:
             logging.error(f"Error tracking link click: {e}")
     
     def get_broadcast_stats(self, days: int = 30) -> dict:
-        """Get broadcast statistics"""
+        """Get broadcast statistics, reused for STATS_CACHE_SECONDS"""
+        now = time.monotonic()
+        cached = self._stats_cache.get(days)
+        if cached and now - cached[0] < STATS_CACHE_SECONDS:
+            return cached[1]
+        
         try:
             message_stats = self.db.get_message_stats(days)
             click_stats = self.db.get_click_stats(days)
@@ -315,7 +419,7 @@ class MessagingHandler:
             if total_users > 0:
                 engagement_rate = (message_stats['unique_recipients'] / total_users) * 100
             
-            return {
+            stats = {
                 'messages': message_stats,
                 'clicks': click_stats,
                 'ctr_percent': round(ctr, 2),
@@ -325,6 +429,8 @@ class MessagingHandler:
                 ),
                 'total_users': total_users
             }
+            self._stats_cache[days] = (now, stats)
+            return stats
             
         except Exception as e:
             logging.error(f"Error getting broadcast stats: {e}")
@@ -339,14 +445,7 @@ class MessagingHandler:
             return False, f"Сообщение слишком длинное (максимум {self.config.get('MAX_MESSAGE_LENGTH', 4000)} символов)"
         
         # Check for spam patterns (basic)
-        spam_patterns = [
-            r'СРОЧНО!!!',
-            r'БЕСПЛАТНО!!!',
-            r'ТОЛЬКО СЕГОДНЯ!!!',
-        ]
-        
-        for pattern in spam_patterns:
-            if re.search(pattern, content, re.IGNORECASE):
-                return False, "Сообщение содержит спам-паттерны"
+        if _contains_spam(content):
+            return False, "Сообщение содержит спам-паттерны"
         
         return True, "Сообщение корректно"
@@ -5,77 +5,124 @@ User Bot Template - шаблон пользовательского бота
 
 import argparse
 import asyncio
+import importlib
 import json
 import logging
 import os
 import signal
 import sys
-import traceback
+import time
 from pathlib import Path
-from telegram import Update
+from telegram import Update, LinkPreviewOptions
 from telegram.ext import Application, CommandHandler, ChatJoinRequestHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 
+try:
+    import orjson  # optional: faster config parsing at bot startup
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    import uvloop  # optional: faster event loop for long polling (Linux/macOS)
+except ImportError:
+    uvloop = None
+
 # Add project root to Python path - CRITICAL FOR RENDER
 project_root = Path(__file__).parent.parent
-sys.path.insert(0, str(project_root))
+PROJECT_ROOT_STR = str(project_root)
+if PROJECT_ROOT_STR not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT_STR)
+
+# Reply to anyone but the owner writing to the bot in private
+NON_ADMIN_REPLY = (
+    "🤖 Этот бот предназначен для управления каналом.\n\n"
+    "Если вы хотите создать своего бота, обратитесь к @BotFactoryMasterBot"
+)
+NO_LINK_PREVIEW = LinkPreviewOptions(is_disabled=True)
 
-# EARLY LOGGING SETUP for debugging startup issues
-def setup_early_logging():
-    """Setup basic logging before we know the bot_id"""
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - UserBot - %(name)s - %(levelname)s - %(message)s',
-        force=True
-    )
+# Update types the registered handlers consume; Telegram doesn't send the rest
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_join_request']
 
-setup_early_logging()
-logging.info("🔄 UserBot main.py started, beginning imports...")
+# Keys every generated bot config must have
+REQUIRED_CONFIG_FIELDS = frozenset(('BOT_ID', 'BOT_TOKEN', 'BOT_USERNAME', 'ADMIN_CHAT_ID', 'DATABASE_PATH'))
 
 # Safe imports with detailed error handling
-def safe_import(module_name, description):
-    """Safely import a module with detailed logging"""
+def safe_import(module_name, attr_name):
+    """Safely import a class from a module with detailed logging"""
     try:
-        logging.info(f"🔄 Importing {description}...")
-        if module_name == "user_bot_template.database":
-            from user_bot_template.database import Database
-            logging.info(f"✅ Successfully imported {description}")
-            return Database
-        elif module_name == "user_bot_template.admin_panel":
-            from user_bot_template.admin_panel import AdminPanel
-            logging.info(f"✅ Successfully imported {description}")
-            return AdminPanel
-        elif module_name == "user_bot_template.handlers.admin_commands":
-            from user_bot_template.handlers.admin_commands import AdminCommandsHandler
-            logging.info(f"✅ Successfully imported {description}")
-            return AdminCommandsHandler
-        elif module_name == "user_bot_template.handlers.channel_events":
-            from user_bot_template.handlers.channel_events import ChannelEventsHandler
-            logging.info(f"✅ Successfully imported {description}")
-            return ChannelEventsHandler
-        elif module_name == "user_bot_template.handlers.messaging":
-            from user_bot_template.handlers.messaging import MessagingHandler
-            logging.info(f"✅ Successfully imported {description}")
-            return MessagingHandler
+        logging.debug("🔄 Importing %s...", attr_name)
+        component = getattr(importlib.import_module(module_name), attr_name)
+        logging.debug("✅ Successfully imported %s", attr_name)
+        return component
     except ImportError as e:
-        logging.error(f"❌ Failed to import {description}: {e}")
-        logging.error(f"Traceback: {traceback.format_exc()}")
-        logging.error(f"Python path: {sys.path}")
-        logging.error(f"Current working directory: {os.getcwd()}")
-        logging.error(f"Project root: {project_root}")
+        logging.error("❌ Failed to import %s: %s", attr_name, e, exc_info=True)
+        logging.error("Python path: %s", sys.path)
+        logging.error("Current working directory: %s", os.getcwd())
+        logging.error("Project root: %s", project_root)
         sys.exit(1)
     except Exception as e:
-        logging.error(f"❌ Unexpected error importing {description}: {e}")
-        logging.error(f"Traceback: {traceback.format_exc()}")
+        logging.error("❌ Unexpected error importing %s: %s", attr_name, e, exc_info=True)
         sys.exit(1)
 
-# Import all required modules
-Database = safe_import("user_bot_template.database", "Database")
-AdminPanel = safe_import("user_bot_template.admin_panel", "AdminPanel")
-AdminCommandsHandler = safe_import("user_bot_template.handlers.admin_commands", "AdminCommandsHandler")
-ChannelEventsHandler = safe_import("user_bot_template.handlers.channel_events", "ChannelEventsHandler")
-MessagingHandler = safe_import("user_bot_template.handlers.messaging", "MessagingHandler")
+# Bot components are imported on first use, so argument parsing doesn't
+# pay for the handler modules (--help-test imports them all on purpose)
+LAZY_COMPONENTS = {
+    'Database': "user_bot_template.database",
+    'AdminPanel': "user_bot_template.admin_panel",
+    'AdminCommandsHandler': "user_bot_template.handlers.admin_commands",
+    'ChannelEventsHandler': "user_bot_template.handlers.channel_events",
+    'MessagingHandler': "user_bot_template.handlers.messaging",
+}
+
+def load_component(name):
+    """Import a bot component class once and keep it as a module global"""
+    component = globals().get(name)
+    if component is None:
+        component = safe_import(LAZY_COMPONENTS[name], name)
+        globals()[name] = component
+    return component
+
+def __getattr__(name):
+    """Import bot component classes on first access (PEP 562)"""
+    if name in LAZY_COMPONENTS:
+        return load_component(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Write buffer for the per-bot log file; records reach disk in large writes
+LOG_FILE_BUFFER_SIZE = 256 * 1024
+# Max seconds a record may wait in the buffer (app.py serves this file live)
+LOG_FLUSH_INTERVAL = 2.0
+
+class BufferedFileHandler(logging.FileHandler):
+    """FileHandler that flushes on warnings or every few seconds, not after every record"""
+    
+    _last_flush = 0.0
+    
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=LOG_FILE_BUFFER_SIZE,
+                    encoding=self.encoding, errors=self.errors)
+    
+    def flush(self):
+        super().flush()
+        self._last_flush = time.monotonic()
+    
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            if (record.levelno >= logging.WARNING
+                    or time.monotonic() - self._last_flush >= LOG_FLUSH_INTERVAL):
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
 
-logging.info("✅ All imports completed successfully")
+def flush_log_handlers():
+    """Push buffered log records to disk"""
+    for handler in logging.getLogger().handlers:
+        handler.flush()
 
 def setup_bot_logging(bot_id):
     """Setup logging for specific bot with file output"""
@@ -92,16 +139,16 @@ def setup_bot_logging(bot_id):
             log_dir = Path(os.environ.get('RENDER_DISK_PATH', '/tmp')) / 'logs'
             log_dir.mkdir(exist_ok=True, parents=True)
             
-            file_handler = logging.FileHandler(log_dir / f"user_bot_{bot_id}_internal.log")
+            file_handler = BufferedFileHandler(log_dir / f"user_bot_{bot_id}_internal.log", encoding='utf-8')
             file_handler.setFormatter(logging.Formatter(
                 f'%(asctime)s - UserBot{bot_id} - %(name)s - %(levelname)s - %(message)s'
             ))
             
             logging.getLogger().addHandler(file_handler)
-            logging.info(f"✅ File logging enabled: {log_dir / f'user_bot_{bot_id}_internal.log'}")
+            logging.info("✅ File logging enabled: %s", log_dir / f'user_bot_{bot_id}_internal.log')
             
         except Exception as e:
-            logging.warning(f"⚠️ Could not setup file logging: {e}")
+            logging.warning("⚠️ Could not setup file logging: %s", e)
             
     except Exception as e:
         print(f"❌ Error setting up logging: {e}", file=sys.stderr)
@@ -118,14 +165,14 @@ class UserBot:
         self.messaging_handler = None
         self.application = None
         self.is_running = False
+        self._master_db = None
+        self._stop_event = asyncio.Event()
+        self._loop = None
         
-        # Setup logging first
-        setup_bot_logging(bot_id)
-        
-        logging.info(f"🔄 Initializing UserBot {bot_id}")
-        logging.info(f"📂 Config path: {config_path}")
-        logging.info(f"📂 Current working directory: {os.getcwd()}")
-        logging.info(f"📂 Project root: {project_root}")
+        logging.info("🔄 Initializing UserBot %s", bot_id)
+        logging.info("📂 Config path: %s", config_path)
+        logging.info("📂 Current working directory: %s", os.getcwd())
+        logging.info("📂 Project root: %s", project_root)
         
         # Load and validate configuration
         self._load_and_validate_config()
@@ -133,129 +180,129 @@ class UserBot:
         if not self.config:
             raise ValueError(f"Failed to load config from {config_path}")
         
+        self.admin_chat_id = int(self.config['ADMIN_CHAT_ID'])
+        
         # Initialize all components step by step
         self._initialize_components()
         
-        logging.info(f"✅ UserBot {bot_id} initialized successfully")
+        logging.info("✅ UserBot %s initialized successfully", bot_id)
     
     def _load_and_validate_config(self):
         """Load and validate bot configuration with detailed error handling"""
         try:
-            logging.info(f"🔄 Loading config from {self.config_path}")
-            
-            config_path_obj = Path(self.config_path)
+            logging.info("🔄 Loading config from %s", self.config_path)
             
-            # Check if file exists
-            if not config_path_obj.exists():
-                logging.error(f"❌ Config file does not exist: {self.config_path}")
-                logging.error(f"📂 Parent directory: {config_path_obj.parent}")
-                logging.error(f"📂 Parent exists: {config_path_obj.parent.exists()}")
-                if config_path_obj.parent.exists():
-                    logging.error(f"📂 Files in parent: {list(config_path_obj.parent.glob('*'))}")
+            # One unbuffered read instead of exists/access/stat checks, the OS reports what's wrong
+            try:
+                fd = os.open(self.config_path, os.O_RDONLY | os.O_CLOEXEC)
+                try:
+                    config_content = os.read(fd, os.fstat(fd).st_size)
+                finally:
+                    os.close(fd)
+            except FileNotFoundError:
+                parent = Path(self.config_path).parent
+                logging.error("❌ Config file does not exist: %s", self.config_path)
+                logging.error("📂 Parent directory: %s (exists: %s)", parent, parent.exists())
                 return
-            
-            # Check file permissions
-            if not os.access(config_path_obj, os.R_OK):
-                logging.error(f"❌ Config file is not readable: {self.config_path}")
+            except PermissionError:
+                logging.error("❌ Config file is not readable: %s", self.config_path)
+                return
+            except OSError as e:
+                logging.error("❌ Failed to read config file: %s", e)
                 return
             
-            # Get file size
-            file_size = config_path_obj.stat().st_size
-            logging.info(f"📄 Config file size: {file_size} bytes")
+            file_size = len(config_content)
+            logging.info("📄 Config file size: %s bytes", file_size)
             
             if file_size == 0:
-                logging.error(f"❌ Config file is empty: {self.config_path}")
+                logging.error("❌ Config file is empty: %s", self.config_path)
                 return
             
-            # Read file content
-            try:
-                with open(self.config_path, 'r', encoding='utf-8') as f:
-                    config_content = f.read()
-                logging.info(f"✅ Config file read successfully, content length: {len(config_content)}")
-                logging.info(f"📄 Config preview: {config_content[:200]}...")
-            except Exception as e:
-                logging.error(f"❌ Failed to read config file: {e}")
-                return
+            logging.debug("📄 Config preview: %.200r...", config_content)
             
             # Parse JSON
             try:
-                self.config = json.loads(config_content)
-                logging.info(f"✅ Config JSON parsed successfully")
-                logging.info(f"📋 Config keys: {list(self.config.keys())}")
+                self.config = _json_loads(config_content)
+                logging.debug("✅ Config JSON parsed successfully")
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("📋 Config keys: %s", list(self.config.keys()))
                 
                 # Validate required fields
-                required_fields = ['BOT_ID', 'BOT_TOKEN', 'BOT_USERNAME', 'ADMIN_CHAT_ID', 'DATABASE_PATH']
-                missing_fields = [field for field in required_fields if field not in self.config]
+                missing_fields = REQUIRED_CONFIG_FIELDS.difference(self.config)
                 
                 if missing_fields:
-                    logging.error(f"❌ Missing required config fields: {missing_fields}")
+                    logging.error("❌ Missing required config fields: %s", sorted(missing_fields))
                     return
                 
                 # Validate BOT_ID matches
                 if self.config['BOT_ID'] != self.bot_id:
-                    logging.error(f"❌ Config BOT_ID ({self.config['BOT_ID']}) does not match expected ({self.bot_id})")
+                    logging.error("❌ Config BOT_ID (%s) does not match expected (%s)", self.config['BOT_ID'], self.bot_id)
                     return
                 
                 # Validate bot token format
                 if ':' not in self.config['BOT_TOKEN']:
-                    logging.error(f"❌ Invalid bot token format")
+                    logging.error("❌ Invalid bot token format")
                     return
                 
-                logging.info(f"✅ Config validation passed")
-                logging.info(f"🤖 Bot: @{self.config['BOT_USERNAME']} (ID: {self.config['BOT_ID']})")
-                logging.info(f"👤 Admin: {self.config['ADMIN_CHAT_ID']}")
+                logging.info("✅ Config validation passed")
+                logging.info("🤖 Bot: @%s (ID: %s)", self.config['BOT_USERNAME'], self.config['BOT_ID'])
+                logging.info("👤 Admin: %s", self.config['ADMIN_CHAT_ID'])
                 
             except json.JSONDecodeError as e:
-                logging.error(f"❌ Invalid JSON in config file: {e}")
-                logging.error(f"📄 JSON error line: {e.lineno}, column: {e.colno}")
+                logging.error("❌ Invalid JSON in config file: %s", e)
+                logging.error("📄 JSON error line: %s, column: %s", e.lineno, e.colno)
                 return
                 
         except Exception as e:
-            logging.error(f"❌ Unexpected error loading config: {e}")
-            logging.error(f"Traceback: {traceback.format_exc()}")
+            logging.error("❌ Unexpected error loading config: %s", e, exc_info=True)
     
     def _initialize_components(self):
         """Initialize all bot components with error handling"""
         try:
-            logging.info(f"🔄 Initializing bot components...")
+            logging.debug("🔄 Initializing bot components...")
+            
+            Database = load_component('Database')
+            AdminPanel = load_component('AdminPanel')
+            AdminCommandsHandler = load_component('AdminCommandsHandler')
+            ChannelEventsHandler = load_component('ChannelEventsHandler')
+            MessagingHandler = load_component('MessagingHandler')
             
             # Initialize database
-            logging.info("🔄 Initializing Database...")
+            logging.debug("🔄 Initializing Database...")
             database_path = self.config['DATABASE_PATH']
-            logging.info(f"📂 Database path: {database_path}")
+            logging.info("📂 Database path: %s", database_path)
             
             # Check if database directory exists
             db_path_obj = Path(database_path)
             db_dir = db_path_obj.parent
             if not db_dir.exists():
-                logging.error(f"❌ Database directory does not exist: {db_dir}")
+                logging.error("❌ Database directory does not exist: %s", db_dir)
                 raise ValueError(f"Database directory does not exist: {db_dir}")
             
             self.db = Database(database_path)
-            logging.info("✅ Database initialized")
+            logging.debug("✅ Database initialized")
             
             # Initialize admin panel
-            logging.info("🔄 Initializing AdminPanel...")
+            logging.debug("🔄 Initializing AdminPanel...")
             self.admin_panel = AdminPanel(self.db, self.config)
-            logging.info("✅ AdminPanel initialized")
+            logging.debug("✅ AdminPanel initialized")
             
             # Initialize handlers
-            logging.info("🔄 Initializing handlers...")
+            logging.debug("🔄 Initializing handlers...")
             
             self.admin_handler = AdminCommandsHandler(self.db, self.config, self.admin_panel)
-            logging.info("✅ AdminCommandsHandler initialized")
+            logging.debug("✅ AdminCommandsHandler initialized")
             
             self.channel_handler = ChannelEventsHandler(self.db, self.config)
-            logging.info("✅ ChannelEventsHandler initialized")
+            logging.debug("✅ ChannelEventsHandler initialized")
             
             self.messaging_handler = MessagingHandler(self.db, self.config)
-            logging.info("✅ MessagingHandler initialized")
+            logging.debug("✅ MessagingHandler initialized")
             
             logging.info("✅ All components initialized successfully")
             
         except Exception as e:
-            logging.error(f"❌ Error initializing components: {e}")
-            logging.error(f"Traceback: {traceback.format_exc()}")
+            logging.error("❌ Error initializing components: %s", e, exc_info=True)
             raise
     
     async def setup_handlers(self):
@@ -265,7 +312,7 @@ class UserBot:
             return
         
         try:
-            logging.info("🔄 Setting up handlers...")
+            logging.debug("🔄 Setting up handlers...")
             
             # Admin commands (only for bot owner)
             self.application.add_handler(
@@ -286,9 +333,19 @@ class UserBot:
                 ChatJoinRequestHandler(self.channel_handler.handle_join_request)
             )
             
-            # Message handlers
+            # Message handlers, routed by PTB filters (first match wins)
+            text_messages = filters.TEXT & ~filters.COMMAND
+            self.application.add_handler(
+                MessageHandler(
+                    text_messages & filters.ChatType.PRIVATE & filters.User(user_id=self.admin_chat_id),
+                    self.admin_handler.handle_private_message
+                )
+            )
             self.application.add_handler(
-                MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message)
+                MessageHandler(text_messages & filters.ChatType.PRIVATE, self.handle_message)
+            )
+            self.application.add_handler(
+                MessageHandler(text_messages, self.messaging_handler.handle_channel_message)
             )
             
             # Callback query handler
@@ -296,131 +353,132 @@ class UserBot:
                 CallbackQueryHandler(self.handle_callback_query)
             )
             
-            logging.info(f"✅ Bot {self.bot_id} handlers setup complete")
+            # Errors raised by any handler are logged here
+            self.application.add_error_handler(self.handle_error)
+            
+            logging.info("✅ Bot %s handlers setup complete", self.bot_id)
             
         except Exception as e:
-            logging.error(f"❌ Error setting up handlers: {e}")
-            logging.error(f"Traceback: {traceback.format_exc()}")
+            logging.error("❌ Error setting up handlers: %s", e, exc_info=True)
             raise
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle text messages"""
-        try:
-            # Route to appropriate handler based on chat type
-            if update.effective_chat.type == 'private':
-                # Private message - route to admin handler if from owner
-                if update.effective_user.id == self.config['ADMIN_CHAT_ID']:
-                    await self.admin_handler.handle_private_message(update, context)
-                else:
-                    # Non-admin user in private chat
-                    await update.message.reply_text(
-                        "🤖 Этот бот предназначен для управления каналом.\n\n"
-                        "Если вы хотите создать своего бота, обратитесь к @BotFactoryMasterBot"
-                    )
-            else:
-                # Group/channel message
-                await self.messaging_handler.handle_channel_message(update, context)
-        except Exception as e:
-            logging.error(f"❌ Error handling message: {e}")
+        """Handle private text messages from non-admin users"""
+        await update.message.reply_text(NON_ADMIN_REPLY, link_preview_options=NO_LINK_PREVIEW)
     
     async def handle_callback_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle callback queries"""
-        try:
-            query = update.callback_query
-            
-            # Only admin can use callback queries
-            if query.from_user.id != self.config['ADMIN_CHAT_ID']:
-                await query.answer("❌ У вас нет прав для этого действия")
-                return
-            
-            await self.admin_handler.handle_callback_query(update, context)
-        except Exception as e:
-            logging.error(f"❌ Error handling callback query: {e}")
+        query = update.callback_query
+        
+        # Only admin can use callback queries
+        if query.from_user.id != self.admin_chat_id:
+            await query.answer("❌ У вас нет прав для этого действия")
+            return
+        
+        await self.admin_handler.handle_callback_query(update, context)
+    
+    async def handle_error(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        """Log exceptions raised while handling updates"""
+        logging.error("❌ Error handling update: %s", context.error, exc_info=context.error)
     
     async def start_bot(self):
         """Start the bot with comprehensive error handling"""
+        self._loop = asyncio.get_running_loop()
         try:
             bot_token = self.config['BOT_TOKEN']
-            logging.info(f"🔄 Creating application for bot {self.bot_id}")
-            logging.info(f"🤖 Bot token: {bot_token[:20]}...{bot_token[-10:]}")
+            logging.info("🔄 Creating application for bot %s", self.bot_id)
+            logging.info("🤖 Bot token: %s...%s", bot_token[:20], bot_token[-10:])
             
             # Create application
-            self.application = Application.builder().token(bot_token).build()
-            logging.info("✅ Application created")
+            builder = Application.builder().token(bot_token)
+            self.application = self.admin_handler.configure_pool(builder).build()
+            logging.debug("✅ Application created")
             
             # Setup handlers
             await self.setup_handlers()
-            logging.info("✅ Handlers setup complete")
+            logging.debug("✅ Handlers setup complete")
             
-            logging.info(f"🚀 Starting bot {self.bot_id} (@{self.config.get('BOT_USERNAME', 'unknown')})")
+            logging.info("🚀 Starting bot %s (@%s)", self.bot_id, self.config.get('BOT_USERNAME', 'unknown'))
             
             # Update bot status in master database
             self._update_master_status('active')
             
             # Initialize and start the application
-            logging.info("🔄 Initializing application...")
+            logging.debug("🔄 Initializing application...")
             await self.application.initialize()
-            logging.info("✅ Application initialized")
+            logging.debug("✅ Application initialized")
             
-            logging.info("🔄 Starting application...")
+            logging.debug("🔄 Starting application...")
             await self.application.start()
-            logging.info("✅ Application started")
+            logging.debug("✅ Application started")
             
             # Start polling
             self.is_running = True
-            logging.info("🔄 Starting polling...")
-            await self.application.updater.start_polling(drop_pending_updates=True)
+            logging.debug("🔄 Starting polling...")
+            await self.application.updater.start_polling(
+                drop_pending_updates=self.config.get('DROP_PENDING_UPDATES', True),
+                allowed_updates=ALLOWED_UPDATES
+            )
             logging.info("✅ Polling started successfully")
             
             # Keep the bot running
             logging.info("🔄 Bot is now running, waiting for updates...")
             
-            # Wait indefinitely (compatible with all telegram-bot versions)
-            try:
-                # Try modern approach first
-                if hasattr(self.application, 'idle'):
-                    await self.application.idle()
-                else:
-                    # Fallback for older versions
-                    import asyncio
-                    while self.is_running:
-                        await asyncio.sleep(1)
-            except Exception as e:
-                logging.error(f"❌ Error in main loop: {e}")
-                # Fallback: simple infinite loop
-                while self.is_running:
-                    await asyncio.sleep(1)
+            # PTB 21 Application has no idle(); sleep until stop() is called
+            await self._stop_event.wait()
             
         except Exception as e:
-            logging.error(f"❌ Error starting bot {self.bot_id}: {e}")
-            logging.error(f"Traceback: {traceback.format_exc()}")
+            logging.error("❌ Error starting bot %s: %s", self.bot_id, e, exc_info=True)
             self._update_master_status('error', str(e))
             raise
         finally:
             # Cleanup
             self.is_running = False
+            # Separate steps so one failure doesn't skip the rest
             if self.application:
                 try:
                     logging.info("🔄 Stopping application...")
-                    await self.application.stop()
+                    # Updater must stop first or shutdown() refuses to run
+                    if self.application.updater and self.application.updater.running:
+                        await self.application.updater.stop()
+                    if self.application.running:
+                        await self.application.stop()
                     await self.application.shutdown()
                     logging.info("✅ Application stopped")
                 except Exception as e:
-                    logging.error(f"❌ Error during cleanup: {e}")
+                    logging.error("❌ Error stopping application: %s", e)
+            
+            if self.messaging_handler:
+                try:
+                    await self.messaging_handler.close()
+                except Exception as e:
+                    logging.error("❌ Error closing messaging handler: %s", e)
+            
+            if self.db:
+                try:
+                    self.db.close()
+                except Exception as e:
+                    logging.error("❌ Error closing database: %s", e)
+    
+    def stop(self):
+        """Ask the running bot to shut down, safe to call from a signal handler"""
+        self.is_running = False
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
     
     def _update_master_status(self, status: str, error_message: str = None):
         """Update bot status in master database"""
         try:
-            # Import here to avoid circular dependencies
-            sys.path.insert(0, str(project_root))
-            from master_bot.database import MasterDatabase
+            # Opened on first use and reused (project root is on sys.path from module load)
+            if self._master_db is None:
+                from master_bot.database import MasterDatabase
+                self._master_db = MasterDatabase()
             
-            master_db = MasterDatabase()
-            master_db.update_bot_status(self.bot_id, status, error_message)
-            logging.info(f"✅ Updated master status to: {status}")
+            self._master_db.update_bot_status(self.bot_id, status, error_message)
+            logging.info("✅ Updated master status to: %s", status)
             
         except Exception as e:
-            logging.error(f"❌ Failed to update master status: {e}")
+            logging.error("❌ Failed to update master status: %s", e)
     
     async def health_check(self):
         """Periodic health check"""
@@ -433,125 +491,110 @@ class UserBot:
                 await asyncio.sleep(self.config.get('HEALTH_CHECK_INTERVAL', 300))
                 
             except Exception as e:
-                logging.error(f"❌ Health check error: {e}")
+                logging.error("❌ Health check error: %s", e)
                 await asyncio.sleep(60)  # Wait 1 minute before retry
 
 def parse_arguments():
-    """Parse command line arguments with validation"""
-    try:
-        logging.info("🔄 Parsing command line arguments...")
-        
-        parser = argparse.ArgumentParser(description='User Bot Template')
-        parser.add_argument('--config', required=True, help='Path to bot configuration file')
-        parser.add_argument('--bot-id', required=True, type=int, help='Bot ID')
-        parser.add_argument('--help-test', action='store_true', help='Test help functionality')
-        
-        args = parser.parse_args()
-        
-        logging.info(f"✅ Arguments parsed successfully:")
-        logging.info(f"  - config: {args.config}")
-        logging.info(f"  - bot-id: {args.bot_id}")
-        logging.info(f"  - help-test: {args.help_test}")
-        
-        return args
-        
-    except SystemExit as e:
-        # This happens when --help is used or arguments are invalid
-        logging.info(f"🔄 Argument parsing resulted in SystemExit: {e.code}")
-        sys.exit(e.code)
-    except Exception as e:
-        logging.error(f"❌ Error parsing arguments: {e}")
-        logging.error(f"Traceback: {traceback.format_exc()}")
-        sys.exit(1)
+    """Parse command line arguments, argparse exits on --help or bad input"""
+    parser = argparse.ArgumentParser(description='User Bot Template')
+    parser.add_argument('--config', required=True, help='Path to bot configuration file')
+    parser.add_argument('--bot-id', required=True, type=int, help='Bot ID')
+    # Used by the process manager to dry-run the command before the real start
+    parser.add_argument('--help-test', action='store_true', help='Test help functionality')
+    
+    args = parser.parse_args()
+    logging.debug("✅ Arguments parsed: config=%s, bot-id=%s, help-test=%s",
+                  args.config, args.bot_id, args.help_test)
+    return args
 
 def validate_environment():
     """Validate runtime environment"""
     try:
-        logging.info("🔄 Validating environment...")
+        logging.debug("🔄 Validating environment...")
         
         # Check Python version
-        logging.info(f"🐍 Python version: {sys.version}")
-        logging.info(f"🐍 Python executable: {sys.executable}")
+        logging.info("🐍 Python version: %s", sys.version)
+        logging.info("🐍 Python executable: %s", sys.executable)
         
         # Check current working directory
-        logging.info(f"📂 Current working directory: {os.getcwd()}")
-        logging.info(f"📂 Project root: {project_root}")
+        logging.info("📂 Current working directory: %s", os.getcwd())
+        logging.info("📂 Project root: %s", project_root)
         
         # Check PYTHONPATH
-        logging.info(f"📂 PYTHONPATH: {os.environ.get('PYTHONPATH', 'Not set')}")
-        logging.info(f"📂 sys.path (first 5): {sys.path[:5]}")
+        logging.info("📂 PYTHONPATH: %s", os.environ.get('PYTHONPATH', 'Not set'))
+        logging.info("📂 sys.path (first 5): %s", sys.path[:5])
         
         # Check data directory
         data_dir = os.environ.get('RENDER_DISK_PATH', '/data')
-        logging.info(f"📂 Data directory: {data_dir}")
-        logging.info(f"📂 Data directory exists: {Path(data_dir).exists()}")
+        logging.info("📂 Data directory: %s", data_dir)
+        logging.info("📂 Data directory exists: %s", Path(data_dir).exists())
         
-        logging.info("✅ Environment validation complete")
+        logging.debug("✅ Environment validation complete")
         
     except Exception as e:
-        logging.error(f"❌ Error validating environment: {e}")
-        logging.error(f"Traceback: {traceback.format_exc()}")
+        logging.error("❌ Error validating environment: %s", e, exc_info=True)
 
 def main():
     """Main entry point for user bot with comprehensive error handling"""
     try:
-        logging.info(f"🚀 Starting UserBot main function")
-        logging.info(f"📋 Command line: {' '.join(sys.argv)}")
-        
-        # Validate environment
-        validate_environment()
-        
-        # Parse arguments
+        # Parse arguments (argparse needs no logging)
         args = parse_arguments()
         
         # Handle help test
         if args.help_test:
-            logging.info("✅ Help test successful")
+            # Preflight for process_manager: fail here if any component can't be imported
+            for name in LAZY_COMPONENTS:
+                load_component(name)
             print("✅ User bot help test successful")
             return
         
+        # Configure logging once, now that bot_id is known
+        setup_bot_logging(args.bot_id)
+        logging.info("🚀 Starting UserBot main function")
+        logging.info("📋 Command line: %s", ' '.join(sys.argv))
+        
+        # Validate environment
+        validate_environment()
+        
         # Validate config file exists
         config_path = Path(args.config)
         if not config_path.exists():
             error_msg = f"Config file not found: {args.config}"
-            logging.error(f"❌ {error_msg}")
+            logging.error("❌ %s", error_msg)
             print(f"Error: {error_msg}", file=sys.stderr)
             sys.exit(1)
         
-        logging.info(f"✅ Config file exists: {config_path}")
+        logging.info("✅ Config file exists: %s", config_path)
         
         # Create bot instance
-        logging.info(f"🔄 Creating UserBot instance...")
+        logging.debug("🔄 Creating UserBot instance...")
         bot = UserBot(str(config_path), args.bot_id)
-        logging.info(f"✅ UserBot instance created")
+        logging.debug("✅ UserBot instance created")
         
         # Setup signal handlers for graceful shutdown
         def signal_handler(signum, frame):
-            logging.info(f"📡 Received signal {signum}, shutting down...")
-            bot.is_running = False
-            if bot.application:
-                # Create task to stop application
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    loop.create_task(bot.application.stop())
-                else:
-                    asyncio.run(bot.application.stop())
+            logging.info("📡 Received signal %s, shutting down...", signum)
+            flush_log_handlers()
+            # start_bot wakes up and stops the application in its cleanup
+            bot.stop()
         
         signal.signal(signal.SIGTERM, signal_handler)
         signal.signal(signal.SIGINT, signal_handler)
         
         # Run bot
-        logging.info(f"🚀 Starting UserBot {args.bot_id} main loop...")
+        if uvloop:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logging.info("⚡ Using uvloop event loop")
+        logging.info("🚀 Starting UserBot %s main loop...", args.bot_id)
         asyncio.run(bot.start_bot())
         
     except KeyboardInterrupt:
         logging.info("🛑 Bot stopped by user (KeyboardInterrupt)")
     except SystemExit as e:
-        logging.info(f"🛑 Bot stopped with SystemExit: {e.code}")
+        logging.info("🛑 Bot stopped with SystemExit: %s", e.code)
         sys.exit(e.code)
     except Exception as e:
-        logging.error(f"❌ Fatal error in main: {e}")
-        logging.error(f"Traceback: {traceback.format_exc()}")
+        logging.error("❌ Fatal error in main: %s", e, exc_info=True)
         print(f"Fatal error: {e}", file=sys.stderr)
         sys.exit(1)
 
@@ -2,25 +2,78 @@
 Scheduler - планировщик для автоматических и массовых рассылок
 """
 
+import json
+import time
 import asyncio
 import logging
+from itertools import islice
 from datetime import datetime, timedelta
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+from telegram.error import TelegramError, RetryAfter, Forbidden
 from typing import Dict, List
-from .utm_utils import process_text_links, create_tracking_link
+from .utm_utils import process_text_links, create_tracking_link, build_utm_template, UTM_ID_PLACEHOLDER
+
+from shared.constants import BROADCAST_CONCURRENCY
+from shared.database_utils import run_db
+from shared.telegram_utils import get_bucket, HTTP2_AVAILABLE
+
+# Enough keep-alive connections for every in-flight send
+BROADCAST_POOL_SIZE = BROADCAST_CONCURRENCY + 4
+BROADCAST_READ_TIMEOUT = 20
+
+# Recipients pulled from the database per round of sends
+RECIPIENT_FETCH_SIZE = 1000
+
+# Due messages fetched per scheduler pass; the rest wait for the next one
+DUE_MESSAGES_BATCH = 500
+
+# Tries per recipient when Telegram answers with flood control (429)
+SEND_ATTEMPTS = 3
+
+# How long the broadcast on/off status is reused between scheduler passes
+BROADCAST_STATUS_TTL = 60
+
+# Users who blocked the bot are skipped for this long before being tried again
+BLOCKED_RETRY_SECONDS = 24 * 60 * 60
+
+BROADCAST_COMPLETE_TEMPLATE = """
+📢 **Рассылка #{broadcast_id} завершена**
+
+📊 **Результаты:**
+• Всего получателей: {total}
+• Доставлено: {successful}
+• Ошибок: {failed}
+• Успешность: {success_pct:.1f}%
+
+🕐 Время: {sent_time}
+"""
 
 class MessageScheduler:
     def __init__(self, bot_token: str, database, config: dict):
-        self.bot = Bot(token=bot_token)
+        self._request = HTTPXRequest(
+            connection_pool_size=BROADCAST_POOL_SIZE,
+            read_timeout=BROADCAST_READ_TIMEOUT,
+            http_version="2" if HTTP2_AVAILABLE else "1.1"
+        )
+        self.bot = Bot(token=bot_token, request=self._request)
         self.db = database
         self.config = config
         self.running = False
-        self.check_interval = 30  # секунд
+        self.check_interval = 30  # секунд, максимум между проверками
+        # Set by producers so new work is picked up without waiting out the interval
+        self._wakeup = asyncio.Event()
+        # Shared by all broadcasts so they stay under Telegram's global limit together
+        self._limiter = get_bucket(bot_token)
+        self._broadcast_status = None
+        self._broadcast_status_at = 0.0
+        self._resume_ts = (None, 0.0)  # (raw auto_resume_time, epoch seconds)
+        self._blocked_until: Dict[int, float] = {}  # user_id -> monotonic retry time
         
     async def start(self):
         """Start the scheduler"""
         self.running = True
+        await run_db(self._ensure_indexes)
         logging.info("🕐 Message scheduler started")
         
         while self.running:
@@ -29,7 +82,12 @@ class MessageScheduler:
                 await self._check_scheduled_broadcasts()
                 await self._check_broadcast_status()
                 
-                await asyncio.sleep(self.check_interval)
+                timeout = await run_db(self._seconds_until_next_message)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
                 
             except Exception as e:
                 logging.error(f"❌ Scheduler error: {e}")
@@ -38,16 +96,89 @@ class MessageScheduler:
     def stop(self):
         """Stop the scheduler"""
         self.running = False
+        self._wakeup.set()
         logging.info("🛑 Message scheduler stopped")
     
+    def _ensure_indexes(self):
+        """Index the due-message lookup so it doesn't scan the whole table"""
+        try:
+            with self.db.get_connection() as conn:
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_sched_status_time
+                    ON scheduled_user_messages(status, scheduled_at)
+                ''')
+                conn.commit()
+        except Exception as e:
+            logging.error(f"❌ Error creating scheduler indexes: {e}")
+    
+    def _get_due_messages(self, limit: int = DUE_MESSAGES_BATCH) -> List[Dict]:
+        """Get scheduled messages whose time has come, oldest first"""
+        with self.db.get_connection() as conn:
+            cursor = conn.execute('''
+                SELECT s.*, m.text, m.photo_url
+                FROM scheduled_user_messages s
+                JOIN broadcast_messages m ON m.message_number = s.message_number
+                WHERE s.status = 'scheduled' AND s.scheduled_at <= ?
+                ORDER BY s.scheduled_at
+                LIMIT ?
+            ''', (datetime.now(), limit))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    async def close(self):
+        """Close scheduler bot connections"""
+        # The bot is never initialize()d, so Bot.shutdown() would be a no-op
+        await self._request.shutdown()
+    
+    def _is_blocked(self, user_id: int) -> bool:
+        """Check if user recently blocked the bot"""
+        until = self._blocked_until.get(user_id)
+        if until is None:
+            return False
+        if time.monotonic() < until:
+            return True
+        del self._blocked_until[user_id]
+        return False
+    
+    def _remember_blocked(self, user_id: int):
+        """Skip sends to user until BLOCKED_RETRY_SECONDS pass"""
+        self._blocked_until[user_id] = time.monotonic() + BLOCKED_RETRY_SECONDS
+    
+    def wake(self):
+        """Run the next check now instead of waiting for the timeout"""
+        self._wakeup.set()
+    
+    def _seconds_until_next_message(self) -> float:
+        """Sleep time until the earliest scheduled message, capped by check_interval"""
+        try:
+            with self.db.get_connection() as conn:
+                row = conn.execute('''
+                    SELECT MIN(scheduled_at) FROM scheduled_user_messages
+                    WHERE status = 'scheduled'
+                ''').fetchone()
+            
+            if not row or row[0] is None:
+                return self.check_interval
+            
+            next_at = row[0] if isinstance(row[0], datetime) else datetime.fromisoformat(row[0])
+            delay = (next_at - datetime.now()).total_seconds()
+            return min(self.check_interval, max(1, delay))
+            
+        except Exception as e:
+            logging.error(f"❌ Error reading next scheduled time: {e}")
+            return self.check_interval
+    
     async def _check_scheduled_messages(self):
         """Check and send scheduled user messages"""
         try:
-            scheduled_messages = self.db.get_scheduled_messages('scheduled')
+            scheduled_messages = await run_db(self._get_due_messages)
             
             if not scheduled_messages:
                 return
             
+            if len(scheduled_messages) == DUE_MESSAGES_BATCH:
+                # Backlog left over, come straight back for it
+                self.wake()
+            
             logging.info(f"📝 Found {len(scheduled_messages)} scheduled messages to send")
             
             for msg in scheduled_messages:
@@ -67,6 +198,10 @@ class MessageScheduler:
             user_id = msg['user_id']
             message_number = msg['message_number']
             
+            if self._is_blocked(user_id):
+                await self._mark_message_failed(msg['id'], "User blocked bot")
+                return
+            
             # Get message content
             text = msg['text']
             photo_url = msg.get('photo_url')
@@ -79,7 +214,7 @@ class MessageScheduler:
             )
             
             # Get message buttons
-            buttons = self.db.get_message_buttons(message_number)
+            buttons = await run_db(self.db.get_message_buttons, message_number)
             reply_markup = None
             
             if buttons:
@@ -116,10 +251,11 @@ class MessageScheduler:
                 )
             
             # Mark as sent
-            self.db.mark_message_sent(msg['id'])
+            await run_db(self.db.mark_message_sent, msg['id'])
             
             # Log message
-            self.db.log_message(
+            await run_db(
+                self.db.log_message,
                 user_id=user_id,
                 message_type='auto_message',
                 content=processed_text[:200],
@@ -129,16 +265,14 @@ class MessageScheduler:
             
             logging.info(f"✅ Sent scheduled message {msg['id']} to user {user_id}")
             
-        except TelegramError as e:
-            if "blocked by the user" in str(e).lower():
-                logging.warning(f"⚠️ User {user_id} blocked the bot, marking message as failed")
-                await self._mark_message_failed(msg['id'], "User blocked bot")
-            else:
-                raise e
+        except Forbidden:
+            self._remember_blocked(user_id)
+            logging.warning(f"⚠️ User {user_id} blocked the bot, marking message as failed")
+            await self._mark_message_failed(msg['id'], "User blocked bot")
     
     async def _mark_message_failed(self, message_id: int, error_msg: str):
         """Mark scheduled message as failed"""
-        try:
+        def mark_failed():
             with self.db.get_connection() as conn:
                 conn.execute('''
                     UPDATE scheduled_user_messages 
@@ -146,6 +280,9 @@ class MessageScheduler:
                     WHERE id = ?
                 ''', (message_id,))
                 conn.commit()
+        
+        try:
+            await run_db(mark_failed)
                 
             logging.warning(f"⚠️ Marked message {message_id} as failed: {error_msg}")
             
@@ -155,7 +292,7 @@ class MessageScheduler:
     async def _check_scheduled_broadcasts(self):
         """Check and send scheduled broadcasts"""
         try:
-            broadcasts = self.db.get_scheduled_broadcasts()
+            broadcasts = await run_db(self.db.get_scheduled_broadcasts)
             
             if not broadcasts:
                 return
@@ -171,6 +308,15 @@ class MessageScheduler:
         except Exception as e:
             logging.error(f"❌ Error checking scheduled broadcasts: {e}")
     
+    def _get_broadcast_buttons(self, broadcast_id: int) -> List[Dict]:
+        """Get buttons attached to a scheduled broadcast"""
+        with self.db.get_connection() as conn:
+            cursor = conn.execute('''
+                SELECT * FROM scheduled_broadcast_buttons 
+                WHERE broadcast_id = ? ORDER BY position
+            ''', (broadcast_id,))
+            return [dict(row) for row in cursor.fetchall()]
+    
     async def _send_scheduled_broadcast(self, broadcast: dict):
         """Send scheduled broadcast to all users"""
         try:
@@ -178,102 +324,130 @@ class MessageScheduler:
             message_text = broadcast['message_text']
             photo_url = broadcast.get('photo_url')
             
-            # Get all active users
-            users = self.db.get_active_users()
+            # Stream recipients instead of loading the whole audience
+            users = self.db.iter_active_users()
+            batch = await run_db(list, islice(users, RECIPIENT_FETCH_SIZE))
             
-            if not users:
+            if not batch:
                 logging.warning(f"⚠️ No active users for broadcast {broadcast_id}")
-                self.db.mark_broadcast_sent(broadcast_id)
+                await run_db(self.db.mark_broadcast_sent, broadcast_id)
                 return
             
-            logging.info(f"📢 Sending broadcast {broadcast_id} to {len(users)} users")
+            logging.info(f"📢 Sending broadcast {broadcast_id}")
             
             successful_sends = 0
             failed_sends = 0
             
             # Get broadcast buttons if any
-            buttons = []
-            with self.db.get_connection() as conn:
-                cursor = conn.execute('''
-                    SELECT * FROM scheduled_broadcast_buttons 
-                    WHERE broadcast_id = ? ORDER BY position
-                ''', (broadcast_id,))
-                buttons = [dict(row) for row in cursor.fetchall()]
+            buttons = await run_db(self._get_broadcast_buttons, broadcast_id)
             
-            # Send to each user
-            for user in users:
-                try:
+            # Parse the links once; only utm_id differs between users
+            text_template, personalized = build_utm_template(
+                message_text,
+                source='scheduled_broadcast',
+                campaign=f'broadcast_{broadcast_id}'
+            )
+            btn_templates = [
+                (button['button_text'], create_tracking_link(
+                    button['button_url'],
+                    UTM_ID_PLACEHOLDER,
+                    'scheduled_broadcast',
+                    button['button_text']
+                ))
+                for button in buttons
+            ]
+            
+            # Serialize the keyboard once; PTB sends string markup as-is, so each
+            # recipient only needs its utm_id filled in (or nothing, if no slot)
+            keyboard_json = None
+            if btn_templates:
+                keyboard_json = json.dumps({
+                    'inline_keyboard': [[{'text': text, 'url': template}] for text, template in btn_templates]
+                }, ensure_ascii=False)
+            keyboard_personalized = keyboard_json is not None and UTM_ID_PLACEHOLDER in keyboard_json
+            
+            utm_campaign = f'broadcast_{broadcast_id}'
+            log_rows = []
+            semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+            
+            async def send_one(user):
+                async with semaphore:
                     user_id = user['user_id']
                     
-                    # Process UTM links for this user
-                    processed_text = process_text_links(
-                        message_text, user_id,
-                        source='scheduled_broadcast',
-                        campaign=f'broadcast_{broadcast_id}'
+                    processed_text = (
+                        text_template.replace(UTM_ID_PLACEHOLDER, str(user_id))
+                        if personalized else text_template
                     )
                     
-                    reply_markup = None
-                    if buttons:
-                        # Create inline keyboard
-                        keyboard = []
-                        for button in buttons:
-                            tracking_url = create_tracking_link(
-                                button['button_url'],
-                                user_id,
-                                'scheduled_broadcast',
-                                button['button_text']
-                            )
-                            keyboard.append([InlineKeyboardButton(
-                                button['button_text'],
-                                url=tracking_url
-                            )])
-                        reply_markup = InlineKeyboardMarkup(keyboard)
+                    reply_markup = (
+                        keyboard_json.replace(UTM_ID_PLACEHOLDER, str(user_id))
+                        if keyboard_personalized else keyboard_json
+                    )
                     
                     # Send message
-                    if photo_url:
-                        await self.bot.send_photo(
-                            chat_id=user_id,
-                            photo=photo_url,
-                            caption=processed_text,
-                            reply_markup=reply_markup,
-                            parse_mode='Markdown'
-                        )
-                    else:
-                        await self.bot.send_message(
-                            chat_id=user_id,
-                            text=processed_text,
-                            reply_markup=reply_markup,
-                            parse_mode='Markdown'
-                        )
-                    
-                    successful_sends += 1
+                    for attempt in range(SEND_ATTEMPTS):
+                        await self._limiter.acquire()
+                        try:
+                            if photo_url:
+                                await self.bot.send_photo(
+                                    chat_id=user_id,
+                                    photo=photo_url,
+                                    caption=processed_text,
+                                    reply_markup=reply_markup,
+                                    parse_mode='Markdown'
+                                )
+                            else:
+                                await self.bot.send_message(
+                                    chat_id=user_id,
+                                    text=processed_text,
+                                    reply_markup=reply_markup,
+                                    parse_mode='Markdown'
+                                )
+                            break
+                        except RetryAfter as e:
+                            if attempt == SEND_ATTEMPTS - 1:
+                                raise
+                            # Flood control hit, wait as told and retry
+                            await asyncio.sleep(e.retry_after)
                     
-                    # Log message
-                    self.db.log_message(
-                        user_id=user_id,
-                        message_type='scheduled_broadcast',
-                        content=processed_text[:200],
-                        utm_source='scheduled_broadcast',
-                        utm_campaign=f'broadcast_{broadcast_id}'
-                    )
-                    
-                    # Small delay to avoid rate limits
-                    await asyncio.sleep(0.1)
+                    log_rows.append((user_id, 'scheduled_broadcast', processed_text[:200], 'scheduled_broadcast', utm_campaign))
+            
+            # Send each chunk concurrently, paced by the shared rate limiter
+            while batch:
+                # Known-blocked chats would only answer 403, don't spend a request on them
+                recipients = [user for user in batch if not self._is_blocked(user['user_id'])]
+                failed_sends += len(batch) - len(recipients)
+                
+                results = await asyncio.gather(*(send_one(user) for user in recipients), return_exceptions=True)
+                
+                for user, error in zip(recipients, results):
+                    if error is None:
+                        successful_sends += 1
+                        continue
                     
-                except TelegramError as e:
                     failed_sends += 1
-                    if "blocked by the user" not in str(e).lower():
-                        logging.warning(f"⚠️ Failed to send to user {user['user_id']}: {e}")
+                    if isinstance(error, Forbidden):
+                        # Blocked the bot or left, expected during broadcasts
+                        self._remember_blocked(user['user_id'])
+                        continue
+                    if isinstance(error, TelegramError):
+                        logging.warning(f"⚠️ Failed to send to user {user['user_id']}: {error}")
+                    else:
+                        logging.error(f"❌ Error sending to user {user['user_id']}: {error}")
                 
-                except Exception as e:
-                    failed_sends += 1
-                    logging.error(f"❌ Error sending to user {user['user_id']}: {e}")
+                batch = await run_db(list, islice(users, RECIPIENT_FETCH_SIZE))
+            
+            total_recipients = successful_sends + failed_sends
+            
+            # Log delivered messages in one transaction
+            await run_db(self.db.log_messages_bulk, log_rows)
             
             # Mark broadcast as sent
-            self.db.mark_broadcast_sent(broadcast_id)
+            await run_db(self.db.mark_broadcast_sent, broadcast_id)
             
             # Create broadcast record for statistics
-            broadcast_record_id = self.db.create_broadcast(
+            broadcast_record_id = await run_db(
+                self.db.create_broadcast,
                 title=f"Scheduled Broadcast {broadcast_id}",
                 content=message_text,
                 utm_source='scheduled_broadcast',
@@ -281,9 +455,10 @@ class MessageScheduler:
             )
             
             # Update statistics
-            self.db.update_broadcast_stats(
+            await run_db(
+                self.db.update_broadcast_stats,
                 broadcast_id=broadcast_record_id,
-                total_recipients=len(users),
+                total_recipients=total_recipients,
                 successful_sends=successful_sends,
                 failed_sends=failed_sends
             )
@@ -292,7 +467,7 @@ class MessageScheduler:
             
             # Notify admin
             await self._notify_admin_broadcast_complete(
-                broadcast_id, len(users), successful_sends, failed_sends
+                broadcast_id, total_recipients, successful_sends, failed_sends
             )
             
         except Exception as e:
@@ -304,17 +479,14 @@ class MessageScheduler:
         try:
             admin_chat_id = self.config['ADMIN_CHAT_ID']
             
-            message = f"""
-📢 **Рассылка #{broadcast_id} завершена**
-
-📊 **Результаты:**
-• Всего получателей: {total}
-• Доставлено: {successful}
-• Ошибок: {failed}
-• Успешность: {(successful/total*100):.1f}%
-
-🕐 Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}
-"""
+            message = BROADCAST_COMPLETE_TEMPLATE.format(
+                broadcast_id=broadcast_id,
+                total=total,
+                successful=successful,
+                failed=failed,
+                success_pct=successful * 100 / total if total else 0.0,
+                sent_time=time.strftime('%H:%M %d.%m.%Y')
+            )
             
             await self.bot.send_message(
                 chat_id=admin_chat_id,
@@ -328,14 +500,22 @@ class MessageScheduler:
     async def _check_broadcast_status(self):
         """Check if broadcasts should be auto-resumed"""
         try:
-            status = self.db.get_broadcast_status()
-            
-            if not status['enabled'] and status['auto_resume_time']:
-                resume_time = datetime.fromisoformat(status['auto_resume_time'])
+            now = time.monotonic()
+            if self._broadcast_status is None or now - self._broadcast_status_at >= BROADCAST_STATUS_TTL:
+                self._broadcast_status = await run_db(self.db.get_broadcast_status)
+                self._broadcast_status_at = now
+            status = self._broadcast_status
+            
+            raw_resume_time = status['auto_resume_time']
+            if not status['enabled'] and raw_resume_time:
+                # Parse the stored time once per distinct value
+                if self._resume_ts[0] != raw_resume_time:
+                    self._resume_ts = (raw_resume_time, datetime.fromisoformat(raw_resume_time).timestamp())
                 
-                if datetime.now() >= resume_time:
+                if time.time() >= self._resume_ts[1]:
                     # Auto-resume broadcasts
-                    self.db.set_broadcast_status(True)
+                    await run_db(self.db.set_broadcast_status, True)
+                    self._broadcast_status = None
                     
                     # Notify admin
                     await self._notify_admin_auto_resume()
@@ -367,11 +547,20 @@ class MessageScheduler:
         except Exception as e:
             logging.error(f"❌ Error notifying admin about auto-resume: {e}")
     
+    def _insert_scheduled_messages(self, rows: List[tuple]):
+        """Insert (user_id, message_number, scheduled_at) rows in one transaction"""
+        with self.db.get_connection() as conn:
+            conn.executemany('''
+                INSERT INTO scheduled_user_messages (user_id, message_number, scheduled_at, status)
+                VALUES (?, ?, ?, 'scheduled')
+            ''', rows)
+            conn.commit()
+    
     async def schedule_user_messages(self, user_id: int):
         """Schedule automatic message sequence for new user"""
         try:
             # Get all enabled broadcast messages
-            messages = self.db.get_all_broadcast_messages()
+            messages = await run_db(self.db.get_all_broadcast_messages)
             enabled_messages = [msg for msg in messages if msg.get('is_enabled', 1)]
             
             if not enabled_messages:
@@ -379,29 +568,17 @@ class MessageScheduler:
                 return
             
             base_time = datetime.now()
-            scheduled_count = 0
+            rows = [
+                (user_id, msg['message_number'], base_time + timedelta(hours=msg['delay_hours']))
+                for msg in enabled_messages
+            ]
             
-            for msg in enabled_messages:
-                try:
-                    # Calculate send time
-                    delay_hours = msg['delay_hours']
-                    send_time = base_time + timedelta(hours=delay_hours)
-                    
-                    # Schedule message
-                    self.db.schedule_user_message(
-                        user_id=user_id,
-                        message_number=msg['message_number'],
-                        scheduled_at=send_time
-                    )
-                    
-                    scheduled_count += 1
-                    
-                    logging.info(f"📅 Scheduled message {msg['message_number']} for user {user_id} at {send_time}")
-                    
-                except Exception as e:
-                    logging.error(f"❌ Error scheduling message {msg['message_number']}: {e}")
+            # One transaction for the whole sequence
+            await run_db(self._insert_scheduled_messages, rows)
+            scheduled_count = len(rows)
             
             logging.info(f"✅ Scheduled {scheduled_count} messages for user {user_id}")
+            self.wake()
             
         except Exception as e:
             logging.error(f"❌ Error scheduling user messages: {e}")
@@ -4,8 +4,34 @@ UTM Utils - утилиты для автоматического добавле
 
 import re
 import logging
+from functools import lru_cache
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-from typing import Optional
+from typing import Optional, Tuple
+
+# Compiled once; broadcasts scan the same text for every recipient
+_URL_RE = re.compile(r'https?://[^\s<>"]+')
+
+# Stands in for utm_id in templates; survives urlencode unchanged
+UTM_ID_PLACEHOLDER = '__UTM_ID__'
+
+# Keys add_utm_to_url sets; a URL carrying all of them is left as is
+_UTM_MARKERS = ('utm_source=', 'utm_medium=', 'utm_campaign=', 'utm_id=')
+
+@lru_cache(maxsize=256)
+def _utm_suffix(source: str, medium: str, campaign: str) -> str:
+    """Encoded UTM query string without utm_id (same for a whole campaign)"""
+    return urlencode({
+        'utm_source': source,
+        'utm_medium': medium,
+        'utm_campaign': campaign
+    })
+
+@lru_cache(maxsize=4096)
+def _parse_url(url: str):
+    """Parse URL and its query once; results are immutable so safe to share"""
+    parsed = urlparse(url)
+    query_items = tuple((key, tuple(values)) for key, values in parse_qs(parsed.query).items())
+    return parsed, query_items
 
 def add_utm_to_url(url: str, user_id: int, source: str = 'bot', 
                    campaign: str = 'auto', medium: str = 'telegram') -> str:
@@ -22,15 +48,25 @@ def add_utm_to_url(url: str, user_id: int, source: str = 'bot',
     Returns:
         URL with UTM parameters
     """
+    # Already fully tagged, nothing to add
+    if all(marker in url for marker in _UTM_MARKERS):
+        return url
+    
+    # No UTM keys to merge and no fragment, so just append to the query
+    if (url.startswith(('http://', 'https://')) and 'utm_' not in url
+            and '#' not in url and url[-1] not in '?&'):
+        sep = '&' if '?' in url else '?'
+        return f"{url}{sep}{_utm_suffix(source, medium, campaign)}&{urlencode({'utm_id': user_id})}"
+    
     try:
         # Parse URL
-        parsed = urlparse(url)
+        parsed, query_items = _parse_url(url)
         
         # Skip if not http/https
         if parsed.scheme not in ['http', 'https']:
             return url
             
-        query_params = parse_qs(parsed.query)
+        query_params = {key: list(values) for key, values in query_items}
         
         # Add UTM parameters if not already present
         utm_params = {
@@ -69,23 +105,30 @@ def process_text_links(text: str, user_id: int, source: str = 'bot',
         Text with UTM-enhanced URLs
     """
     try:
-        # Pattern for URLs
-        url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-        
-        def replace_url(match):
-            original_url = match.group(0)
-            utm_url = add_utm_to_url(original_url, user_id, source, campaign)
-            return utm_url
-        
         # Replace all URLs with UTM versions
-        processed_text = re.sub(url_pattern, replace_url, text)
-        
-        return processed_text
+        return _URL_RE.sub(lambda m: add_utm_to_url(m.group(0), user_id, source, campaign), text)
         
     except Exception as e:
         logging.error(f"Error processing text links: {e}")
         return text  # Return original text if error
 
+def build_utm_template(text: str, source: str = 'bot',
+                       campaign: str = 'auto') -> Tuple[str, bool]:
+    """
+    Add UTM parameters to all links once, leaving a placeholder for utm_id
+    
+    Args:
+        text: Text containing URLs
+        source: UTM source
+        campaign: UTM campaign
+        
+    Returns:
+        (template, has_placeholder); fill per user with
+        template.replace(UTM_ID_PLACEHOLDER, str(user_id))
+    """
+    template = process_text_links(text, UTM_ID_PLACEHOLDER, source, campaign)
+    return template, UTM_ID_PLACEHOLDER in template
+
 def extract_utm_params(url: str) -> dict:
     """
     Extract UTM parameters from URL